@@ -0,0 +1,320 @@
+"""Benchmarks for the hot paths of ZyteSmartProxyMiddleware.
+
+Each scenario drives process_request, process_response or process_exception
+with a synthetic stream of requests and responses, and reports:
+
+-   the time per call, in microseconds (best of several rounds),
+
+-   the memory allocated per call and still allocated after the round (net),
+    and the peak memory allocated during a round, in bytes, as measured by
+    tracemalloc.
+
+Run it with scrapy-zyte-smartproxy installed, e.g. with ``tox -e benchmark``,
+or directly::
+
+    python benchmarks/bench_middleware.py
+    python benchmarks/bench_middleware.py --save baseline.json
+    python benchmarks/bench_middleware.py --compare baseline.json
+
+With ``--compare``, the exit code is 1 if any scenario is slower than in the
+baseline by more than ``--tolerance`` (a ratio, 0.2 by default).
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import logging
+import sys
+import warnings
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None  # type: ignore
+
+from scrapy.http import Request, Response
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import ConnectionRefusedError
+
+from scrapy_zyte_smartproxy import ZyteSmartProxyMiddleware
+
+SLOT_KEY = "example.com"
+URL = "http://example.com/page"
+SPM_URL = "http://proxy.zyte.com:8011"
+ZYTE_API_URL = "http://api.zyte.com:8011"
+
+
+class Slot(object):
+
+    def __init__(self):
+        self.delay = 0.0
+        self.concurrency = 8
+
+
+class Downloader(object):
+
+    def __init__(self):
+        self.slots = {SLOT_KEY: Slot()}
+
+
+class Engine(object):
+
+    def __init__(self):
+        self.downloader = Downloader()
+
+    def close_spider(self, spider, reason):
+        pass
+
+
+def _middleware(**settings):
+    settings.setdefault("ZYTE_SMARTPROXY_APIKEY", "apikey")
+    settings.setdefault("ZYTE_SMARTPROXY_ENABLED", True)
+    settings.setdefault("ZYTE_SMARTPROXY_MAXBANS", sys.maxsize)
+    crawler = get_crawler(Spider, settings)
+    crawler.engine = Engine()
+    mw = ZyteSmartProxyMiddleware.from_crawler(crawler)
+    spider = Spider("benchmark")
+    mw.open_spider(spider)
+    return mw, spider
+
+
+def _requests(number, headers=None):
+    return [
+        Request(URL, headers=headers, meta={"download_slot": SLOT_KEY})
+        for _ in range(number)
+    ]
+
+
+def _proxied_requests(mw, spider, number, headers=None):
+    requests = _requests(number, headers=headers)
+    for request in requests:
+        mw.process_request(request, spider)
+    return requests
+
+
+def _response(status=200, headers=None, target="spm"):
+    headers = dict(headers or {})
+    if target == "spm":
+        headers["X-Crawlera-Version"] = "1.36.3-cd5e44"
+    else:
+        headers["Zyte-Request-Id"] = "123456789"
+    return Response(URL, status=status, headers=headers)
+
+
+def process_request_spm(number):
+    mw, spider = _middleware(ZYTE_SMARTPROXY_URL=SPM_URL)
+    requests = _requests(number, headers={"User-Agent": "Scrapy"})
+    return [(mw.process_request, (request, spider)) for request in requests]
+
+
+def process_request_zyte_api(number):
+    mw, spider = _middleware(ZYTE_SMARTPROXY_URL=ZYTE_API_URL)
+    requests = _requests(number, headers={"User-Agent": "Scrapy"})
+    return [(mw.process_request, (request, spider)) for request in requests]
+
+
+def process_request_translation(number):
+    mw, spider = _middleware(ZYTE_SMARTPROXY_URL=SPM_URL)
+    requests = _requests(
+        number,
+        headers={
+            "Zyte-Device": "desktop",
+            "Zyte-Geolocation": "US",
+            "Zyte-Foo": "bar",
+        },
+    )
+    return [(mw.process_request, (request, spider)) for request in requests]
+
+
+def process_request_default_headers(number):
+    mw, spider = _middleware(
+        ZYTE_SMARTPROXY_DEFAULT_HEADERS={
+            "X-Crawlera-Profile": "desktop",
+            "X-Crawlera-Cookies": "disable",
+        },
+    )
+    requests = _requests(number, headers={"X-Crawlera-UA": "desktop"})
+    return [(mw.process_request, (request, spider)) for request in requests]
+
+
+def process_request_unproxied(number):
+    mw, spider = _middleware(ZYTE_SMARTPROXY_ENABLED=False)
+    requests = _requests(number, headers={"X-Crawlera-Profile": "desktop"})
+    return [(mw.process_request, (request, spider)) for request in requests]
+
+
+def process_request_force_enabled(number):
+    mw, spider = _middleware(
+        ZYTE_SMARTPROXY_ENABLED=False,
+        ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES=[403],
+    )
+    mw.enabled_for_domain["example.com"] = True
+    requests = _requests(number)
+    return [(mw.process_request, (request, spider)) for request in requests]
+
+
+def _process_response(number, target="spm", **kwargs):
+    url = SPM_URL if target == "spm" else ZYTE_API_URL
+    mw, spider = _middleware(ZYTE_SMARTPROXY_URL=url)
+    requests = _proxied_requests(mw, spider, number)
+    return [
+        (mw.process_response, (request, _response(target=target, **kwargs), spider))
+        for request in requests
+    ]
+
+
+def process_response_spm(number):
+    return _process_response(number)
+
+
+def process_response_zyte_api(number):
+    return _process_response(number, target="zyte_api")
+
+
+def process_response_ban(number):
+    return _process_response(
+        number,
+        status=503,
+        headers={"X-Crawlera-Error": "banned", "Retry-After": "1"},
+    )
+
+
+def process_response_throttle(number):
+    return _process_response(
+        number,
+        target="zyte_api",
+        status=429,
+        headers={"Zyte-Error-Type": "/limits/over-domain-limit"},
+    )
+
+
+def process_exception_connection_refused(number):
+    mw, spider = _middleware()
+    requests = _proxied_requests(mw, spider, number)
+    return [
+        (mw.process_exception, (request, ConnectionRefusedError(), spider))
+        for request in requests
+    ]
+
+
+SCENARIOS = (
+    process_request_spm,
+    process_request_zyte_api,
+    process_request_translation,
+    process_request_default_headers,
+    process_request_unproxied,
+    process_request_force_enabled,
+    process_response_spm,
+    process_response_zyte_api,
+    process_response_ban,
+    process_response_throttle,
+    process_exception_connection_refused,
+)
+
+
+def _run_round(calls):
+    start = default_timer()
+    for function, args in calls:
+        function(*args)
+    return default_timer() - start
+
+
+def _measure_memory(calls):
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        _run_round(calls)
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (after - before) / float(len(calls)), peak - before
+
+
+def run(scenario, number, repeat):
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = min(_run_round(scenario(number)) for _ in range(repeat))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    net, peak = _measure_memory(scenario(number))
+    return {
+        "us_per_call": best / number * 1e6,
+        "net_bytes_per_call": net,
+        "peak_bytes": peak,
+    }
+
+
+def _format(value, pattern):
+    return "n/a" if value is None else pattern % value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "-n", "--number", type=int, default=10000, help="calls per round"
+    )
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="rounds")
+    parser.add_argument(
+        "-k", "--filter", default="", help="only run scenarios matching this"
+    )
+    parser.add_argument("--save", help="save results to this JSON file")
+    parser.add_argument("--compare", help="compare with results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    # Header warnings are expected, and logging them would skew results.
+    logging.getLogger("scrapy_zyte_smartproxy").setLevel(logging.ERROR)
+    warnings.simplefilter("ignore")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print(
+        "%-40s %12s %14s %12s %10s"
+        % ("scenario", "us/call", "net B/call", "peak B", "vs base")
+    )
+    for scenario in SCENARIOS:
+        name = scenario.__name__
+        if args.filter not in name:
+            continue
+        result = results[name] = run(scenario, args.number, args.repeat)
+        change = ""
+        if name in baseline:
+            ratio = result["us_per_call"] / baseline[name]["us_per_call"] - 1
+            change = "%+.1f%%" % (ratio * 100)
+            if ratio > args.tolerance:
+                regressions.append(name)
+        print(
+            "%-40s %12.2f %14s %12s %10s"
+            % (
+                name,
+                result["us_per_call"],
+                _format(result["net_bytes_per_call"], "%.1f"),
+                _format(result["peak_bytes"], "%d"),
+                change,
+            )
+        )
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print("Regressions: %s" % ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""End-to-end load test of ZyteSmartProxyMiddleware.
+
+It starts the mock proxy from ``tests/mockserver.py`` and runs a full Scrapy
+crawl through it, then reports:
+
+-   requests per second, counting every response that reached the spider,
+
+-   the 50th, 95th and 99th percentiles and the maximum of the download
+    latency, in milliseconds,
+
+-   the response status counts, the download exception counts and the
+    middleware stats.
+
+Ban and throttling storms can be simulated with ``--ban``, ``--throttle`` and
+``--retry-after``, e.g.::
+
+    python benchmarks/loadtest.py --requests 2000 --ban 0.2
+    python benchmarks/loadtest.py --mode zyte_api --throttle 0.5 --retry-after 1
+
+Options not listed in ``--help`` are passed to the mock proxy, run
+``python -m tests.mockserver --help`` for those.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from scrapy import Spider  # noqa: E402
+from scrapy.crawler import CrawlerProcess  # noqa: E402
+
+from tests.mockserver import MockProxyServer  # noqa: E402
+
+EXCEPTION_PREFIX = "downloader/exception_type_count/"
+
+
+class LoadTestSpider(Spider):
+    name = "loadtest"
+
+    def __init__(self, requests=1000, domains=10, *args, **kwargs):
+        super(LoadTestSpider, self).__init__(*args, **kwargs)
+        # start_urls, unlike start_requests, works on all Scrapy versions.
+        self.start_urls = [
+            "http://domain%d.example/%d" % (i % domains, i) for i in range(requests)
+        ]
+        self.latencies = []  # type: list
+        self.statuses = Counter()  # type: Counter
+
+    def parse(self, response):
+        self.latencies.append(response.meta["download_latency"])
+        self.statuses[response.status] += 1
+
+
+def _percentile(values, percentile):
+    if not values:
+        return None
+    index = int(round(percentile / 100.0 * (len(values) - 1)))
+    return values[index] * 1000
+
+
+def run(proxy_url, requests, domains, settings):
+    settings = dict(
+        {
+            "ZYTE_SMARTPROXY_ENABLED": True,
+            "ZYTE_SMARTPROXY_URL": proxy_url,
+            "ZYTE_SMARTPROXY_APIKEY": "apikey",
+            "DOWNLOADER_MIDDLEWARES": {
+                "scrapy_zyte_smartproxy.ZyteSmartProxyMiddleware": 610,
+            },
+            "HTTPERROR_ALLOW_ALL": True,
+            "LOG_LEVEL": "WARNING",
+            "TELNETCONSOLE_ENABLED": False,
+        },
+        **settings
+    )
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(LoadTestSpider)
+    start = default_timer()
+    process.crawl(crawler, requests=requests, domains=domains)
+    process.start()
+    elapsed = default_timer() - start
+
+    spider = crawler.spider
+    latencies = sorted(spider.latencies)
+    stats = crawler.stats.get_stats()
+    return {
+        "elapsed": elapsed,
+        "responses": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": _percentile(latencies, 50),
+            "p95": _percentile(latencies, 95),
+            "p99": _percentile(latencies, 99),
+            "max": _percentile(latencies, 100),
+        },
+        "statuses": {str(key): value for key, value in spider.statuses.items()},
+        "exceptions": {
+            key.replace(EXCEPTION_PREFIX, "", 1): value
+            for key, value in stats.items()
+            if key.startswith(EXCEPTION_PREFIX)
+        },
+        "finish_reason": stats.get("finish_reason"),
+        "middleware_stats": {
+            key: value
+            for key, value in stats.items()
+            if key.startswith(("zyte_smartproxy/", "zyte_api_proxy/"))
+        },
+    }
+
+
+def _print(result):
+    print("Elapsed:       %.2f s" % result["elapsed"])
+    print("Responses:     %d" % result["responses"])
+    print("Requests/s:    %.1f" % result["requests_per_second"])
+    for name, value in sorted(result["latency_ms"].items()):
+        print(
+            "Latency %-5s  %s" % (name, "n/a" if value is None else "%.1f ms" % value)
+        )
+    print("Finish reason: %s" % result["finish_reason"])
+    print("Statuses:")
+    for key, value in sorted(result["statuses"].items()):
+        print("    %-30s %d" % (key, value))
+    print("Exceptions:")
+    for key, value in sorted(result["exceptions"].items()):
+        print("    %-30s %d" % (key, value))
+    print("Middleware stats:")
+    for key, value in sorted(result["middleware_stats"].items()):
+        print("    %-60s %s" % (key, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--domains", type=int, default=10)
+    parser.add_argument(
+        "-s",
+        "--set",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Scrapy setting, e.g. -s CONCURRENT_REQUESTS=32",
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON output")
+    args, proxy_args = parser.parse_known_args(argv)
+    settings = dict(setting.split("=", 1) for setting in args.set)
+
+    logging.getLogger("scrapy_zyte_smartproxy").setLevel(logging.ERROR)
+
+    with MockProxyServer(args=proxy_args) as proxy:
+        result = run(proxy.url, args.requests, args.domains, settings)
+    if args.json:
+        print(json.dumps(result, sort_keys=True))
+    else:
+        _print(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
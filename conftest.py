@@ -0,0 +1,4 @@
+import sys
+
+# Python 3 syntax, only imported on Scrapy 2.6 and later.
+collect_ignore = ["scrapy_zyte_smartproxy/_async.py"] if sys.version_info < (3,) else []
@@ -0,0 +1,14 @@
+"""Code that requires Python 3 syntax, only imported on Scrapy 2.6 and later,
+which require Python 3."""
+
+from scrapy.utils.defer import maybe_deferred_to_future
+
+
+async def wait_for(deferred):
+    """Return the result of *deferred* once it fires.
+
+    Scrapy 2.14 and later deprecate returning Deferreds from
+    ``process_request``, so Deferreds are returned wrapped in this coroutine
+    instead.
+    """
+    return await maybe_deferred_to_future(deferred)
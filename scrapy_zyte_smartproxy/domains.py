@@ -0,0 +1,119 @@
+# Key of node values in DomainTrie nodes, labels are never None.
+_VALUE = None
+
+
+def _labels(domain):
+    return reversed(domain.lower().strip(".").split("."))
+
+
+class DomainTrie(object):
+    """Mapping of domains to values where the value of a domain also applies
+    to its subdomains, unless they have a value of their own.
+
+    Lookups take O(n) time, where n is the number of labels of the looked up
+    domain, regardless of the number of domains in the mapping.
+    """
+
+    def __init__(self, items=()):
+        # Nested dicts, from the top-level domain down, where the _VALUE key
+        # holds a (domain, value) tuple.
+        self._root = {}  # type: dict
+        self._len = 0
+        for domain, value in dict(items).items():
+            self[domain] = value
+
+    def __len__(self):
+        return self._len
+
+    def __setitem__(self, domain, value):
+        node = self._root
+        for label in _labels(domain):
+            node = node.setdefault(label, {})
+        if _VALUE not in node:
+            self._len += 1
+        node[_VALUE] = (domain, value)
+
+    def __contains__(self, domain):
+        node = self._root
+        for label in _labels(domain):
+            node = node.get(label)
+            if node is None:
+                return False
+        return _VALUE in node
+
+    def match(self, host):
+        """Return a ``(domain, value)`` tuple for the longest domain that is
+        *host* or a parent domain of *host*, or ``None``."""
+        node = self._root
+        found = None
+        for label in _labels(host):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(_VALUE, found)
+        return found
+
+    def get(self, host, default=None):
+        """Return the value of the longest domain that is *host* or a parent
+        domain of *host*, or *default*."""
+        found = self.match(host)
+        return default if found is None else found[1]
+
+    def discard(self, domain):
+        """Remove *domain*, but not its subdomains, if present."""
+        path = []
+        node = self._root
+        for label in _labels(domain):
+            child = node.get(label)
+            if child is None:
+                return
+            path.append((node, label))
+            node = child
+        if node.pop(_VALUE, None) is None:
+            return
+        self._len -= 1
+        # Remove nodes left empty.
+        for parent, label in reversed(path):
+            if parent[label]:
+                break
+            del parent[label]
+
+    def items(self):
+        items = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            for label, child in node.items():
+                if label is _VALUE:
+                    items.append(child)
+                else:
+                    nodes.append(child)
+        return items
+
+
+class DomainPolicy(object):
+    """Settings that apply to the requests of a domain, see
+    ``ZYTE_SMARTPROXY_DOMAIN_POLICIES``.
+
+    *enabled* is ``None`` to follow the global settings, and *headers* is the
+    list of ``(header, value)`` tuples to set by default on requests.
+    """
+
+    __slots__ = (
+        "enabled",
+        "headers",
+        "download_timeout",
+        "backoff_step",
+        "backoff_max",
+        "maxbans",
+    )
+
+    def __init__(
+        self, enabled, headers, download_timeout, backoff_step, backoff_max, maxbans
+    ):
+        self.enabled = enabled
+        self.headers = headers
+        self.download_timeout = download_timeout
+        self.backoff_step = backoff_step
+        self.backoff_max = backoff_max
+        self.maxbans = maxbans
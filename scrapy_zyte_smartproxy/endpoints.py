@@ -0,0 +1,99 @@
+from collections import deque
+
+
+class Endpoint(object):
+    """Proxy endpoint of an :class:`EndpointPool`."""
+
+    __slots__ = (
+        "url",
+        "auth_url",
+        "weight",
+        "outstanding",
+        "down_until",
+        "_errors",
+    )
+
+    def __init__(self, url, auth_url, weight=1.0):
+        self.url = url
+        self.auth_url = auth_url
+        self.weight = float(weight)
+        self.outstanding = 0
+        self.down_until = 0.0
+        # Timestamps of recent errors.
+        self._errors = deque()  # type: deque
+
+    def __repr__(self):
+        return "Endpoint({!r}, weight={!r})".format(self.url, self.weight)
+
+
+class EndpointPool(object):
+    """Pool of proxy endpoints.
+
+    :meth:`select` picks the endpoint with the fewest outstanding requests
+    relative to its weight, among those that are not down. Endpoints are down
+    for *down_time* seconds after *error_threshold* errors within
+    *error_window* seconds.
+    """
+
+    def __init__(self, endpoints, error_threshold, error_window, down_time):
+        self.endpoints = list(endpoints)
+        self.error_threshold = error_threshold
+        self.error_window = error_window
+        self.down_time = down_time
+        # Keys are endpoint URLs with and without credentials, as the latter
+        # are found in the proxy request meta key once HttpProxyMiddleware has
+        # processed a request.
+        self._by_url = {}
+        for endpoint in self.endpoints:
+            self._by_url[endpoint.url] = endpoint
+            self._by_url[endpoint.auth_url] = endpoint
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def get(self, url):
+        """Return the endpoint of *url*, with or without credentials, or
+        ``None``."""
+        return self._by_url.get(url)
+
+    def select(self, now):
+        """Return the endpoint to use for a new request, and count the request
+        as outstanding.
+
+        If all endpoints are down, the one that has been down the longest is
+        returned.
+        """
+        best = None
+        best_score = None
+        for endpoint in self.endpoints:
+            if endpoint.down_until > now:
+                continue
+            score = (endpoint.outstanding + 1) / endpoint.weight
+            if best_score is None or score < best_score:
+                best, best_score = endpoint, score
+        if best is None:
+            best = min(self.endpoints, key=lambda endpoint: endpoint.down_until)
+        best.outstanding += 1
+        return best
+
+    def release(self, endpoint):
+        if endpoint.outstanding > 0:
+            endpoint.outstanding -= 1
+
+    def all_down(self, now):
+        return all(endpoint.down_until > now for endpoint in self.endpoints)
+
+    def record_error(self, endpoint, now):
+        """Record an error of *endpoint*, and return ``True`` if it marks
+        *endpoint* as down."""
+        if endpoint.down_until > now:
+            return False
+        errors = endpoint._errors
+        errors.append(now)
+        while now - errors[0] > self.error_window:
+            errors.popleft()
+        if len(errors) < self.error_threshold:
+            return False
+        errors.clear()
+        endpoint.down_until = now + self.down_time
+        return True
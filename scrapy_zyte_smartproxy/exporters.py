@@ -0,0 +1,216 @@
+"""Live exporters of middleware metrics, see
+``ZYTE_SMARTPROXY_METRICS_EXPORTER``.
+
+Exporters get metrics from a *collect* callable that returns a ``(counters,
+gauges)`` tuple, where *counters* is a dict of stat names, as found in
+``crawler.stats``, and their values, and *gauges* is a list of ``(name,
+labels, value)`` tuples, where *name* is also a stat-like name and *labels* is
+a dict.
+"""
+
+import logging
+import re
+import socket
+
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+# The reactor is imported where needed, so that importing this module does not
+# install one.
+
+logger = logging.getLogger(__name__)
+
+_INVALID_NAME_CHARACTERS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _parse_address(address, default_port):
+    host, separator, port = address.rpartition(":")
+    if not separator:
+        host, port = address, ""
+    return host or "127.0.0.1", int(port) if port else default_port
+
+
+class MetricsExporter(object):
+    """Base class of metrics exporters.
+
+    *address* is a ``host:port`` string, where either part may be missing to
+    use its default value.
+    """
+
+    default_port = None  # type: int
+
+    def __init__(self, collect, address="", interval=10.0):
+        self.collect = collect
+        self.host, self.port = _parse_address(address, self.default_port)
+        self.interval = interval
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PrometheusExporter(MetricsExporter):
+    """Serves metrics in the Prometheus text format over HTTP, on any path.
+
+    Counter names get a ``_total`` suffix, and ``/`` and other characters not
+    allowed in metric names are replaced by ``_``, e.g.
+    ``zyte_smartproxy/response/status/200`` becomes
+    ``zyte_smartproxy_response_status_200_total``.
+    """
+
+    default_port = 9410
+
+    def __init__(self, *args, **kwargs):
+        super(PrometheusExporter, self).__init__(*args, **kwargs)
+        self._port = None
+
+    def start(self):
+        from twisted.internet import reactor
+
+        self._port = reactor.listenTCP(
+            self.port, Site(_PrometheusResource(self)), interface=self.host
+        )
+        logger.info(
+            "Serving Zyte proxy metrics on http://%s:%d",
+            self.host,
+            self._port.getHost().port,
+        )
+
+    def stop(self):
+        if self._port is not None:
+            self._port.stopListening()
+            self._port = None
+
+    def render(self):
+        counters, gauges = self.collect()
+        lines = []
+        for name, value in sorted(counters.items()):
+            name = _INVALID_NAME_CHARACTERS.sub("_", name) + "_total"
+            lines.append("# TYPE {} counter".format(name))
+            lines.append("{} {}".format(name, value))
+        declared = set()
+        for name, labels, value in sorted(gauges, key=lambda gauge: gauge[0]):
+            name = _INVALID_NAME_CHARACTERS.sub("_", name)
+            if name not in declared:
+                declared.add(name)
+                lines.append("# TYPE {} gauge".format(name))
+            lines.append(
+                "{}{{{}}} {}".format(
+                    name,
+                    ",".join(
+                        '{}="{}"'.format(key, _escape_label_value(label))
+                        for key, label in sorted(labels.items())
+                    ),
+                    value,
+                )
+            )
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _PrometheusResource(Resource):
+
+    isLeaf = True
+
+    def __init__(self, exporter):
+        Resource.__init__(self)
+        self.exporter = exporter
+
+    def render_GET(self, request):
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        return self.exporter.render()
+
+
+class StatsDExporter(MetricsExporter):
+    """Pushes metrics to a StatsD server over UDP every *interval* seconds.
+
+    Counters are sent as the increments since the previous push, so that the
+    StatsD server can compute rates, and gauges as their current values. ``/``
+    in names becomes ``.``, and gauge label values are appended to the name,
+    e.g. ``zyte_smartproxy.slot.bans.example_com``.
+    """
+
+    default_port = 8125
+    # Keep datagrams within the usual MTU.
+    max_datagram_size = 1432
+
+    def __init__(self, *args, **kwargs):
+        super(StatsDExporter, self).__init__(*args, **kwargs)
+        self._socket = None
+        self._task = None
+        self._sent = {}  # type: dict
+
+    def start(self):
+        # Resolve the server address once, instead of on every push.
+        family, _, _, _, address = socket.getaddrinfo(
+            self.host, self.port, 0, socket.SOCK_DGRAM
+        )[0]
+        self._address = address
+        self._socket = socket.socket(family, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+        self._task = LoopingCall(self.push)
+        self._task.start(self.interval, now=False)
+
+    def stop(self):
+        if self._task is not None and self._task.running:
+            self._task.stop()
+        if self._socket is not None:
+            self.push()
+            self._socket.close()
+            self._socket = None
+
+    def push(self):
+        self._send(self.lines())
+
+    def lines(self):
+        counters, gauges = self.collect()
+        lines = []
+        for name, value in sorted(counters.items()):
+            delta = value - self._sent.get(name, 0)
+            if not delta:
+                continue
+            self._sent[name] = value
+            lines.append("{}:{}|c".format(_statsd_name(name), delta))
+        for name, labels, value in gauges:
+            parts = [name] + [labels[key] for key in sorted(labels)]
+            lines.append(
+                "{}:{}|g".format(".".join(_statsd_name(part) for part in parts), value)
+            )
+        return lines
+
+    def _send(self, lines):
+        datagram = b""
+        for line in lines:
+            line = line.encode("utf-8")
+            if datagram and len(datagram) + len(line) >= self.max_datagram_size:
+                self._sendto(datagram)
+                datagram = b""
+            datagram = datagram + b"\n" + line if datagram else line
+        if datagram:
+            self._sendto(datagram)
+
+    def _sendto(self, datagram):
+        try:
+            self._socket.sendto(datagram, self._address)
+        except (OSError, socket.error) as exception:
+            logger.debug("Could not send metrics to StatsD: %s", exception)
+
+
+def _statsd_name(name):
+    return ".".join(
+        _INVALID_NAME_CHARACTERS.sub("_", part) for part in str(name).split("/")
+    )
+
+
+# Values of ZYTE_SMARTPROXY_METRICS_EXPORTER that do not need an import path.
+EXPORTERS = {
+    "prometheus": PrometheusExporter,
+    "statsd": StatsDExporter,
+}
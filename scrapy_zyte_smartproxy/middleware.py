@@ -1,32 +1,119 @@
+import json
 import logging
 import os
 import warnings
 from base64 import urlsafe_b64decode
-from collections import defaultdict
-from typing import Dict, List  # noqa
+from collections import OrderedDict
+from heapq import nlargest
+from time import time
+from typing import Any, Dict, List, Optional, Tuple  # noqa
 
 try:
     from urllib.request import _parse_proxy  # type: ignore
 except ImportError:
     from urllib2 import _parse_proxy  # type: ignore
 
-from scrapy import signals
-from scrapy.exceptions import ScrapyDeprecationWarning
+import six
+from scrapy import signals, version_info
+from scrapy.exceptions import (
+    DontCloseSpider,
+    IgnoreRequest,
+    ScrapyDeprecationWarning,
+)
 from scrapy.resolver import dnscache
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.misc import load_object
+from six.moves import intern
 from six.moves.urllib.parse import urlparse, urlunparse
+from twisted.internet.defer import CancelledError, Deferred
 from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.task import LoopingCall, deferLater
 from w3lib.http import basic_auth_header
 
-from scrapy_zyte_smartproxy.utils import exp_backoff
+from scrapy_zyte_smartproxy.domains import DomainPolicy, DomainTrie
+from scrapy_zyte_smartproxy.endpoints import Endpoint, EndpointPool
+from scrapy_zyte_smartproxy.exporters import EXPORTERS, MetricsExporter  # noqa
+from scrapy_zyte_smartproxy.sessions import CREATE, SessionPool
+from scrapy_zyte_smartproxy.state import StateBackend  # noqa
+from scrapy_zyte_smartproxy.utils import (
+    BanWindow,
+    BoundedStore,
+    CircuitBreaker,
+    LatencyHistogram,
+    TokenBucket,
+    WarningAggregator,
+    exp_backoff,
+    load_domains,
+    parse_retry_after,
+    save_domains,
+)
+
+if version_info >= (2, 6):
+    from scrapy_zyte_smartproxy._async import wait_for
+else:
+    wait_for = None
 
 logger = logging.getLogger(__name__)
 
+# Keys of ZYTE_SMARTPROXY_RATE_LIMIT_BY_TARGET, values are values of
+# targets_zyte_api.
+_RATE_LIMIT_TARGETS = {"spm": False, "zyte_api": True}
+
+# Keys of ZYTE_SMARTPROXY_DOMAIN_POLICIES values, other than "enabled" and
+# "headers", and their types.
+_DOMAIN_POLICY_SETTINGS = (
+    ("download_timeout", int),
+    ("backoff_step", int),
+    ("backoff_max", int),
+    ("maxbans", int),
+)
+
+# Errors of reading ZYTE_SMARTPROXY_DOMAINS_FILE.
+_DOMAINS_FILE_ERRORS = (
+    IOError,
+    OSError,
+    ValueError,
+    KeyError,
+    TypeError,
+    AttributeError,
+)
+
+# Latency percentiles exported to stats, see _export_latency.
+LATENCY_PERCENTILES = (50, 95, 99)
+
+# Maximum number of download slots, those with the highest ban ratio, to
+# export ban window stats for, see _export_ban_windows.
+BAN_WINDOW_STATS_SLOTS = 100
+
+
+# Keys are values of targets_zyte_api.
+_TARGET_DESCRIPTIONS = {
+    None: "on requests not handled by scrapy-zyte-smartproxy",
+    False: "on requests proxied with Zyte Smart Proxy Manager",
+    True: "on requests proxied with Zyte API",
+}
+
+
+def _fix_url_protocol(url, setting="ZYTE_SMARTPROXY_URL"):
+    if url.startswith("https://"):
+        logger.warning('%s "%s" set with "https://" protocol.' % (setting, url))
+    elif not url.startswith("http://"):
+        logger.warning('Adding "http://" to %s %s' % (setting, url))
+        url = "http://" + url
+    return url
+
 
 def _remove_auth(auth_proxy_url):
     proxy_type, user, password, hostport = _parse_proxy(auth_proxy_url)
     return urlunparse((proxy_type, hostport, "", "", "", ""))
 
 
+def _ignore_cancellation(failure):
+    """Errback for Deferreds that may be cancelled on spider_closed, and
+    that no one else waits for."""
+    failure.trap(CancelledError)
+
+
 class ZyteSmartProxyMiddleware(object):
 
     url = "http://proxy.zyte.com:8011"
@@ -41,18 +128,104 @@ class ZyteSmartProxyMiddleware(object):
     conflicting_headers = ("X-Crawlera-Profile", "X-Crawlera-UA")
     backoff_step = 15
     backoff_max = 180
-    exp_backoff = None
+    # Limits of the stores that keep per-slot, per-domain and per-proxy state
+    state_maxsize = 100000
+    state_ttl = 0
+    stats_flush_interval = 0.0
+    warning_interval = 60
     max_auth_retry_times = 10
+    throttle_retry_enabled = False
+    max_throttle_retry_times = 5
+    session_pool_size = 0
+    circuit_breaker_enabled = False
+    circuit_breaker_threshold = 5
+    circuit_breaker_window = 30
+    circuit_breaker_probes = 1
+    urls = None  # type: Any
+    endpoint_error_threshold = 5
+    endpoint_error_window = 30
+    latency_histograms_enabled = False
+    latency_per_slot = False
+    latency_slots_maxsize = 100
+    latency_export_interval = 60.0
+    metrics_exporter = ""
+    metrics_address = ""
+    metrics_interval = 10.0
+    ban_window = 0
+    ban_ratio = 0.9
+    domains_file = ""
+    domains_file_ttl = 30 * 24 * 60 * 60
+    domains_file_maxsize = 100000
+    rate_limit = 0.0
+    rate_limit_burst = 0
+    rate_limit_by_target = None  # type: Any
+    state_backend = ""
+    state_sync_interval = 10.0
+    quarantine_enabled = False
+    quarantine_time = 300
+    quarantine_max_time = 3600
+    quarantine_close_ratio = 0.5
+    domain_policies = None  # type: Any
     apikey = ""
+    aimd_enabled = False
+    aimd_min_concurrency = 1
+    aimd_max_concurrency = 32
+    aimd_decrease_factor = 0.5
+    aimd_target_latency = 0.0
 
     def __init__(self, crawler):
         self.crawler = crawler
         self.job_id = os.environ.get("SCRAPY_JOB")
         self.spider = None
-        self._bans = defaultdict(int)
-        self._saved_delays = defaultdict(lambda: None)
         self._auth_url = None
-        self.enabled_for_domain = {}  # type: Dict[str, bool]
+        self._endpoints = None  # type: Optional[EndpointPool]
+        self._default_targets_zyte_api = False
+        # Keys are values of targets_zyte_api, values are dicts that map stats
+        # as passed to _inc_stat to full stat names.
+        self._stat_names = {False: {}, True: {}}  # type: Dict[bool, Dict]
+        # Stat increments pending to be flushed into crawler.stats, if
+        # ZYTE_SMARTPROXY_STATS_FLUSH_INTERVAL is set.
+        self._stats_buffer = None  # type: Optional[Dict[str, Any]]
+        self._stats_task = None
+        # Deferreds of requests waiting to be sent, see _admit.
+        self._waits = set()  # type: set
+        self._gates = []  # type: list
+        # Delayed calls that schedule throttled requests again, see
+        # _retry_throttled.
+        self._throttle_retries = set()  # type: set
+        # Deferreds that schedule requests again once a session is available,
+        # see _wait_for_session.
+        self._session_waits = set()  # type: set
+        self._circuit = None  # type: Optional[CircuitBreaker]
+        # Deferreds of requests waiting for the circuit breaker to let them
+        # through.
+        self._circuit_waiters = []  # type: List[Deferred]
+        # Keys are (targets_zyte_api, status // 100) tuples, with None instead
+        # of a status for exceptions, values are LatencyHistogram objects.
+        self._latency = {}  # type: Dict[Tuple[bool, Optional[int]], Any]
+        self._latency_task = None
+        self._exporter = None  # type: Optional[MetricsExporter]
+        self._state = None  # type: Optional[StateBackend]
+        self._state_task = None
+        # Writes to the state backend that _sync_state has yet to do: keys of
+        # download slots with new delays, keys of download slots and their
+        # number of new bans, keys of download slots whose ban count was
+        # reset, and domains enabled by force_enable_on_http_codes.
+        self._pending_delays = set()  # type: set
+        self._pending_bans = {}  # type: Dict[str, int]
+        self._pending_resets = set()  # type: set
+        self._pending_domains = set()  # type: set
+        # Keys are values of targets_zyte_api, with None for the limit of all
+        # targets, values are TokenBucket objects.
+        self._rate_limiters = {}  # type: Dict[Optional[bool], TokenBucket]
+        # Keys are domains enabled by force_enable_on_http_codes, values are
+        # the timestamps when they were enabled, see ZYTE_SMARTPROXY_DOMAINS_FILE.
+        # None if domains are not persisted.
+        self._learned_domains = None  # type: Optional[BoundedStore]
+        # Index of DomainPolicy objects, None if there are no domain policies.
+        self._domain_policies = None  # type: Optional[DomainTrie]
+        self._policies_enable_domains = False
+        self._init_state()
         self.force_enable_on_http_codes = []  # type: List[int]
         self.zyte_api_to_spm_translations = {
             b"zyte-device": b"x-crawlera-profile",
@@ -69,10 +242,48 @@ class ZyteSmartProxyMiddleware(object):
             ("backoff_step", int),
             ("backoff_max", int),
             ("force_enable_on_http_codes", list),
+            ("throttle_retry_enabled", bool),
+            ("max_throttle_retry_times", int),
+            ("session_pool_size", int),
+            ("circuit_breaker_enabled", bool),
+            ("circuit_breaker_threshold", int),
+            ("circuit_breaker_window", int),
+            ("circuit_breaker_probes", int),
+            ("urls", object),  # list or dict
+            ("endpoint_error_threshold", int),
+            ("endpoint_error_window", int),
+            ("latency_histograms_enabled", bool),
+            ("latency_per_slot", bool),
+            ("latency_slots_maxsize", int),
+            ("latency_export_interval", float),
+            ("metrics_exporter", str),
+            ("metrics_address", str),
+            ("metrics_interval", float),
+            ("ban_window", int),
+            ("ban_ratio", float),
+            ("domains_file", str),
+            ("domains_file_ttl", int),
+            ("domains_file_maxsize", int),
+            ("rate_limit", float),
+            ("rate_limit_burst", int),
+            ("rate_limit_by_target", dict),
+            ("state_backend", str),
+            ("state_sync_interval", float),
+            ("quarantine_enabled", bool),
+            ("quarantine_time", int),
+            ("quarantine_max_time", int),
+            ("quarantine_close_ratio", float),
+            ("domain_policies", dict),
+            ("aimd_enabled", bool),
+            ("aimd_min_concurrency", int),
+            ("aimd_max_concurrency", int),
+            ("aimd_decrease_factor", float),
+            ("aimd_target_latency", float),
+            ("state_maxsize", int),
+            ("state_ttl", int),
+            ("stats_flush_interval", float),
+            ("warning_interval", int),
         ]
-        # Keys are proxy URLs, values are booleans (True means Zyte API, False
-        # means Zyte Smart Proxy Manager).
-        self._targets = {}
         # SPM headers that can be used with Zyte API proxy mode
         # https://docs.zyte.com/zyte-api/migration/zyte/smartproxy.html#parameter-mapping
         self.spm_bc_headers = [
@@ -87,14 +298,76 @@ class ZyteSmartProxyMiddleware(object):
             "ZYTE_SMARTPROXY_KEEP_HEADERS", False
         )
 
+    def _init_state(self):
+        # Keys are download slot keys, values are consecutive ban counts.
+        self._bans = self._make_store("bans", default_factory=int)
+        # Keys are download slot keys, values are the slot delays to restore.
+        self._saved_delays = self._make_store(
+            "saved_delays", on_evict=self._restore_evicted_delay
+        )
+        # Keys are download slot keys, values are ((backoff step, backoff
+        # max), exp_backoff generator) tuples. Slots are only tracked while
+        # they are being throttled.
+        self._backoffs = self._make_store("backoffs")
+        # Keys are download slot keys, values are [increase credit, time of
+        # the last concurrency decrease] lists.
+        self._aimd_state = self._make_store("aimd")
+        # Keys are netlocs, values are booleans.
+        self.enabled_for_domain = self._make_store(
+            "domains", on_evict=self._unindex_domain
+        )
+        # Index of enabled_for_domain that also matches subdomains.
+        self._enabled_domain_index = DomainTrie()
+        # Keys are proxy URLs, values are booleans (True means Zyte API, False
+        # means Zyte Smart Proxy Manager).
+        self._targets = self._make_store("targets")
+        # Keys are netlocs, values are SessionPool objects.
+        self._session_pools = self._make_store(
+            "sessions", on_evict=self._evict_session_pool
+        )
+        # Keys are download slot keys, values are the not-before timestamps
+        # last shared through the state backend by this process.
+        self._shared_deadlines = self._make_store("shared_deadlines")
+        # Keys are download slot keys, values are BanWindow objects.
+        self._ban_windows = self._make_store(
+            "ban_windows", default_factory=lambda: BanWindow(self.ban_window)
+        )
+        # Keys are download slot keys, values are [quarantine count minus 1,
+        # end of the quarantine] lists.
+        self._quarantines = self._make_store("quarantines")
+        # Keys are download slot keys, values are dicts like self._latency.
+        self._slot_latency = self._make_store(
+            "latency", default_factory=dict, maxsize=self.latency_slots_maxsize
+        )
+
+    def _make_store(self, name, default_factory=None, on_evict=None, maxsize=None):
+        stat = "state/evicted/{}".format(name)
+
+        def _on_evict(key, value):
+            self._inc_stat(stat, targets_zyte_api=self._default_targets_zyte_api)
+            if on_evict is not None:
+                on_evict(key, value)
+
+        return BoundedStore(
+            maxsize=self.state_maxsize if maxsize is None else maxsize,
+            ttl=self.state_ttl,
+            default_factory=default_factory,
+            on_evict=_on_evict,
+        )
+
     @classmethod
     def from_crawler(cls, crawler):
         o = cls(crawler)
         crawler.signals.connect(o.open_spider, signals.spider_opened)
+        crawler.signals.connect(o.spider_closed, signals.spider_closed)
+        crawler.signals.connect(o.spider_idle, signals.spider_idle)
         return o
 
-    def _make_auth_url(self, spider):
-        parsed_url = urlparse(self.url)
+    def _make_auth_url(self, spider, url=None):
+        parsed_url = urlparse(self.url if url is None else url)
+        if url is not None and parsed_url.username:
+            # Endpoints of ZYTE_SMARTPROXY_URLS may have their own API key.
+            return url
         auth = self.get_proxyauth(spider)
         if not auth.startswith(b"Basic "):
             raise ValueError(
@@ -114,13 +387,57 @@ class ZyteSmartProxyMiddleware(object):
         for k, type_ in self._settings:
             setattr(self, k, self._get_setting_value(spider, k, type_))
 
-        self._fix_url_protocol()
-        self._headers = self.crawler.settings.get(
-            "ZYTE_SMARTPROXY_DEFAULT_HEADERS", {}
-        ).items()
-        self.exp_backoff = exp_backoff(self.backoff_step, self.backoff_max)
+        self._endpoint_urls = self._parse_urls()
+        if self._endpoint_urls:
+            self.url = self._endpoint_urls[0][0]
+        else:
+            self._fix_url_protocol()
+        self._default_targets_zyte_api = urlparse(self.url).hostname == "api.zyte.com"
+        self._headers = [
+            (header, value)
+            for header, value in self.crawler.settings.get(
+                "ZYTE_SMARTPROXY_DEFAULT_HEADERS", {}
+            ).items()
+            if value is not None
+        ]
+        self._compile_header_plans()
+        self._compile_static_headers()
+        self._compile_domain_policies()
+        self._header_warnings = WarningAggregator(logger, self.warning_interval)
+        self._conflicting_headers_reported = False
+        self._init_state()
+        self._gates = []
+        if self.session_pool_size:
+            # First, so that requests waiting for a session, which are dropped
+            # and crawled again later, do not use circuit breaker probes or
+            # rate limit tokens.
+            self._gates.append(self._assign_session)
+        if self.circuit_breaker_enabled:
+            self._circuit = CircuitBreaker(
+                threshold=self.circuit_breaker_threshold,
+                window=self.circuit_breaker_window,
+                open_time=self.connection_refused_delay,
+                probes=self.circuit_breaker_probes,
+            )
+            self._gates.append(self._wait_for_circuit)
+        self._rate_limiters = self._make_rate_limiters()
+        if self.state_backend and self.state_sync_interval <= 0:
+            raise ValueError(
+                "ZYTE_SMARTPROXY_STATE_SYNC_INTERVAL must be greater than 0 "
+                "if ZYTE_SMARTPROXY_STATE_BACKEND is set"
+            )
+        if self._rate_limiters:
+            self._gates.append(self._wait_for_rate_limit)
+        self._latency = {}
+        if self.latency_histograms_enabled:
+            # Last, so that time spent waiting in other gates is not counted.
+            self._gates.append(self._start_latency_timer)
 
-        if not self.enabled and not self.force_enable_on_http_codes:
+        if (
+            not self.enabled
+            and not self.force_enable_on_http_codes
+            and not self._policies_enable_domains
+        ):
             return
 
         if not self.apikey:
@@ -130,12 +447,50 @@ class ZyteSmartProxyMiddleware(object):
             )
             return
 
+        self._learned_domains = None
+        if self.domains_file and self.force_enable_on_http_codes and not self.enabled:
+            self._learned_domains = BoundedStore(maxsize=self.domains_file_maxsize)
+            self._load_domains()
+
         self._auth_url = self._make_auth_url(spider)
         self._authless_url = _remove_auth(self._auth_url)
+        if self._endpoint_urls:
+            self._endpoints = EndpointPool(
+                (
+                    Endpoint(
+                        _remove_auth(url), self._make_auth_url(spider, url), weight
+                    )
+                    for url, weight in self._endpoint_urls
+                ),
+                error_threshold=self.endpoint_error_threshold,
+                error_window=self.endpoint_error_window,
+                down_time=self.connection_refused_delay,
+            )
+
+        if self.stats_flush_interval > 0:
+            self._stats_buffer = {}
+            self._stats_task = LoopingCall(self._flush_stats)
+            self._stats_task.start(self.stats_flush_interval, now=False)
+
+        if self.latency_histograms_enabled and self.latency_export_interval > 0:
+            self._latency_task = LoopingCall(self._export_latency)
+            self._latency_task.start(self.latency_export_interval, now=False)
+
+        if self.state_backend:
+            self._state = load_object(self.state_backend).from_crawler(self.crawler)
+            self._state_task = LoopingCall(self._sync_state)
+            self._state_task.start(self.state_sync_interval)
 
         logger.info(
             "Using Zyte proxy service %s with an API key ending in %s"
-            % (self.url, self.apikey[:7]),
+            % (
+                (
+                    ", ".join(endpoint.url for endpoint in self._endpoints.endpoints)
+                    if self._endpoints is not None
+                    else self.url
+                ),
+                self.apikey[:7],
+            ),
             extra={"spider": spider},
         )
 
@@ -151,9 +506,83 @@ class ZyteSmartProxyMiddleware(object):
                 extra={"spider": spider},
             )
 
+        if self.metrics_exporter:
+            # Last, so that failing to start it does not leave the rest of
+            # the middleware unconfigured.
+            self._start_exporter()
+
+    def _start_exporter(self):
+        exporter_cls = EXPORTERS.get(self.metrics_exporter)
+        if exporter_cls is None:
+            exporter_cls = load_object(self.metrics_exporter)
+        exporter = exporter_cls(
+            self._collect_metrics,
+            address=self.metrics_address,
+            interval=self.metrics_interval,
+        )
+        try:
+            exporter.start()
+        except Exception as error:
+            # e.g. the port is in use by another crawl on the same host.
+            logger.error(
+                "Could not start the %s metrics exporter, metrics will not be "
+                "exported: %s",
+                self.metrics_exporter,
+                error,
+                extra={"spider": self.spider},
+            )
+            return
+        self._exporter = exporter
+
+    def spider_idle(self, spider):
+        """Keep the spider open while throttled requests, or requests waiting
+        for a session, wait to be crawled again outside the engine."""
+        if self._throttle_retries or self._session_waits:
+            raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self._stats_task is not None and self._stats_task.running:
+            self._stats_task.stop()
+        if self._latency_task is not None and self._latency_task.running:
+            self._latency_task.stop()
+        if self.latency_histograms_enabled:
+            self._export_latency()
+            self._export_slot_latency()
+        self._header_warnings.report()
+        if self.ban_window:
+            self._export_ban_windows()
+        self._flush_stats()
+        if self._exporter is not None:
+            self._exporter.stop()
+            self._exporter = None
+        if self._learned_domains is not None:
+            self._save_domains()
+        if self._state is not None:
+            if self._state_task is not None and self._state_task.running:
+                self._state_task.stop()
+            self._sync_state(pull=False)
+            if self._state.dropped:
+                self.crawler.stats.set_value(
+                    "{}/state/dropped_writes".format(
+                        "zyte_api_proxy"
+                        if self._default_targets_zyte_api
+                        else "zyte_smartproxy"
+                    ),
+                    self._state.dropped,
+                )
+            self._state.close()
+            self._state = None
+        for wait in list(self._waits):
+            wait.cancel()
+        for call in list(self._throttle_retries):
+            call.cancel()
+        self._throttle_retries.clear()
+
     def _settings_get(self, type_, *a, **kw):
         if type_ is int:
             return self.crawler.settings.getint(*a, **kw)
+        elif type_ is float:
+            return self.crawler.settings.getfloat(*a, **kw)
         elif type_ is bool:
             return self.crawler.settings.getbool(*a, **kw)
         elif type_ is list:
@@ -191,13 +620,38 @@ class ZyteSmartProxyMiddleware(object):
         )
 
     def _fix_url_protocol(self):
-        if self.url.startswith("https://"):
-            logger.warning(
-                'ZYTE_SMARTPROXY_URL "%s" set with "https://" protocol.' % self.url
-            )
-        elif not self.url.startswith("http://"):
-            logger.warning('Adding "http://" to ZYTE_SMARTPROXY_URL %s' % self.url)
-            self.url = "http://" + self.url
+        self.url = _fix_url_protocol(self.url)
+
+    def _parse_urls(self):
+        """Return ZYTE_SMARTPROXY_URLS as a list of (URL, weight) tuples,
+        without URLs with a weight of 0."""
+        urls = self.urls
+        if not urls:
+            return []
+        if isinstance(urls, six.string_types):
+            try:
+                urls = json.loads(urls)
+            except ValueError:
+                urls = urls.split(",")
+        if isinstance(urls, dict):
+            items = urls.items()
+        else:
+            items = ((url, 1) for url in urls)
+        parsed = []
+        for url, weight in items:
+            weight = float(weight)
+            if weight < 0:
+                raise ValueError(
+                    "Invalid ZYTE_SMARTPROXY_URLS weight {!r} for {!r}, weights "
+                    "must be 0 or greater".format(weight, url)
+                )
+            if weight:
+                parsed.append(
+                    (_fix_url_protocol(url.strip(), "ZYTE_SMARTPROXY_URLS"), weight)
+                )
+        if not parsed:
+            raise ValueError("All ZYTE_SMARTPROXY_URLS have a weight of 0")
+        return parsed
 
     def is_enabled(self, spider):
         """Hook to enable middleware by custom rules."""
@@ -238,30 +692,95 @@ class ZyteSmartProxyMiddleware(object):
             self._targets[auth_url] = targets_zyte_api
         return targets_zyte_api
 
-    def _translate_headers(self, request, targets_zyte_api):
-        if targets_zyte_api:
-            return
-        for header, translation in self.zyte_api_to_spm_translations.items():
-            if header not in request.headers:
-                continue
-            values = request.headers.pop(header)
-            value = b"".join(values)
-            request.headers[translation] = value
-            logger.warning(
-                "Translating header %r (%r) to %r on request %r",
-                header,
-                value,
-                translation,
-                request,
+    def _inc_stat(self, stat, targets_zyte_api, value=1):
+        """Increase a stat.
+
+        *stat* is either a string or a tuple of parts to concatenate, e.g.
+        ``("response/status/", 200)``, so that stat names only need to be
+        built the first time that they are used.
+        """
+        names = self._stat_names[targets_zyte_api]
+        name = names.get(stat)
+        if name is None:
+            prefix = "zyte_api_proxy" if targets_zyte_api else "zyte_smartproxy"
+            suffix = (
+                "".join(str(part) for part in stat) if type(stat) is tuple else stat
             )
+            name = names[stat] = intern(str("{}/{}".format(prefix, suffix)))
+        buffer = self._stats_buffer
+        if buffer is None:
+            self.crawler.stats.inc_value(name, value)
+        else:
+            buffer[name] = buffer.get(name, 0) + value
 
-    def _inc_stat(self, stat, targets_zyte_api, value=1):
-        prefix = "zyte_api_proxy" if targets_zyte_api else "zyte_smartproxy"
-        self.crawler.stats.inc_value("{}/{}".format(prefix, stat), value)
+    def _flush_stats(self):
+        """Add buffered stat increments to the crawler stats."""
+        if not self._stats_buffer:
+            return
+        buffer, self._stats_buffer = self._stats_buffer, {}
+        for name, value in buffer.items():
+            self.crawler.stats.inc_value(name, value)
+
+    def _export_ban_windows(self):
+        """Set the ban ratio and ban rate stats of the download slots with
+        the highest ban ratio.
+
+        Only done when the spider closes, to keep the number of stats writes
+        and stats bounded. Live values are available through the metrics
+        exporter.
+        """
+        prefix = (
+            "zyte_api_proxy" if self._default_targets_zyte_api else "zyte_smartproxy"
+        )
+        now = time()
+        windows = nlargest(
+            BAN_WINDOW_STATS_SLOTS,
+            self._ban_windows.items(),
+            key=lambda item: item[1].ratio,
+        )
+        for key, window in windows:
+            name = "{}/ban_window/slot/{}/".format(prefix, key)
+            self.crawler.stats.set_value(name + "ratio", round(window.ratio, 3))
+            self.crawler.stats.set_value(name + "rate", round(window.rate(now), 3))
+
+    def _collect_metrics(self):
+        """Return the current metrics for a MetricsExporter.
+
+        Counters are the stats increased through :meth:`_inc_stat`, including
+        buffered increments. Gauges are the consecutive ban count, the ban
+        ratio and ban rate, if ZYTE_SMARTPROXY_BAN_WINDOW is set, and the delay
+        of download slots being banned or delayed.
+        """
+        stats = self.crawler.stats
+        buffer = self._stats_buffer or {}
+        counters = {}
+        for names in self._stat_names.values():
+            for name in names.values():
+                counters[name] = stats.get_value(name, 0) + buffer.get(name, 0)
+        prefix = (
+            "zyte_api_proxy" if self._default_targets_zyte_api else "zyte_smartproxy"
+        )
+        gauges = [
+            (prefix + "/slot/bans", {"slot": key}, bans)
+            for key, bans in self._bans.items()
+        ]
+        now = time()
+        for key, window in self._ban_windows.items():
+            labels = {"slot": key}
+            gauges.append((prefix + "/slot/ban_ratio", labels, window.ratio))
+            gauges.append((prefix + "/slot/ban_rate", labels, window.rate(now)))
+        slots = self.crawler.engine.downloader.slots
+        for key in self._saved_delays:
+            slot = slots.get(key)
+            if slot is not None:
+                gauges.append((prefix + "/slot/delay", {"slot": key}, slot.delay))
+        return counters, gauges
 
     def process_request(self, request, spider):
         if self._is_enabled_for_request(request):
-            if "proxy" not in request.meta:
+            if self._endpoints is not None:
+                self._select_endpoint(request)
+            elif "proxy" not in request.meta:
                 request.meta["proxy"] = self._auth_url
             elif (
                 request.meta["proxy"] == self._authless_url
@@ -277,32 +796,501 @@ class ZyteSmartProxyMiddleware(object):
                 )
                 request.meta["proxy"] = self._auth_url
             targets_zyte_api = self._targets_zyte_api(request)
-            self._set_zyte_smartproxy_default_headers(request)
-            request.meta["download_timeout"] = self.download_timeout
-            if self.job_id:
-                job_header = "Zyte-JobId" if targets_zyte_api else "X-Crawlera-JobId"
-                request.headers[job_header] = self.job_id
-            user_agent_header = (
-                "Zyte-Client" if targets_zyte_api else "X-Crawlera-Client"
-            )
-            from scrapy_zyte_smartproxy import __version__
-
-            request.headers[user_agent_header] = (
-                "scrapy-zyte-smartproxy/%s" % __version__
+            policy = self._get_domain_policy(request)
+            self._set_zyte_smartproxy_default_headers(
+                request, targets_zyte_api=targets_zyte_api, headers=policy.headers
             )
+            request.meta["download_timeout"] = policy.download_timeout
+            for header, value in self._static_headers[targets_zyte_api]:
+                request.headers[header] = value
             self._inc_stat("request", targets_zyte_api=targets_zyte_api)
             self._inc_stat(
-                "request/method/{}".format(request.method),
+                ("request/method/", request.method),
                 targets_zyte_api=targets_zyte_api,
             )
             if not self._keep_headers:
-                self._translate_headers(request, targets_zyte_api=targets_zyte_api)
                 self._clean_zyte_smartproxy_headers(
                     request, targets_zyte_api=targets_zyte_api
                 )
+            deferred = self._admit(request, targets_zyte_api=targets_zyte_api)
+            if deferred is None or wait_for is None:
+                return deferred
+            return wait_for(deferred)
         elif not self._keep_headers:
             self._clean_zyte_smartproxy_headers(request)
 
+    def _select_endpoint(self, request):
+        endpoints = self._endpoints
+        assert endpoints is not None
+        proxy = request.meta.get("proxy")
+        if proxy is not None and endpoints.get(proxy) is None:
+            # Proxy set by the user.
+            return
+        endpoint = endpoints.select(time())
+        request.meta["proxy"] = endpoint.auth_url
+        request.meta["zyte_smartproxy_endpoint"] = endpoint.url
+
+    def _release_endpoint(self, request):
+        """Stop counting *request* as outstanding for its endpoint, and
+        return that endpoint, if any."""
+        endpoints = self._endpoints
+        assert endpoints is not None
+        url = request.meta.pop("zyte_smartproxy_endpoint", None)
+        if url is None:
+            return None
+        endpoint = endpoints.get(url)
+        if endpoint is not None:
+            endpoints.release(endpoint)
+        return endpoint
+
+    def _record_endpoint_error(self, endpoint, now):
+        endpoints = self._endpoints
+        assert endpoints is not None
+        if not endpoints.record_error(endpoint, now):
+            return
+        self._inc_stat(
+            "endpoints/down", targets_zyte_api=self._default_targets_zyte_api
+        )
+        logger.warning(
+            "Not using the Zyte proxy service endpoint %s for %d seconds due "
+            "to errors.",
+            endpoint.url,
+            endpoints.down_time,
+            extra={"spider": self.spider},
+        )
+
+    def _admit(self, request, targets_zyte_api, gates=None):
+        """Return ``None`` if *request* can be sent right away, or a Deferred
+        that fires with ``None`` when it can be sent.
+
+        *request* goes through *gates*, ``self._gates`` by default, in order.
+        Gates are methods that take the same parameters as this method,
+        except *gates*, and return the same.
+        """
+        gates = list(self._gates if gates is None else gates)
+        while gates:
+            deferred = gates.pop(0)(request, targets_zyte_api)
+            if deferred is not None:
+                deferred.addCallback(
+                    lambda _: self._admit(request, targets_zyte_api, gates)
+                )
+                return deferred
+        return None
+
+    def _compile_domain_policies(self):
+        """Build the index of ZYTE_SMARTPROXY_DOMAIN_POLICIES, with settings
+        missing from a policy resolved to their global values."""
+        self._default_policy = DomainPolicy(
+            enabled=None,
+            headers=self._headers,
+            **{name: getattr(self, name) for name, _ in _DOMAIN_POLICY_SETTINGS}
+        )
+        self._domain_policies = None
+        self._policies_enable_domains = False
+        if not self.domain_policies:
+            return
+        allowed = {"enabled", "headers"}
+        allowed.update(name for name, _ in _DOMAIN_POLICY_SETTINGS)
+        policies = DomainTrie()
+        for domain, overrides in self.domain_policies.items():
+            unknown = set(overrides) - allowed
+            if unknown:
+                raise ValueError(
+                    "Invalid ZYTE_SMARTPROXY_DOMAIN_POLICIES key(s) {} for "
+                    "domain {!r}, expected any of: {}".format(
+                        ", ".join(sorted(repr(key) for key in unknown)),
+                        domain,
+                        ", ".join(sorted(allowed)),
+                    )
+                )
+            settings = {
+                name: (
+                    type_(overrides[name]) if name in overrides else getattr(self, name)
+                )
+                for name, type_ in _DOMAIN_POLICY_SETTINGS
+            }
+            enabled = overrides.get("enabled")
+            policies[domain] = DomainPolicy(
+                enabled=None if enabled is None else bool(enabled),
+                headers=self._merge_policy_headers(overrides.get("headers") or {}),
+                **settings
+            )
+            if enabled:
+                self._policies_enable_domains = True
+        self._domain_policies = policies
+
+    def _merge_policy_headers(self, headers):
+        """Return the default headers with *headers* applied on top, where a
+        ``None`` value removes a default header."""
+        merged = OrderedDict(
+            (header.lower(), (header, value)) for header, value in self._headers
+        )
+        for header, value in headers.items():
+            if value is None:
+                merged.pop(header.lower(), None)
+            else:
+                merged[header.lower()] = (header, value)
+        return list(merged.values())
+
+    def _get_domain_policy(self, request):
+        policies = self._domain_policies
+        if policies is None:
+            return self._default_policy
+        return policies.get(self._get_request_hostname(request), self._default_policy)
+
+    def _make_rate_limiters(self):
+        limits = {None: self.rate_limit}
+        for target, limit in (self.rate_limit_by_target or {}).items():
+            if target not in _RATE_LIMIT_TARGETS:
+                raise ValueError(
+                    "Invalid ZYTE_SMARTPROXY_RATE_LIMIT_BY_TARGET key {!r}, "
+                    "expected one of: {}".format(
+                        target, ", ".join(sorted(_RATE_LIMIT_TARGETS))
+                    )
+                )
+            limits[_RATE_LIMIT_TARGETS[target]] = float(limit)
+        return {
+            key: TokenBucket(limit, self.rate_limit_burst or max(limit, 1))
+            for key, limit in limits.items()
+            if limit > 0
+        }
+
+    def _wait_for_rate_limit(self, request, targets_zyte_api):
+        now = time()
+        wait = 0.0
+        for key in (None, targets_zyte_api):
+            bucket = self._rate_limiters.get(key)
+            if bucket is not None:
+                wait = max(wait, bucket.take(now))
+        if not wait:
+            return None
+        self._inc_stat("rate_limit/delayed", targets_zyte_api=targets_zyte_api)
+        return self._wait_until(now + wait)
+
+    def _sync_state(self, pull=True):
+        """Write the state learned by this process since the last call to the
+        state backend, and, if *pull* is ``True``, read the state shared by
+        other processes.
+
+        Only done periodically, so that the state backend is not called for
+        every response.
+        """
+        try:
+            self._push_state()
+            if pull:
+                self._sync_shared_deadlines()
+                if self.force_enable_on_http_codes:
+                    self._sync_enabled_domains()
+        except Exception as error:
+            logger.warning(
+                "Could not sync state with %s: %s",
+                self.state_backend,
+                error,
+                extra={"spider": self.spider},
+            )
+
+    def _push_state(self):
+        state = self._state
+        assert state is not None
+        resets, self._pending_resets = self._pending_resets, set()
+        for key in resets:
+            state.delete("bans:" + key)
+        bans, self._pending_bans = self._pending_bans, {}
+        for key, amount in bans.items():
+            # The new count includes the bans of other processes.
+            self._bans[key] = state.incr(
+                "bans:" + key, ttl=self.backoff_max, amount=amount
+            )
+        now = time()
+        delays, self._pending_delays = self._pending_delays, set()
+        for key in delays:
+            deadline = self._shared_deadlines.get(key)
+            if deadline is None or deadline <= now:
+                continue
+            state.set("not_before:" + key, deadline, ttl=deadline - now)
+            state.sadd("delayed_slots", key, ttl=deadline - now)
+        domains, self._pending_domains = self._pending_domains, set()
+        for domain in domains:
+            state.sadd("domains", domain, ttl=self.domains_file_ttl)
+
+    def _sync_shared_deadlines(self):
+        """Delay download slots delayed by other processes, until the end of
+        their delay."""
+        state = self._state
+        assert state is not None
+        slots = self.crawler.engine.downloader.slots
+        now = time()
+        for key in state.smembers("delayed_slots"):
+            slot = slots.get(key)
+            if slot is None:
+                continue
+            deadline = state.get("not_before:" + key)
+            if (
+                deadline is None
+                or deadline <= now
+                or deadline <= self._shared_deadlines.get(key, 0)
+            ):
+                continue
+            self._shared_deadlines[key] = deadline
+            if self._saved_delays.get(key) is None:
+                self._saved_delays[key] = slot.delay
+            slot.delay = deadline - now
+            self._inc_stat(
+                "state/shared_delay", targets_zyte_api=self._default_targets_zyte_api
+            )
+
+    def _sync_enabled_domains(self):
+        """Enable domains enabled by other processes due to
+        ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES."""
+        state = self._state
+        assert state is not None
+        for domain in state.smembers("domains"):
+            self._enable_domain(domain)
+
+    def _wait_until(self, timestamp):
+        if timestamp is None:
+            return None
+        wait = timestamp - time()
+        if wait <= 0:
+            return None
+        from twisted.internet import reactor
+
+        return self._track_wait(deferLater(reactor, wait, lambda: None))
+
+    def _track_wait(self, deferred):
+        self._waits.add(deferred)
+        deferred.addBoth(self._end_wait, deferred)
+        return deferred
+
+    def _end_wait(self, result, deferred):
+        self._waits.discard(deferred)
+        return result
+
+    def _wait_for_circuit(self, request, targets_zyte_api):
+        circuit = self._circuit
+        assert circuit is not None
+        state = circuit.state
+        allowed = circuit.allow(time())
+        if circuit.state != state:
+            self._circuit_changed(circuit.state)
+        if allowed:
+            return None
+        deferred = self._track_wait(Deferred(self._circuit_waiters.remove))
+        self._circuit_waiters.append(deferred)
+        deferred.addCallback(
+            lambda _: self._wait_for_circuit(request, targets_zyte_api)
+        )
+        return deferred
+
+    def _circuit_changed(self, state):
+        self._inc_stat(
+            ("circuit/", state), targets_zyte_api=self._default_targets_zyte_api
+        )
+        if state == CircuitBreaker.OPEN:
+            logger.warning(
+                "Cannot connect to the Zyte proxy service, pausing all proxied "
+                "requests for %d seconds.",
+                self.connection_refused_delay,
+                extra={"spider": self.spider},
+            )
+            self._wake_circuit_waiters_later()
+        elif state == CircuitBreaker.HALF_OPEN:
+            logger.info(
+                "Sending probe requests to the Zyte proxy service.",
+                extra={"spider": self.spider},
+            )
+            # Send new probes if the current ones get no result in time.
+            self._wake_circuit_waiters_later()
+        else:
+            logger.info(
+                "The Zyte proxy service is reachable again, resuming proxied "
+                "requests.",
+                extra={"spider": self.spider},
+            )
+            self._wake_circuit_waiters()
+
+    def _wake_circuit_waiters_later(self):
+        from twisted.internet import reactor
+
+        wake = deferLater(
+            reactor, self.connection_refused_delay, self._wake_circuit_waiters
+        )
+        wake.addErrback(_ignore_cancellation)
+        self._track_wait(wake)
+
+    def _wake_circuit_waiters(self):
+        waiters, self._circuit_waiters = self._circuit_waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def _record_circuit_result(self, success):
+        circuit = self._circuit
+        assert circuit is not None
+        if success:
+            state = circuit.record_success(time())
+        else:
+            state = circuit.record_failure(time())
+        if state is not None:
+            self._circuit_changed(state)
+
+    def _start_latency_timer(self, request, targets_zyte_api):
+        request.meta["zyte_smartproxy_start_time"] = time()
+        return None
+
+    def _record_latency(self, request, status_class, targets_zyte_api):
+        """Record the time since *request* went through
+        :meth:`_start_latency_timer`.
+
+        *status_class* is the response status divided by 100, or ``None`` for
+        exceptions.
+        """
+        start = request.meta.pop("zyte_smartproxy_start_time", None)
+        if start is None:
+            return
+        latency = time() - start
+        key = (targets_zyte_api, status_class)
+        histogram = self._latency.get(key)
+        if histogram is None:
+            histogram = self._latency[key] = LatencyHistogram()
+        histogram.record(latency)
+        if self.latency_per_slot:
+            histograms = self._slot_latency[self._get_slot_key(request)]
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = LatencyHistogram()
+            histogram.record(latency)
+
+    def _export_latency(self):
+        """Set latency percentile stats from the latency histograms of proxy
+        services."""
+        self._set_latency_stats("latency/", self._latency)
+
+    def _export_slot_latency(self):
+        """Set latency percentile stats from the latency histograms of
+        download slots.
+
+        Only done when the spider closes, to keep the number of stats writes
+        and stats bounded.
+        """
+        for slot, histograms in self._slot_latency.items():
+            self._set_latency_stats("latency/slot/{}/".format(slot), histograms)
+
+    def _set_latency_stats(self, prefix, histograms):
+        for (targets_zyte_api, status_class), histogram in histograms.items():
+            name = "{}/{}{}/".format(
+                "zyte_api_proxy" if targets_zyte_api else "zyte_smartproxy",
+                prefix,
+                "exception" if status_class is None else "{}xx".format(status_class),
+            )
+            self.crawler.stats.set_value(name + "count", histogram.count)
+            for percentile in LATENCY_PERCENTILES:
+                self.crawler.stats.set_value(
+                    "{}p{}".format(name, percentile),
+                    round(histogram.percentile(percentile), 3),
+                )
+
+    def _assign_session(self, request, targets_zyte_api):
+        if (
+            "zyte_smartproxy_session" not in request.meta
+            and b"X-Crawlera-Session" in request.headers
+        ):
+            # Session set by the user.
+            return None
+        domain = self._get_request_domain(request)
+        pool = self._session_pools.get(domain)
+        if pool is None:
+            pool = self._session_pools[domain] = SessionPool(
+                self.session_pool_size,
+                create_timeout=self._get_domain_policy(request).download_timeout,
+            )
+        now = time()
+        expired = pool.expire(now)
+        if expired:
+            self._inc_stat(
+                "sessions/create_timeout",
+                targets_zyte_api=targets_zyte_api,
+                value=expired,
+            )
+        session = pool.acquire(request, now)
+        if session is None:
+            self._inc_stat("sessions/wait", targets_zyte_api=targets_zyte_api)
+            self._wait_for_session(request, pool, now)
+            raise self._drop_rescheduled(
+                request, "Request {} scheduled to wait for a session"
+            )
+        request.headers["X-Crawlera-Session"] = session
+        request.meta["zyte_smartproxy_session"] = session
+        return None
+
+    def _wait_for_session(self, request, pool, now):
+        """Schedule a copy of *request* to be crawled on the next change in
+        *pool*, or once the oldest session being created in *pool* expires.
+
+        The copy is kept out of the downloader while it waits, so that it
+        does not take any of the CONCURRENT_REQUESTS slots.
+        """
+        retryreq = request.copy()
+        retryreq.dont_filter = True
+        wait = pool.wait()
+        timeout = pool.expires_in(now)
+        if timeout is not None:
+            from twisted.internet import reactor
+
+            wait.addTimeout(
+                timeout, reactor, onTimeoutCancel=lambda result, timeout: None
+            )
+        wait.addCallback(lambda _: self._crawl(retryreq))
+        wait.addErrback(_ignore_cancellation)
+        self._session_waits.add(wait)
+        wait.addBoth(self._end_session_wait, wait)
+        self._track_wait(wait)
+
+    def _end_session_wait(self, result, deferred):
+        self._session_waits.discard(deferred)
+        return result
+
+    def _update_session(self, request, response, error, targets_zyte_api):
+        """Give back the session of *request* to its pool, adding it to the
+        pool if *response* created it, or retiring it if *response* shows
+        that it is no longer usable.
+
+        *response* is ``None`` if the request failed with an exception.
+        """
+        session = request.meta.get("zyte_smartproxy_session")
+        if session is None:
+            return
+        pool = self._session_pools.get(self._get_request_domain(request))
+        if pool is None:
+            return
+        banned = response is not None and self._is_banned(response)
+        if session == CREATE:
+            if response is not None:
+                session = response.headers.get("X-Crawlera-Session")
+            if session == CREATE or not session or banned:
+                pool.creation_failed(request)
+                self._inc_stat(
+                    "sessions/create_failed", targets_zyte_api=targets_zyte_api
+                )
+            elif pool.add(request, session):
+                self._inc_stat("sessions/created", targets_zyte_api=targets_zyte_api)
+            else:
+                self._inc_stat("sessions/discarded", targets_zyte_api=targets_zyte_api)
+            return
+        pool.release(session)
+        if banned:
+            reason = "banned"
+        elif error == b"bad_session_id":
+            reason = "bad_session_id"
+        else:
+            return
+        if pool.retire(session):
+            self._inc_stat(
+                ("sessions/retired/", reason), targets_zyte_api=targets_zyte_api
+            )
+
+    def _evict_session_pool(self, key, pool):
+        pool.wake_all()
+
     def _is_banned(self, response):
         return (
             response.status == self.ban_code
@@ -337,36 +1325,88 @@ class ZyteSmartProxyMiddleware(object):
     def process_response(self, request, response, spider):
         zyte_smartproxy_error = self._process_error(response)
 
+        if self._endpoints is not None:
+            endpoint = self._release_endpoint(request)
+            if (
+                endpoint is not None
+                and response.status >= 500
+                and not self._is_zyte_smartproxy_or_zapi_response(response)
+            ):
+                # 5xx responses from in front of the proxy service, e.g. from
+                # a load balancer.
+                self._record_endpoint_error(endpoint, time())
+
         targets_zyte_api = self._targets_zyte_api(request)
 
+        if self.latency_histograms_enabled:
+            self._record_latency(request, response.status // 100, targets_zyte_api)
+
         if not self._is_enabled_for_request(request):
             return self._handle_not_enabled_response(
                 request, response, targets_zyte_api=targets_zyte_api
             )
 
+        if self.session_pool_size:
+            self._update_session(
+                request, response, zyte_smartproxy_error, targets_zyte_api
+            )
+
         if not self._is_zyte_smartproxy_or_zapi_response(response):
+            if (
+                self._circuit is not None
+                and self._circuit.state == CircuitBreaker.HALF_OPEN
+            ):
+                # A probe answered by something else than the proxy service,
+                # e.g. a load balancer in front of it.
+                self._record_circuit_result(success=False)
             return response
 
+        if self._circuit is not None:
+            self._record_circuit_result(success=True)
+
         key = self._get_slot_key(request)
-        self._restore_original_delay(request)
+        policy = self._get_domain_policy(request)
+        quarantined = self._in_quarantine(key)
+        if not quarantined:
+            # Quarantined slots keep their delay until the quarantine ends.
+            self._restore_original_delay(request)
 
         is_auth_error = self._is_auth_error(response)
         throttle_error = self._throttle_error(response)
+        throttle_retry = None
         if is_auth_error or throttle_error:
             if is_auth_error:
                 reason = "autherror"
             else:
                 assert throttle_error
                 reason = throttle_error.lstrip("/")
-            self._set_custom_delay(
+            delay = self._get_delay(response, key, targets_zyte_api, policy)
+            if throttle_error and self.throttle_retry_enabled:
+                throttle_retry = self._retry_throttled(
+                    request, delay, targets_zyte_api=targets_zyte_api
+                )
+            if throttle_retry is None:
+                self._set_custom_delay(
+                    request,
+                    delay,
+                    reason=reason,
+                    targets_zyte_api=targets_zyte_api,
+                )
+        else:
+            self._inc_stat("delay/reset_backoff", targets_zyte_api=targets_zyte_api)
+            self._backoffs.pop(key, None)
+
+        if self.aimd_enabled:
+            self._adjust_concurrency(
                 request,
-                next(self.exp_backoff),
-                reason=reason,
+                throttled=bool(throttle_error),
                 targets_zyte_api=targets_zyte_api,
             )
-        else:
-            self._inc_stat("delay/reset_backoff", targets_zyte_api=targets_zyte_api)
-            self.exp_backoff = exp_backoff(self.backoff_step, self.backoff_max)
+
+        if throttle_retry is not None:
+            raise self._drop_rescheduled(
+                request, "Throttled request {} scheduled for retry"
+            )
 
         if is_auth_error:
             # When Zyte Smart Proxy Manager has issues it might not be able to
@@ -386,44 +1426,88 @@ class ZyteSmartProxyMiddleware(object):
                     extra={"spider": self.spider},
                 )
 
-        if self._is_banned(response):
-            self._bans[key] += 1
-            if self._bans[key] > self.maxbans:
-                self.crawler.engine.close_spider(spider, "banned")
+        is_banned = self._is_banned(response)
+        if self.ban_window:
+            self._ban_windows[key].record(is_banned, time())
+        if is_banned:
+            if self._exceeds_ban_limit(key, self._count_ban(key), policy):
+                if self.quarantine_enabled:
+                    self._quarantine(request, key, targets_zyte_api)
+                else:
+                    self.crawler.engine.close_spider(spider, "banned")
             else:
-                after = response.headers.get("retry-after")
-                if after:
+                delay = self._get_delay(
+                    response, key, targets_zyte_api, policy, backoff=False
+                )
+                if delay is not None:
                     self._set_custom_delay(
                         request,
-                        float(after),
+                        delay,
                         reason="banned",
                         targets_zyte_api=targets_zyte_api,
                     )
             self._inc_stat("response/banned", targets_zyte_api=targets_zyte_api)
         else:
-            self._bans[key] = 0
+            if (
+                self._bans.pop(key, None) is not None
+                and self._state is not None
+                and key is not None
+            ):
+                self._pending_bans.pop(key, None)
+                self._pending_resets.add(key)
+            if key in self._quarantines:
+                if self.ban_window:
+                    release = self._ban_windows[key].ratio < self.ban_ratio / 2
+                else:
+                    # Responses to requests sent before the quarantine do not
+                    # end it.
+                    release = not quarantined
+                if release:
+                    del self._quarantines[key]
+                    self._restore_original_delay(request)
+                    self._inc_stat(
+                        "quarantine/released", targets_zyte_api=targets_zyte_api
+                    )
         # If placed behind `RedirectMiddleware`,
         # it would not count 3xx responses
         self._inc_stat("response", targets_zyte_api=targets_zyte_api)
         self._inc_stat(
-            "response/status/{}".format(response.status),
+            ("response/status/", response.status),
             targets_zyte_api=targets_zyte_api,
         )
         if zyte_smartproxy_error:
             self._inc_stat("response/error", targets_zyte_api=targets_zyte_api)
-            error_msg = zyte_smartproxy_error.decode("utf8")
             self._inc_stat(
-                "response/error/{}".format(error_msg),
+                ("response/error/", zyte_smartproxy_error.decode("utf8")),
                 targets_zyte_api=targets_zyte_api,
             )
         return response
 
     def process_exception(self, request, exception, spider):
+        if self.latency_histograms_enabled:
+            self._record_latency(request, None, self._targets_zyte_api(request))
         if not self._is_enabled_for_request(request):
             return
+        if self.session_pool_size:
+            self._update_session(request, None, None, self._targets_zyte_api(request))
+        endpoints = self._endpoints
+        endpoint = None
+        if endpoints is not None:
+            endpoint = self._release_endpoint(request)
         if isinstance(exception, (ConnectionRefusedError, ConnectionDone)):
             # Handle Zyte Smart Proxy Manager downtime
-            self._clear_dns_cache()
+            if endpoints is not None and endpoint is not None:
+                now = time()
+                self._clear_dns_cache(endpoint.url)
+                self._record_endpoint_error(endpoint, now)
+                if not endpoints.all_down(now):
+                    # Other endpoints can take over.
+                    return
+            else:
+                self._clear_dns_cache()
+            if self._circuit is not None:
+                self._record_circuit_result(success=False)
+                return
             targets_zyte_api = self._targets_zyte_api(request)
             self._set_custom_delay(
                 request,
@@ -431,11 +1515,128 @@ class ZyteSmartProxyMiddleware(object):
                 reason="conn_refused",
                 targets_zyte_api=targets_zyte_api,
             )
+        elif (
+            self._circuit is not None
+            and self._circuit.state == CircuitBreaker.HALF_OPEN
+            and not isinstance(exception, IgnoreRequest)
+        ):
+            # Any failure of a probe request reopens the circuit, but not
+            # requests dropped before being sent.
+            self._record_circuit_result(success=False)
+
+    def _count_ban(self, key):
+        """Count a ban of the *key* download slot, and return its number of
+        consecutive bans.
+
+        If there is a state backend, the number includes the bans of other
+        processes as of the last call to :meth:`_sync_state`.
+        """
+        self._bans[key] += 1
+        # Responses that skipped the downloader, e.g. cached ones, have no
+        # download slot.
+        if self._state is not None and key is not None:
+            self._pending_bans[key] = self._pending_bans.get(key, 0) + 1
+        return self._bans[key]
+
+    def _exceeds_ban_limit(self, key, bans, policy):
+        if self.ban_window:
+            window = self._ban_windows[key]
+            return window.full and window.ratio >= self.ban_ratio
+        return bans > policy.maxbans
+
+    def _in_quarantine(self, key):
+        quarantine = self._quarantines.get(key)
+        return quarantine is not None and time() < quarantine[1]
+
+    def _quarantine(self, request, key, targets_zyte_api):
+        """Delay the download slot of *request* for a cooling period that
+        doubles with every consecutive quarantine of the slot, and close the
+        spider if too many slots are in quarantine."""
+        now = time()
+        quarantine = self._quarantines.get(key)
+        if quarantine is not None and now < quarantine[1]:
+            # Response to a request sent before the quarantine started.
+            self._set_custom_delay(
+                request, quarantine[1] - now, targets_zyte_api=targets_zyte_api
+            )
+            return
+        level = 0 if quarantine is None else quarantine[0] + 1
+        delay = min(self.quarantine_time * 2**level, self.quarantine_max_time)
+        self._quarantines[key] = [level, now + delay]
+        self._set_custom_delay(
+            request, delay, reason="quarantine", targets_zyte_api=targets_zyte_api
+        )
+        if level == 0:
+            self._inc_stat("quarantine/slots", targets_zyte_api=targets_zyte_api)
+        logger.warning(
+            "Download slot %s is banned, pausing it for %d seconds.",
+            key,
+            delay,
+            extra={"spider": self.spider},
+        )
+        slots = self.crawler.engine.downloader.slots
+        quarantined = sum(1 for slot_key in self._quarantines if slot_key in slots)
+        if quarantined and quarantined >= self.quarantine_close_ratio * len(slots):
+            self.crawler.engine.close_spider(self.spider, "banned")
+
+    def _load_domains(self):
+        try:
+            domains = load_domains(
+                self.domains_file, ttl=self.domains_file_ttl, now=time()
+            )
+        except _DOMAINS_FILE_ERRORS as error:
+            logger.warning(
+                "Could not load domains from %s: %s",
+                self.domains_file,
+                error,
+                extra={"spider": self.spider},
+            )
+            return
+        learned_domains = self._learned_domains
+        assert learned_domains is not None
+        # Oldest first, so that they are the first ones evicted.
+        for domain, learned in sorted(domains.items(), key=lambda item: item[1]):
+            learned_domains[domain] = learned
+            self._enable_domain(domain)
+        self._inc_stat(
+            "domains_file/loaded",
+            targets_zyte_api=self._default_targets_zyte_api,
+            value=len(domains),
+        )
+
+    def _save_domains(self):
+        learned_domains = self._learned_domains
+        assert learned_domains is not None
+        # Keep the domains saved by other processes since this one started.
+        try:
+            domains = load_domains(
+                self.domains_file, ttl=self.domains_file_ttl, now=time()
+            )
+        except _DOMAINS_FILE_ERRORS:
+            domains = {}
+        domains.update(learned_domains.items())
+        try:
+            save_domains(
+                self.domains_file,
+                domains,
+                maxsize=self.domains_file_maxsize,
+            )
+        except (IOError, OSError) as error:
+            logger.warning(
+                "Could not save domains to %s: %s",
+                self.domains_file,
+                error,
+                extra={"spider": self.spider},
+            )
 
     def _handle_not_enabled_response(self, request, response, targets_zyte_api):
         if self._should_enable_for_response(response):
-            domain = self._get_url_domain(request.url)
-            self.enabled_for_domain[domain] = True
+            domain = self._get_request_hostname(request)
+            self._enable_domain(domain)
+            if self._learned_domains is not None:
+                self._learned_domains[domain] = time()
+            if self._state is not None:
+                self._pending_domains.add(domain)
 
             retryreq = request.copy()
             retryreq.dont_filter = True
@@ -446,6 +1647,51 @@ class ZyteSmartProxyMiddleware(object):
             return retryreq
         return response
 
+    def _retry_throttled(self, request, delay, targets_zyte_api):
+        """Schedule a copy of *request* to be crawled after *delay* seconds
+        and return it, or return ``None`` if *request* has been retried too
+        many times already.
+
+        The copy is kept out of the downloader while it waits, so that it
+        does not take any of the CONCURRENT_REQUESTS slots.
+        """
+        retries = request.meta.get("zyte_smartproxy_throttle_retry_times", 0)
+        if retries >= self.max_throttle_retry_times:
+            self._inc_stat(
+                "retries/throttle/max_reached", targets_zyte_api=targets_zyte_api
+            )
+            return None
+        retryreq = request.copy()
+        retryreq.meta["zyte_smartproxy_throttle_retry_times"] = retries + 1
+        retryreq.dont_filter = True
+        from twisted.internet import reactor
+
+        def crawl():
+            self._throttle_retries.discard(call)
+            self._crawl(retryreq)
+
+        call = reactor.callLater(delay, crawl)
+        self._throttle_retries.add(call)
+        self._inc_stat("retries/throttle", targets_zyte_api=targets_zyte_api)
+        return retryreq
+
+    def _drop_rescheduled(self, request, message):
+        """Return an IgnoreRequest exception that drops *request*, a copy of
+        which has been scheduled to be crawled later.
+
+        Scrapy calls the errback of requests dropped with IgnoreRequest, so the
+        errback is removed from *request*: the copy keeps it, and only its
+        outcome is reported.
+        """
+        request.errback = None
+        return IgnoreRequest(message.format(request))
+
+    def _crawl(self, request):
+        if version_info < (2, 6):
+            self.crawler.engine.crawl(request, self.spider)
+        else:
+            self.crawler.engine.crawl(request)
+
     def _retry_auth(self, response, request, spider, targets_zyte_api):
         logger.warning(
             (
@@ -461,23 +1707,48 @@ class ZyteSmartProxyMiddleware(object):
         self._inc_stat("retries/auth", targets_zyte_api=targets_zyte_api)
         return retryreq
 
-    def _clear_dns_cache(self):
+    def _clear_dns_cache(self, url=None):
         # Scrapy doesn't expire dns records by default, so we force it here,
         # so client can reconnect trough DNS failover.
-        dnscache.pop(urlparse(self.url).hostname, None)
+        dnscache.pop(urlparse(self.url if url is None else url).hostname, None)
 
     def _should_enable_for_response(self, response):
         return response.status in self.force_enable_on_http_codes
 
     def _is_enabled_for_request(self, request):
-        domain = self._get_url_domain(request.url)
-        domain_enabled = self.enabled_for_domain.get(domain, False)
-        dont_proxy = request.meta.get("dont_proxy", False)
-        return (domain_enabled or self.enabled) and not dont_proxy
+        if request.meta.get("dont_proxy", False):
+            return False
+        if self._domain_policies is not None:
+            enabled = self._get_domain_policy(request).enabled
+            if enabled is not None:
+                return enabled
+        if self.enabled:
+            return True
+        # Skip URL parsing while no domain has been enabled.
+        if not self.enabled_for_domain:
+            return False
+        host = self._get_request_hostname(request)
+        found = self._enabled_domain_index.match(host)
+        if found is not None:
+            # Look up the matching domain in enabled_for_domain, to keep it
+            # from expiring while in use.
+            return self.enabled_for_domain.get(found[0], False)
+        # Domains set directly in enabled_for_domain are not indexed.
+        return self.enabled_for_domain.get(host, False)
+
+    def _enable_domain(self, domain):
+        """Enable *domain* and its subdomains."""
+        self.enabled_for_domain[domain] = True
+        self._enabled_domain_index[domain] = True
+
+    def _unindex_domain(self, domain, value):
+        self._enabled_domain_index.discard(domain)
+
+    def _get_request_domain(self, request):
+        return urlparse_cached(request).netloc
 
-    def _get_url_domain(self, url):
-        parsed = urlparse(url)
-        return parsed.netloc
+    def _get_request_hostname(self, request):
+        return urlparse_cached(request).hostname or ""
 
     def _is_zyte_smartproxy_or_zapi_response(self, response):
         """Check if is Smart Proxy Manager or Zyte API proxy mode response"""
@@ -493,18 +1764,133 @@ class ZyteSmartProxyMiddleware(object):
         key = self._get_slot_key(request)
         return key, self.crawler.engine.downloader.slots.get(key)
 
+    def _get_delay(self, response, key, targets_zyte_api, policy, backoff=True):
+        """Return the delay to set on the download slot of *response*.
+
+        A valid ``Retry-After`` header wins, capped at the ``backoff_max`` of
+        *policy*.
+        Otherwise, the next backoff value of the slot is used if *backoff* is
+        ``True``, else ``None`` is returned.
+        """
+        delay = parse_retry_after(response.headers.get("Retry-After"))
+        if delay is not None:
+            if delay > policy.backoff_max:
+                delay = policy.backoff_max
+                source = "retry_after_capped"
+            else:
+                source = "retry_after"
+        elif backoff:
+            delay = self._next_backoff(key, policy)
+            source = "backoff"
+        else:
+            return None
+        self._inc_stat(("delay/source/", source), targets_zyte_api=targets_zyte_api)
+        return delay
+
+    @property
+    def exp_backoff(self):
+        """Deprecated, backoff is tracked per download slot.
+
+        Exponential backoff generator of responses without a download slot.
+        """
+        warnings.warn(
+            "ZyteSmartProxyMiddleware.exp_backoff is deprecated, backoff is "
+            "now tracked per download slot.",
+            category=ScrapyDeprecationWarning,
+            stacklevel=2,
+        )
+        cached = self._backoffs.get(None)
+        if cached is None:
+            cached = self._backoffs[None] = (
+                (self.backoff_step, self.backoff_max),
+                exp_backoff(self.backoff_step, self.backoff_max),
+            )
+        return cached[1]
+
+    @exp_backoff.setter
+    def exp_backoff(self, value):
+        warnings.warn(
+            "ZyteSmartProxyMiddleware.exp_backoff is deprecated, backoff is "
+            "now tracked per download slot.",
+            category=ScrapyDeprecationWarning,
+            stacklevel=2,
+        )
+        # Custom generators are used whatever the backoff parameters.
+        self._backoffs[None] = (None, value)
+
+    def _next_backoff(self, key, policy=None):
+        """Return the next backoff delay for the specified slot.
+
+        The backoff sequence of the slot starts over if the backoff step or
+        maximum of *policy* differ from those the sequence was started with.
+        """
+        if policy is None:
+            params = (self.backoff_step, self.backoff_max)
+        else:
+            params = (policy.backoff_step, policy.backoff_max)
+        cached = self._backoffs.get(key)
+        if cached is None or cached[0] not in (None, params):
+            cached = self._backoffs[key] = (params, exp_backoff(*params))
+        return next(cached[1])
+
+    def _adjust_concurrency(self, request, throttled, targets_zyte_api):
+        """Adjust the concurrency of the request slot with additive-increase,
+        multiplicative-decrease (AIMD)."""
+        key, slot = self._get_slot(request)
+        if not slot:
+            return
+        state = self._aimd_state.get(key)
+        if state is None:
+            state = self._aimd_state[key] = [0.0, 0.0]
+        latency = request.meta.get("download_latency")
+        congested = throttled or (
+            self.aimd_target_latency > 0
+            and latency is not None
+            and latency > self.aimd_target_latency
+        )
+        if congested:
+            now = time()
+            if latency is not None and now - latency < state[1]:
+                # The request was sent before the last decrease, so the
+                # congestion it reports has already been accounted for.
+                return
+            state[0], state[1] = 0.0, now
+            concurrency = max(
+                self.aimd_min_concurrency,
+                int(slot.concurrency * self.aimd_decrease_factor),
+            )
+            if concurrency < slot.concurrency:
+                slot.concurrency = concurrency
+                self._inc_stat("aimd/decrease", targets_zyte_api=targets_zyte_api)
+        elif slot.concurrency < self.aimd_max_concurrency:
+            # Increase concurrency by 1 once every request of a full
+            # concurrency window has succeeded.
+            state[0] += 1.0 / slot.concurrency
+            if state[0] >= 1:
+                state[0] -= 1
+                slot.concurrency += 1
+                self._inc_stat("aimd/increase", targets_zyte_api=targets_zyte_api)
+
     def _set_custom_delay(self, request, delay, targets_zyte_api, reason=None):
         """Set custom delay for slot and save original one."""
         key, slot = self._get_slot(request)
         if not slot:
             return
-        if self._saved_delays[key] is None:
+        quarantine = self._quarantines.get(key)
+        if quarantine is not None:
+            # Do not shorten quarantines, e.g. due to a throttling response to
+            # a request sent before the quarantine.
+            delay = max(delay, quarantine[1] - time())
+        if self._saved_delays.get(key) is None:
             self._saved_delays[key] = slot.delay
         slot.delay = delay
+        if self._state is not None and delay > 0:
+            self._shared_deadlines[key] = time() + delay
+            self._pending_delays.add(key)
         if reason is not None:
-            self._inc_stat("delay/{}".format(reason), targets_zyte_api=targets_zyte_api)
+            self._inc_stat(("delay/", reason), targets_zyte_api=targets_zyte_api)
             self._inc_stat(
-                "delay/{}/total".format(reason),
+                ("delay/", reason, "/total"),
                 value=delay,
                 targets_zyte_api=targets_zyte_api,
             )
@@ -514,95 +1900,169 @@ class ZyteSmartProxyMiddleware(object):
         key, slot = self._get_slot(request)
         if not slot:
             return
-        if self._saved_delays[key] is not None:
-            slot.delay, self._saved_delays[key] = self._saved_delays[key], None
+        delay = self._saved_delays.pop(key, None)
+        if delay is not None:
+            slot.delay = delay
+
+    def _restore_evicted_delay(self, key, delay):
+        """Restore the original delay of a slot whose saved delay has been
+        evicted, so that its custom delay does not stay forever."""
+        engine = getattr(self.crawler, "engine", None)
+        if engine is None or delay is None:
+            return
+        slot = engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.delay = delay
+
+    def _compile_header_plans(self):
+        """Build the header rewrite plan of each target.
+
+        Keys are None for requests not handled by this downloader middleware,
+        and otherwise the value of targets_zyte_api. Values are (lowercase
+        prefixes of headers to process, lowercase header translations,
+        lowercase headers to keep) tuples.
+        """
+        self._header_plans = {
+            None: (tuple(self.header_lowercase_prefixes), {}, frozenset()),
+            False: ((b"zyte-",), dict(self.zyte_api_to_spm_translations), frozenset()),
+            True: ((b"x-crawlera-",), {}, frozenset(self.spm_bc_headers)),
+        }
+
+    def _compile_static_headers(self):
+        """Build the headers that are set on every proxied request.
+
+        Keys are values of targets_zyte_api, values are lists of (header,
+        value) tuples.
+        """
+        from scrapy_zyte_smartproxy import __version__
+
+        client = ("scrapy-zyte-smartproxy/%s" % __version__).encode("utf-8")
+        self._static_headers = {}
+        for targets_zyte_api, job_header, client_header in (
+            (False, b"X-Crawlera-JobId", b"X-Crawlera-Client"),
+            (True, b"Zyte-JobId", b"Zyte-Client"),
+        ):
+            headers = []
+            if self.job_id:
+                headers.append((job_header, self.job_id.encode("utf-8")))
+            headers.append((client_header, client))
+            self._static_headers[targets_zyte_api] = headers
 
     def _clean_zyte_smartproxy_headers(self, request, targets_zyte_api=None):
-        """Remove X-Crawlera-* headers from the request."""
-        if targets_zyte_api is None:
-            prefixes = self.header_lowercase_prefixes
-        elif targets_zyte_api:
-            prefixes = (b"x-crawlera-",)
-        else:
-            prefixes = (b"zyte-",)
-        targets = [
-            header for header in request.headers if self._drop_header(header, prefixes)
-        ]
-        for header in targets:
-            values = request.headers.pop(header, None)
-            value = b"".join(values)
-            if targets_zyte_api is not None:
-                actual_target, header_target = (
-                    ("Zyte API", "Zyte Smart Proxy Manager")
-                    if targets_zyte_api
-                    else ("Zyte Smart Proxy Manager", "Zyte API")
-                )
-                logger.warning(
-                    (
-                        "Dropping header %r (%r) from request %r, as this "
-                        "request is proxied with %s and not with %s, and "
-                        "automatic translation is not supported for this "
-                        "header. See "
-                        "https://docs.zyte.com/zyte-api/migration/zyte/"
-                        "smartproxy.html#parameter-mapping"
-                        " to learn the right way to translate this header "
-                        "manually."
-                    ),
-                    header,
+        """Translate or remove headers meant for a different target, or, if
+        targets_zyte_api is None, remove all Zyte proxy headers."""
+        prefixes, translations, keep = self._header_plans[targets_zyte_api]
+        matches = None
+        for header in request.headers:
+            if header and header.lower().startswith(prefixes):
+                if matches is None:
+                    matches = []
+                matches.append(header)
+        if matches is None:
+            return
+        for header in matches:
+            header_lowercase = header.lower()
+            translation = translations.get(header_lowercase)
+            if translation is not None:
+                value = b"".join(request.headers.pop(header))
+                request.headers[translation] = value
+                self._warn_header(
+                    "translated",
+                    header_lowercase,
+                    targets_zyte_api,
+                    "Translating header %r (%r) to %r on request %r",
+                    header_lowercase,
                     value,
+                    translation,
                     request,
-                    actual_target,
-                    header_target,
                 )
-            else:
-                logger.warning(
-                    (
-                        "Dropping header {header!r} ({value!r}) from request "
-                        "{request!r}, as this request is not handled by "
-                        "scrapy-zyte-smartproxy. If you are sure that you need "
-                        "to send this header in a request not handled by "
-                        "scrapy-zyte-smartproxy, use the "
-                        "ZYTE_SMARTPROXY_KEEP_HEADERS setting."
-                    ).format(
-                        header=header,
-                        value=value,
-                        request=request,
-                    )
+            elif header_lowercase in keep:
+                self._warn_header(
+                    "kept",
+                    header,
+                    targets_zyte_api,
+                    "Keeping deprecated header %r.",
+                    header,
                 )
+            else:
+                self._drop_header(request, header, targets_zyte_api)
 
-    def _drop_header(self, header_name, prefixes):
-        if not header_name:
-            return False
-        header_name_lowercase = header_name.lower()
-        has_drop_prefix = any(
-            header_name_lowercase.startswith(prefix) for prefix in prefixes
-        )
-        if (
-            has_drop_prefix
-            # When dropping all prefixes, always drop matching headers, i.e.
-            # ignore self.spm_bc_headers.
-            and len(prefixes) <= 1
-            and header_name_lowercase in self.spm_bc_headers
-        ):
-            logger.warning(
-                "Keeping deprecated header {header_name!r}.".format(
-                    header_name=header_name
-                )
+    def _drop_header(self, request, header, targets_zyte_api):
+        value = b"".join(request.headers.pop(header))
+        if targets_zyte_api is not None:
+            actual_target, header_target = (
+                ("Zyte API", "Zyte Smart Proxy Manager")
+                if targets_zyte_api
+                else ("Zyte Smart Proxy Manager", "Zyte API")
+            )
+            self._warn_header(
+                "dropped",
+                header,
+                targets_zyte_api,
+                (
+                    "Dropping header %r (%r) from request %r, as this "
+                    "request is proxied with %s and not with %s, and "
+                    "automatic translation is not supported for this "
+                    "header. See "
+                    "https://docs.zyte.com/zyte-api/migration/zyte/"
+                    "smartproxy.html#parameter-mapping"
+                    " to learn the right way to translate this header "
+                    "manually."
+                ),
+                header,
+                value,
+                request,
+                actual_target,
+                header_target,
+            )
+        else:
+            self._warn_header(
+                "dropped",
+                header,
+                targets_zyte_api,
+                (
+                    "Dropping header %r (%r) from request %r, as this "
+                    "request is not handled by scrapy-zyte-smartproxy. If you "
+                    "are sure that you need to send this header in a request "
+                    "not handled by scrapy-zyte-smartproxy, use the "
+                    "ZYTE_SMARTPROXY_KEEP_HEADERS setting."
+                ),
+                header,
+                value,
+                request,
             )
-            return False
-        return has_drop_prefix
 
-    def _set_zyte_smartproxy_default_headers(self, request):
-        for header, value in self._headers:
-            if value is None:
-                continue
+    def _warn_header(self, action, header, targets_zyte_api, msg, *args):
+        """Count a header translation, keeping or dropping in stats, and log
+        *msg* the first time that it happens."""
+        if targets_zyte_api is None:
+            stat_target = self._default_targets_zyte_api
+        else:
+            stat_target = targets_zyte_api
+        header_name = header.decode("latin-1").lower()
+        self._inc_stat(("headers/", action, "/", header_name), stat_target)
+        self._header_warnings.warn(
+            (header_name, action, targets_zyte_api),
+            (
+                "Header %r %s %s",
+                (header, action, _TARGET_DESCRIPTIONS[targets_zyte_api]),
+            ),
+            msg,
+            *args
+        )
+
+    def _set_zyte_smartproxy_default_headers(
+        self, request, targets_zyte_api=False, headers=None
+    ):
+        for header, value in self._headers if headers is None else headers:
             request.headers.setdefault(header, value)
-        lower_case_headers = [
-            header.decode("utf-8").lower() for header in request.headers
-        ]
-        if all(h.lower() in lower_case_headers for h in self.conflicting_headers):
+        if not all(header in request.headers for header in self.conflicting_headers):
+            return
+        self._inc_stat("headers/conflicting", targets_zyte_api=targets_zyte_api)
+        if not self._conflicting_headers_reported:
             # Send a general warning once,
             # and specific urls if LOG_LEVEL = DEBUG
+            self._conflicting_headers_reported = True
             warnings.warn(
                 "The headers %s are conflicting on some of your requests. "
                 "Please check "
@@ -611,6 +2071,7 @@ class ZyteSmartProxyMiddleware(object):
                 "for more information. You can set LOG_LEVEL=DEBUG to see the "
                 "urls with problems." % str(self.conflicting_headers)
             )
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(
                 "The headers %s are conflicting on request %s. X-Crawlera-UA "
                 "will be ignored. Please check "
@@ -0,0 +1,138 @@
+from collections import OrderedDict, deque
+
+from twisted.internet.defer import Deferred
+
+# Value of the X-Crawlera-Session request header that asks for a new session.
+CREATE = b"create"
+
+
+class SessionPool(object):
+    """Pool of up to *size* proxy sessions.
+
+    :meth:`acquire` returns the session to use for a request: the ID of the
+    ready session with the fewest requests in progress, taking turns among
+    equally loaded sessions, or :data:`CREATE` while the pool, counting
+    sessions being created, is not full. If the pool is full but no session
+    is ready yet, it returns ``None``, and :meth:`wait` can be used to wait
+    for a change in the pool.
+
+    Every session returned by :meth:`acquire` must be given back exactly once:
+    with :meth:`add` or :meth:`creation_failed` for :data:`CREATE`, and with
+    :meth:`release` for session IDs.
+
+    If *create_timeout* is set, sessions being created for longer than that
+    many seconds are dropped by :meth:`expire`, so that a creation that is
+    never given back does not hold its place in the pool forever.
+    """
+
+    def __init__(self, size, create_timeout=None):
+        self.size = size
+        self.create_timeout = create_timeout
+        # Keys are session IDs, values are the number of requests in progress.
+        self.sessions = OrderedDict()  # type: OrderedDict
+        # Keys are the keys passed to acquire for sessions being created,
+        # values are the times when their creation started.
+        self.creating = OrderedDict()  # type: OrderedDict
+        self._cursor = 0
+        self._waiters = deque()  # type: deque
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def acquire(self, key, now=0.0):
+        """Return the session to use for *key*, e.g. a request, at time *now*.
+
+        If :data:`CREATE` is returned, *key* must be passed to :meth:`add` or
+        :meth:`creation_failed` afterwards.
+        """
+        if len(self.sessions) + len(self.creating) < self.size:
+            self.creating[key] = now
+            return CREATE
+        if not self.sessions:
+            return None
+        sessions = list(self.sessions.items())
+        count = len(sessions)
+        start = self._cursor % count
+        best = None
+        for offset in range(count):
+            session, load = sessions[(start + offset) % count]
+            if best is None or load < best[1]:
+                best = (session, load)
+        self._cursor = start + 1
+        session = best[0]
+        self.sessions[session] += 1
+        return session
+
+    def release(self, session):
+        if session in self.sessions:
+            self.sessions[session] -= 1
+
+    def add(self, key, session):
+        """Give back the :data:`CREATE` of *key* after it resulted in
+        *session*, and add *session* to the pool. Return ``False`` if
+        *session* could not be added because the pool is full, else
+        ``True``."""
+        self.creating.pop(key, None)
+        if len(self.sessions) >= self.size or session in self.sessions:
+            self._wake()
+            return False
+        self.sessions[session] = 0
+        # Every waiter can use the new session.
+        self.wake_all()
+        return True
+
+    def creation_failed(self, key):
+        if key in self.creating:
+            del self.creating[key]
+            self._wake()
+
+    def expire(self, now):
+        """Drop the sessions being created since *create_timeout* seconds
+        before *now* or earlier, and return how many were dropped."""
+        if not self.create_timeout:
+            return 0
+        expired = 0
+        for key, started in list(self.creating.items()):
+            if now - started < self.create_timeout:
+                break
+            del self.creating[key]
+            expired += 1
+            self._wake()
+        return expired
+
+    def expires_in(self, now):
+        """Return the number of seconds after *now* when the oldest session
+        being created expires, or ``None`` if it never does."""
+        if not self.create_timeout or not self.creating:
+            return None
+        started = next(iter(self.creating.values()))
+        return max(started + self.create_timeout - now, 0)
+
+    def retire(self, session):
+        """Remove *session* from the pool, and return ``True`` if it was in
+        the pool."""
+        if self.sessions.pop(session, None) is None:
+            return False
+        self._wake()
+        return True
+
+    def wait(self):
+        """Return a Deferred that fires with ``None`` on the next change in
+        the pool that may allow :meth:`acquire` to return a session."""
+        deferred = Deferred(self._cancel_wait)
+        self._waiters.append(deferred)
+        return deferred
+
+    def wake_all(self):
+        while self._waiters:
+            self._waiters.popleft().callback(None)
+
+    def _cancel_wait(self, deferred):
+        try:
+            self._waiters.remove(deferred)
+        except ValueError:
+            pass
+
+    def _wake(self):
+        if self._waiters:
+            self._waiters.popleft().callback(None)
@@ -0,0 +1,348 @@
+"""Backends of state shared between processes, see
+``ZYTE_SMARTPROXY_STATE_BACKEND``.
+
+Keys and set members are strings, and values are floats. Backends are called
+from the reactor thread, every ``ZYTE_SMARTPROXY_STATE_SYNC_INTERVAL`` seconds
+and when the spider closes, so their methods should return quickly.
+"""
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from hashlib import sha1
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend(object):
+    """Base class of state backends.
+
+    *ttl* parameters are in seconds, ``None`` means no expiration.
+    """
+
+    #: Number of writes that could not be stored, e.g. because the backend is
+    #: full.
+    dropped = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls()
+
+    def get(self, key):
+        """Return the value of *key*, or ``None``."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def incr(self, key, ttl=None, amount=1):
+        """Increase the value of *key*, starting at 0, by *amount*, set its
+        *ttl*, and return its new value as an integer."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def sadd(self, key, member, ttl=None):
+        """Add *member* to the set *key*, for at least *ttl* seconds."""
+        raise NotImplementedError
+
+    def smembers(self, key):
+        """Return the members of the set *key*."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _expires(ttl):
+    return time() + ttl if ttl else 0.0
+
+
+class MemoryStateBackend(StateBackend):
+    """Backend that keeps state in memory, so it is not shared with other
+    processes."""
+
+    def __init__(self):
+        # Values are (value, expiration time or 0) tuples.
+        self._values = {}  # type: dict
+        # Values are dicts of members and their expiration time or 0.
+        self._sets = {}  # type: dict
+
+    def get(self, key):
+        item = self._values.get(key)
+        if item is None:
+            return None
+        if item[1] and item[1] <= time():
+            del self._values[key]
+            return None
+        return item[0]
+
+    def set(self, key, value, ttl=None):
+        self._values[key] = (float(value), _expires(ttl))
+
+    def incr(self, key, ttl=None, amount=1):
+        value = int(self.get(key) or 0) + amount
+        self.set(key, value, ttl)
+        return value
+
+    def delete(self, key):
+        self._values.pop(key, None)
+
+    def sadd(self, key, member, ttl=None):
+        self._sets.setdefault(key, {})[member] = _expires(ttl)
+
+    def smembers(self, key):
+        members = self._sets.get(key, {})
+        now = time()
+        for member, expires in list(members.items()):
+            if expires and expires <= now:
+                del members[member]
+        return set(members)
+
+
+class MmapStateBackend(StateBackend):
+    """Backend that keeps state in a memory-mapped file, shared by the
+    processes of a node that use the same *path*.
+
+    The file is a hash table of up to *capacity* entries, locked with
+    :func:`fcntl.flock`, so it only works on Unix. Keys longer than 237 UTF-8
+    bytes are hashed, so set members that long are not returned by
+    :meth:`smembers`. If the table is too full, new keys are not stored, and
+    :attr:`dropped` is increased. Expired entries are reused.
+    """
+
+    RECORD_SIZE = 256
+    # Status, key length, value, expiration time or 0.
+    _HEADER = struct.Struct("<BHdd")
+    _STATUS = struct.Struct("<B")
+    _EMPTY, _USED, _DELETED = 0, 1, 2
+    # Linear probing gives up after this many entries.
+    max_probes = 64
+
+    def __init__(self, path, capacity=16384):
+        import fcntl
+
+        self._fcntl = fcntl
+        self.path = path
+        self.capacity = capacity
+        size = capacity * self.RECORD_SIZE
+        self._file = open(path, "a+b")
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(path) < size:
+                self._file.truncate(size)
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(
+            settings.get("ZYTE_SMARTPROXY_STATE_MMAP_PATH")
+            or os.path.join(tempfile.gettempdir(), "scrapy-zyte-smartproxy.state"),
+            capacity=settings.getint("ZYTE_SMARTPROXY_STATE_MMAP_CAPACITY", 16384),
+        )
+
+    def _lock(self, operation):
+        self._fcntl.flock(self._file.fileno(), operation)
+
+    def _encode(self, key):
+        key = key.encode("utf-8")
+        if len(key) > self.RECORD_SIZE - self._HEADER.size:
+            key = b"#" + sha1(key).hexdigest().encode("ascii")
+        return key
+
+    def _find(self, key):
+        """Return the index of the live entry of *key*, or ``None``, and the
+        index of the first reusable entry for *key*, or ``None``."""
+        data = self._mmap
+        now = time()
+        start = (zlib.crc32(key) & 0xFFFFFFFF) % self.capacity
+        free = None
+        for probe in range(min(self.max_probes, self.capacity)):
+            index = (start + probe) % self.capacity
+            offset = index * self.RECORD_SIZE
+            status, length, _, expires = self._HEADER.unpack_from(data, offset)
+            if status == self._EMPTY:
+                return None, index if free is None else free
+            if status == self._USED and (not expires or expires > now):
+                key_start = offset + self._HEADER.size
+                key_end = key_start + length
+                if data[key_start:key_end] == key:
+                    return index, index
+            elif free is None:
+                free = index
+        return None, free
+
+    def _drop(self):
+        if not self.dropped:
+            logger.warning(
+                "The state file %s is full, increase "
+                "ZYTE_SMARTPROXY_STATE_MMAP_CAPACITY.",
+                self.path,
+            )
+        self.dropped += 1
+
+    def _read(self, index):
+        return self._HEADER.unpack_from(self._mmap, index * self.RECORD_SIZE)[2]
+
+    def _write(self, index, key, value, ttl):
+        offset = index * self.RECORD_SIZE
+        self._HEADER.pack_into(
+            self._mmap, offset, self._USED, len(key), value, _expires(ttl)
+        )
+        key_start = offset + self._HEADER.size
+        key_end = key_start + len(key)
+        self._mmap[key_start:key_end] = key
+
+    def get(self, key):
+        key = self._encode(key)
+        self._lock(self._fcntl.LOCK_SH)
+        try:
+            index, _ = self._find(key)
+            return None if index is None else self._read(index)
+        finally:
+            self._lock(self._fcntl.LOCK_UN)
+
+    def set(self, key, value, ttl=None):
+        key = self._encode(key)
+        self._lock(self._fcntl.LOCK_EX)
+        try:
+            _, free = self._find(key)
+            if free is None:
+                self._drop()
+            else:
+                self._write(free, key, float(value), ttl)
+        finally:
+            self._lock(self._fcntl.LOCK_UN)
+
+    def incr(self, key, ttl=None, amount=1):
+        key = self._encode(key)
+        self._lock(self._fcntl.LOCK_EX)
+        try:
+            index, free = self._find(key)
+            value = amount if index is None else int(self._read(index)) + amount
+            if free is None:
+                self._drop()
+            else:
+                self._write(free, key, value, ttl)
+            return value
+        finally:
+            self._lock(self._fcntl.LOCK_UN)
+
+    def delete(self, key):
+        key = self._encode(key)
+        self._lock(self._fcntl.LOCK_EX)
+        try:
+            index, _ = self._find(key)
+            if index is not None:
+                self._STATUS.pack_into(
+                    self._mmap, index * self.RECORD_SIZE, self._DELETED
+                )
+        finally:
+            self._lock(self._fcntl.LOCK_UN)
+
+    def sadd(self, key, member, ttl=None):
+        self.set(key + "\0" + member, 1, ttl)
+
+    def smembers(self, key):
+        prefix = self._encode(key + "\0")
+        members = set()
+        data = self._mmap
+        now = time()
+        self._lock(self._fcntl.LOCK_SH)
+        try:
+            for index in range(self.capacity):
+                offset = index * self.RECORD_SIZE
+                status, length, _, expires = self._HEADER.unpack_from(data, offset)
+                if status != self._USED or (expires and expires <= now):
+                    continue
+                key_start = offset + self._HEADER.size
+                key_end = key_start + length
+                entry = data[key_start:key_end]
+                if entry.startswith(prefix):
+                    members.add(entry.replace(prefix, b"", 1).decode("utf-8"))
+        finally:
+            self._lock(self._fcntl.LOCK_UN)
+        return members
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class RedisStateBackend(StateBackend):
+    """Backend that keeps state in a Redis-compatible server, shared by all
+    processes that use the same server and *prefix*.
+
+    *client* is a :class:`redis.Redis` object, or any object with the same
+    ``get``, ``set``, ``incr``, ``pexpire``, ``pttl``, ``delete``, ``sadd``
+    and ``smembers`` methods.
+
+    Sets expire as a whole, *ttl* seconds after the addition with the latest
+    expiration.
+    """
+
+    def __init__(self, client, prefix="zyte_smartproxy:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError(
+                "scrapy_zyte_smartproxy.state.RedisStateBackend requires the "
+                "redis package: pip install redis"
+            )
+        settings = crawler.settings
+        client = redis.Redis.from_url(
+            settings.get("ZYTE_SMARTPROXY_STATE_REDIS_URL", "redis://localhost:6379")
+        )
+        return cls(
+            client,
+            prefix=settings.get(
+                "ZYTE_SMARTPROXY_STATE_REDIS_PREFIX", "zyte_smartproxy:"
+            ),
+        )
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else float(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(
+            self.prefix + key, value, px=max(1, int(ttl * 1000)) if ttl else None
+        )
+
+    def incr(self, key, ttl=None, amount=1):
+        key = self.prefix + key
+        value = self.client.incr(key, amount)
+        if ttl:
+            self.client.pexpire(key, max(1, int(ttl * 1000)))
+        return int(value)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def sadd(self, key, member, ttl=None):
+        key = self.prefix + key
+        self.client.sadd(key, member)
+        if ttl:
+            ttl = max(1, int(ttl * 1000))
+            # pttl is negative for keys without expiration.
+            if self.client.pttl(key) < ttl:
+                self.client.pexpire(key, ttl)
+
+    def smembers(self, key):
+        return {
+            member.decode("utf-8") if isinstance(member, bytes) else member
+            for member in self.client.smembers(self.prefix + key)
+        }
@@ -1,6 +1,18 @@
+import gzip
+import json
 import math
+import os
 import random
+import tempfile
+from collections import OrderedDict, deque
+from email.utils import mktime_tz, parsedate_tz
 from itertools import count
+from time import time
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping  # type: ignore
 
 
 def exp_backoff(step, max):
@@ -13,3 +25,453 @@ def exp_backoff(step, max):
             yield random.uniform(0, step * 2**attempt)  # nosec
         else:
             yield random.uniform(0, max)  # nosec
+
+
+def parse_retry_after(value, now=None):
+    """Return the number of seconds to wait according to *value*, the value of
+    a ``Retry-After`` header as either a number of seconds or an HTTP date, or
+    ``None`` if *value* is missing or invalid.
+
+    For HTTP dates, *now* is the current timestamp, :func:`time.time` by
+    default. Dates in the past result in ``0.0``.
+    """
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    try:
+        seconds = float(value)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        seconds = mktime_tz(date) - (time() if now is None else now)
+    if seconds != seconds:  # NaN
+        return None
+    return max(seconds, 0.0)
+
+
+def load_domains(path, ttl=0, now=None):
+    """Return a dict of domains and the timestamps when they were learned, read
+    from a file written by :func:`save_domains`, skipping those learned more
+    than *ttl* seconds ago if *ttl* is set.
+
+    A missing file counts as an empty one.
+    """
+    if not os.path.exists(path):
+        return {}
+    with gzip.open(path, "rb") as f:
+        data = json.loads(f.read().decode("utf-8"))
+    domains = data["domains"]
+    if not ttl:
+        return domains
+    now = time() if now is None else now
+    return {
+        domain: timestamp
+        for domain, timestamp in domains.items()
+        if now - timestamp < ttl
+    }
+
+
+def save_domains(path, domains, maxsize=0):
+    """Save a dict of domains and the timestamps when they were learned into
+    a gzip-compressed JSON file at *path*, keeping only the *maxsize* most
+    recently learned domains if *maxsize* is set.
+
+    The file is replaced atomically, through a uniquely named temporary file,
+    so that neither a crash while saving nor processes saving at the same time
+    corrupt it.
+    """
+    if maxsize and len(domains) > maxsize:
+        domains = dict(
+            sorted(domains.items(), key=lambda item: item[1], reverse=True)[:maxsize]
+        )
+    data = json.dumps({"version": 1, "domains": domains}, separators=(",", ":"))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+    )
+    try:
+        with os.fdopen(fd, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                f.write(data.encode("utf-8"))
+        getattr(os, "replace", os.rename)(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class BoundedStore(MutableMapping):
+    """Mapping that holds at most *maxsize* items, evicting the least recently
+    used ones first.
+
+    If *ttl* is set, items that have not been used for *ttl* seconds are also
+    evicted.
+
+    If *default_factory* is set, it works as in
+    :class:`collections.defaultdict`.
+
+    If *on_evict* is set, it is called with the key and value of every evicted
+    item.
+
+    A *maxsize* or *ttl* of ``0`` means no limit.
+    """
+
+    def __init__(self, maxsize=0, ttl=0, default_factory=None, on_evict=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.default_factory = default_factory
+        self.on_evict = on_evict
+        self.evictions = 0
+        # Values are (value, time of last use) tuples.
+        self._data = OrderedDict()  # type: OrderedDict
+
+    def _now(self):
+        return time() if self.ttl else 0
+
+    def _evict(self, key):
+        value, _ = self._data.pop(key)
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def _expire(self, now):
+        data = self._data
+        while data:
+            key = next(iter(data))
+            if now - data[key][1] < self.ttl:
+                break
+            self._evict(key)
+
+    def _is_expired(self, item, now):
+        return self.ttl and now - item[1] >= self.ttl
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and not self._is_expired(item, self._now())
+
+    def __getitem__(self, key):
+        now = self._now()
+        item = self._data.pop(key, None)
+        if item is not None and self._is_expired(item, now):
+            self._data[key] = item
+            self._evict(key)
+            item = None
+        if item is None:
+            if self.default_factory is None:
+                raise KeyError(key)
+            value = self.default_factory()
+            self[key] = value
+            return value
+        self._data[key] = (item[0], now)
+        return item[0]
+
+    def __setitem__(self, key, value):
+        data = self._data
+        now = self._now()
+        if key in data:
+            del data[key]
+        else:
+            if self.ttl:
+                self._expire(now)
+            if self.maxsize and len(data) >= self.maxsize:
+                self._evict(next(iter(data)))
+        data[key] = (value, now)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, dict(self.items()))
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return self[key]
+
+    def pop(self, key, *args):
+        item = self._data.pop(key, None)
+        if item is None:
+            if args:
+                return args[0]
+            raise KeyError(key)
+        return item[0]
+
+    def items(self):
+        return [(key, item[0]) for key, item in self._data.items()]
+
+    def values(self):
+        return [item[0] for item in self._data.values()]
+
+    def clear(self):
+        self._data.clear()
+
+
+class WarningAggregator(object):
+    """Logs only the first occurrence of each warning, and then, at most once
+    every *interval* seconds, how many more times each warning has occurred.
+
+    Warnings are identified by a hashable key.
+    """
+
+    def __init__(self, logger, interval=60):
+        self.logger = logger
+        self.interval = interval
+        # Keys are warning keys, values are [summary message, summary
+        # arguments, occurrences since the last report] lists.
+        self._warnings = {}  # type: dict
+        self._last_report = time()
+
+    def warn(self, key, summary, msg, *args):
+        """Log *msg* with *args* as a warning if it is the first occurrence of
+        *key*, else count it.
+
+        *summary* is a (message, arguments) tuple used to describe the warning
+        in reports.
+        """
+        warning = self._warnings.get(key)
+        if warning is None:
+            self._warnings[key] = [summary[0], summary[1], 0]
+            self.logger.warning(msg, *args)
+            return
+        warning[2] += 1
+        if self.interval and time() - self._last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        """Log how many more times each warning has occurred since the last
+        report."""
+        for warning in self._warnings.values():
+            msg, args, occurrences = warning
+            if not occurrences:
+                continue
+            warning[2] = 0
+            self.logger.warning(
+                msg + " (%d more times since it was last reported).",
+                *(args + (occurrences,))
+            )
+        self._last_report = time()
+
+
+class CircuitBreaker(object):
+    """Circuit breaker that opens after *threshold* failures within *window*
+    seconds.
+
+    While open, :meth:`allow` returns ``False`` until *open_time* seconds have
+    passed. Then the circuit becomes half-open: :meth:`allow` returns ``True``
+    for up to *probes* calls, and the next success closes the circuit, while
+    the next failure opens it again. If neither happens within *open_time*
+    seconds, e.g. because probe requests were lost, :meth:`allow` returns
+    ``True`` for up to *probes* more calls.
+
+    Methods that take *now*, the current timestamp, return the new state if
+    the state changes, else ``None``.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, threshold, window, open_time, probes=1):
+        self.threshold = threshold
+        self.window = window
+        self.open_time = open_time
+        self.probes = probes
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._failures = deque()  # type: deque
+        self._probes_sent = 0
+        self._probed_at = 0.0
+
+    @property
+    def reopens_at(self):
+        return self.opened_at + self.open_time
+
+    def allow(self, now):
+        if self.state == self.OPEN:
+            if now < self.reopens_at:
+                return False
+            self.state = self.HALF_OPEN
+            self._probes_sent = 0
+        if self.state == self.HALF_OPEN:
+            if self._probes_sent >= self.probes:
+                if now < self._probed_at + self.open_time:
+                    return False
+                self._probes_sent = 0
+            if not self._probes_sent:
+                self._probed_at = now
+            self._probes_sent += 1
+        return True
+
+    def record_success(self, now):
+        if self.state != self.HALF_OPEN:
+            return None
+        self.state = self.CLOSED
+        self._failures.clear()
+        return self.state
+
+    def record_failure(self, now):
+        if self.state == self.OPEN:
+            return None
+        if self.state == self.CLOSED:
+            failures = self._failures
+            failures.append(now)
+            while now - failures[0] > self.window:
+                failures.popleft()
+            if len(failures) < self.threshold:
+                return None
+        self.state = self.OPEN
+        self.opened_at = now
+        self._failures.clear()
+        return self.state
+
+
+class LatencyHistogram(object):
+    """Histogram of durations, in seconds, with logarithmic buckets.
+
+    There are *buckets_per_octave* buckets for every doubling of duration
+    between *min_value* and *max_value*, so percentiles are accurate to about
+    9% with the default value, and memory usage is fixed.
+    """
+
+    def __init__(self, min_value=0.001, max_value=3600.0, buckets_per_octave=8):
+        self.min_value = min_value
+        self.buckets_per_octave = buckets_per_octave
+        self._log_min = math.log(min_value)
+        self._scale = buckets_per_octave / math.log(2)
+        # Bucket 0 is for durations up to min_value, the last bucket is for
+        # durations above max_value.
+        size = int(math.ceil(math.log(max_value / min_value, 2) * buckets_per_octave))
+        self._counts = [0] * (size + 2)
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, value):
+        if value <= self.min_value:
+            index = 0
+        else:
+            index = min(
+                int((math.log(value) - self._log_min) * self._scale) + 1,
+                len(self._counts) - 1,
+            )
+        self._counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """Return an upper bound of the given percentile (0-100) of recorded
+        durations, or ``None`` if there are none."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = 0
+        for index, bucket_count in enumerate(self._counts):
+            seen += bucket_count
+            if seen >= rank:
+                break
+        if index == len(self._counts) - 1:
+            return self.max
+        upper = self.min_value * 2 ** (float(index) / self.buckets_per_octave)
+        return min(upper, self.max)
+
+
+class BanWindow(object):
+    """Ban ratio of the last *size* responses of a download slot, and
+    exponentially-decayed ban rate, in bans per second over about the last
+    *period* seconds, with fixed memory usage."""
+
+    __slots__ = (
+        "size",
+        "period",
+        "count",
+        "bans",
+        "_outcomes",
+        "_index",
+        "_rate",
+        "_updated",
+    )
+
+    def __init__(self, size, period=60.0):
+        self.size = size
+        self.period = period
+        self.count = 0
+        self.bans = 0
+        # Ring buffer of outcomes, 1 for bans.
+        self._outcomes = bytearray(size)
+        self._index = 0
+        self._rate = 0.0
+        self._updated = None
+
+    @property
+    def full(self):
+        return self.count >= self.size
+
+    @property
+    def ratio(self):
+        if not self.count:
+            return 0.0
+        return float(self.bans) / self.count
+
+    def record(self, banned, now):
+        outcome = 1 if banned else 0
+        if self.count < self.size:
+            self.count += 1
+        else:
+            self.bans -= self._outcomes[self._index]
+        self._outcomes[self._index] = outcome
+        self.bans += outcome
+        self._index = (self._index + 1) % self.size
+        self._rate = self.rate(now)
+        self._updated = now
+        if banned:
+            self._rate += 1.0 / self.period
+
+    def rate(self, now):
+        if self._updated is None:
+            return 0.0
+        return self._rate * math.exp(-max(0.0, now - self._updated) / self.period)
+
+
+class TokenBucket(object):
+    """Token bucket of up to *capacity* tokens, refilled at *rate* tokens per
+    second.
+
+    :meth:`take` reserves tokens in advance when the bucket is empty, so that
+    waiting callers get tokens in the order in which they asked for them.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self._updated = None
+
+    def take(self, now):
+        """Take a token, and return how many seconds to wait until it is
+        available, or ``0.0`` if it is available right away."""
+        if self._updated is not None:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self._updated) * self.rate
+            )
+        self._updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
@@ -0,0 +1,215 @@
+"""Local stand-in for Zyte proxy services.
+
+It works as an HTTP proxy for plain HTTP URLs (CONNECT is not supported), and
+answers every request itself, emulating Zyte Smart Proxy Manager or the proxy
+mode of Zyte API:
+
+-   Every response has an ``X-Crawlera-Version`` header (Smart Proxy Manager)
+    or a ``Zyte-Request-Id`` header (Zyte API).
+
+-   Requests without the expected ``Proxy-Authorization`` header get a 407
+    response.
+
+-   Ban, throttling and authentication error responses, with their
+    ``X-Crawlera-Error`` or ``Zyte-Error-Type`` headers and an optional
+    ``Retry-After`` header, are returned with the configured probabilities.
+
+-   ``X-Crawlera-Session: create`` request headers get a new session ID in
+    the ``X-Crawlera-Session`` response header, other session IDs are echoed.
+
+-   Responses are delayed by a random latency within the configured range.
+
+Run ``python -m tests.mockserver --help`` for the available options, or use
+:class:`MockProxyServer` to run it in a subprocess.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+from base64 import b64encode
+
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+# The reactor is imported where needed, so that importing this module does not
+# install one.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Keys are modes, values are (identifying header, ban response, throttling
+# response, authentication error response) tuples, where responses are
+# (status, error header, error) tuples.
+MODES = {
+    "spm": (
+        b"X-Crawlera-Version",
+        (503, b"X-Crawlera-Error", b"banned"),
+        (503, b"X-Crawlera-Error", b"noslaves"),
+        (407, b"X-Crawlera-Error", b"bad_proxy_auth"),
+    ),
+    "zyte_api": (
+        b"Zyte-Request-Id",
+        (520, b"Zyte-Error-Type", b"/download/temporary-error"),
+        (429, b"Zyte-Error-Type", b"/limits/over-user-limit"),
+        (407, b"Zyte-Error-Type", b"/auth/key-not-found"),
+    ),
+}
+
+
+class ProxyResource(Resource):
+
+    isLeaf = True
+
+    def __init__(
+        self,
+        mode="spm",
+        apikey="apikey",
+        ban=0.0,
+        throttle=0.0,
+        auth_error=0.0,
+        retry_after=None,
+        min_latency=0.0,
+        max_latency=0.0,
+        seed=None,
+    ):
+        Resource.__init__(self)
+        self.id_header, self.ban, self.throttle, self.auth_error = MODES[mode]
+        self.proxy_auth = b"Basic " + b64encode(apikey.encode() + b":")
+        self.probabilities = ((self.ban, ban), (self.throttle, throttle))
+        self.auth_error_probability = auth_error
+        self.retry_after = retry_after
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def render(self, request):
+        self.requests += 1
+        number = self.requests
+        latency = self.random.uniform(self.min_latency, self.max_latency)
+        if latency > 0:
+            from twisted.internet import reactor
+
+            reactor.callLater(latency, self._respond, request, number)
+            return NOT_DONE_YET
+        return self._respond(request, number, finish=False)
+
+    def _error(self):
+        if (
+            self.auth_error_probability
+            and self.random.random() < self.auth_error_probability
+        ):
+            return self.auth_error
+        for error, probability in self.probabilities:
+            if probability and self.random.random() < probability:
+                return error
+        return None
+
+    def _respond(self, request, number, finish=True):
+        request.setHeader(self.id_header, str(number).encode())
+        session = request.getHeader(b"X-Crawlera-Session")
+        if session == b"create":
+            session = ("s%d" % number).encode()
+        if session is not None:
+            request.setHeader(b"X-Crawlera-Session", session)
+        if request.getHeader(b"Proxy-Authorization") != self.proxy_auth:
+            error = self.auth_error
+        else:
+            error = self._error()
+        if error is None:
+            request.setResponseCode(200)
+            body = b"<html><body>" + request.uri + b"</body></html>"
+        else:
+            status, header, value = error
+            request.setResponseCode(status)
+            request.setHeader(header, value)
+            if self.retry_after is not None and error is not self.auth_error:
+                request.setHeader(b"Retry-After", str(self.retry_after).encode())
+            body = b""
+        if not finish:
+            return body
+        if not request.finished and not request._disconnected:
+            request.write(body)
+            request.finish()
+
+
+class MockProxyServer(object):
+    """Context manager that runs the mock proxy in a subprocess.
+
+    Keyword arguments are passed as command-line options, e.g.
+    ``MockProxyServer(mode="zyte_api", ban=0.1)``, after any command-line
+    arguments in *args*.
+    """
+
+    def __init__(self, args=(), **options):
+        self.args = list(args)
+        for name, value in options.items():
+            self.args.extend(["--" + name.replace("_", "-"), str(value)])
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(
+            [sys.executable, "-u", "-m", "tests.mockserver"] + self.args,
+            stdout=subprocess.PIPE,
+            cwd=ROOT,
+        )
+        line = self.proc.stdout.readline().decode()
+        self.port = int(re.search(r"port (\d+)", line).group(1))
+        self.url = "http://127.0.0.1:%d" % self.port
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.proc.kill()
+        self.proc.communicate()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Zyte proxy service.")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--mode", choices=sorted(MODES), default="spm")
+    parser.add_argument("--apikey", default="apikey")
+    parser.add_argument("--ban", type=float, default=0.0, help="ban probability")
+    parser.add_argument(
+        "--throttle", type=float, default=0.0, help="throttling probability"
+    )
+    parser.add_argument(
+        "--auth-error",
+        type=float,
+        default=0.0,
+        help="authentication error probability",
+    )
+    parser.add_argument(
+        "--retry-after",
+        type=int,
+        default=None,
+        help="Retry-After value for ban and throttling responses",
+    )
+    parser.add_argument("--min-latency", type=float, default=0.0)
+    parser.add_argument("--max-latency", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from twisted.internet import reactor
+
+    resource = ProxyResource(
+        mode=args.mode,
+        apikey=args.apikey,
+        ban=args.ban,
+        throttle=args.throttle,
+        auth_error=args.auth_error,
+        retry_after=args.retry_after,
+        min_latency=args.min_latency,
+        max_latency=max(args.min_latency, args.max_latency),
+        seed=args.seed,
+    )
+    port = reactor.listenTCP(args.port, Site(resource), interface="127.0.0.1")
+    print("Mock proxy listening on port %d" % port.getHost().port)
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
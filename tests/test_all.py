@@ -1,7 +1,14 @@
 # -*- coding: UTF-8 -*-
 
 import binascii
+import json
+import math
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
 from copy import copy
 from random import choice
 from unittest import TestCase
@@ -9,20 +16,46 @@ from unittest import TestCase
 import pytest
 
 try:
-    from unittest.mock import call, patch  # type: ignore
+    from unittest.mock import Mock, call, patch  # type: ignore
 except ImportError:
-    from mock import call, patch  # type: ignore
+    from mock import Mock, call, patch  # type: ignore
 
+from scrapy import version_info
 from scrapy.downloadermiddlewares.httpproxy import HttpProxyMiddleware
-from scrapy.exceptions import ScrapyDeprecationWarning
+from scrapy.exceptions import (
+    DontCloseSpider,
+    IgnoreRequest,
+    ScrapyDeprecationWarning,
+)
 from scrapy.http import Request, Response
 from scrapy.resolver import dnscache
 from scrapy.spiders import Spider
 from scrapy.utils.test import get_crawler
+from six.moves.urllib.parse import urlparse
+from twisted.internet import reactor  # noqa: F401
+from twisted.internet.defer import Deferred
 from twisted.internet.error import ConnectionDone, ConnectionRefusedError
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
 from w3lib.http import basic_auth_header
 
-from scrapy_zyte_smartproxy import ZyteSmartProxyMiddleware, __version__
+from scrapy_zyte_smartproxy import ZyteSmartProxyMiddleware, __version__, state
+from scrapy_zyte_smartproxy.domains import DomainPolicy, DomainTrie
+from scrapy_zyte_smartproxy.endpoints import Endpoint, EndpointPool
+from scrapy_zyte_smartproxy.state import (
+    MemoryStateBackend,
+    MmapStateBackend,
+    RedisStateBackend,
+)
+from scrapy_zyte_smartproxy.utils import (
+    BanWindow,
+    CircuitBreaker,
+    LatencyHistogram,
+    TokenBucket,
+    load_domains,
+    parse_retry_after,
+    save_domains,
+)
 
 RESPONSE_IDENTIFYING_HEADERS = (
     ("X-Crawlera-Version", None),
@@ -32,10 +65,26 @@ RESPONSE_IDENTIFYING_HEADERS = (
 )
 
 
+def _deferred(result):
+    """Return a Deferred for a *result* of process_request that is neither
+    ``None`` nor a Deferred, i.e. a coroutine, returned on Scrapy 2.6 and
+    later.
+
+    Scrapy requires an installed reactor to await Deferreds, hence the
+    reactor import above.
+    """
+    if result is None or isinstance(result, Deferred):
+        return result
+    from twisted.internet.defer import ensureDeferred
+
+    return ensureDeferred(result)
+
+
 class MockedSlot(object):
 
-    def __init__(self, delay=0.0):
+    def __init__(self, delay=0.0, concurrency=8):
         self.delay = delay
+        self.concurrency = concurrency
 
 
 class ZyteSmartProxyMiddlewareTestCase(TestCase):
@@ -72,9 +121,15 @@ class ZyteSmartProxyMiddlewareTestCase(TestCase):
             downloader = MockedDownloader()
             fake_spider_closed_result = None
 
+            def __init__(self):
+                self.crawled = []
+
             def close_spider(self, spider, reason):
                 self.fake_spider_closed_result = (spider, reason)
 
+            def crawl(self, request, spider=None):
+                self.crawled.append(request)
+
         # with `spider` instead of `type(spider)` raises an exception
         crawler = get_crawler(type(spider), settings)
         crawler.engine = MockedEngine()
@@ -575,6 +630,55 @@ class ZyteSmartProxyMiddlewareTestCase(TestCase):
         settings["ZYTE_SMARTPROXY_URL"] = "http://api.zyte.com:8011"
         self._test_stats(settings, "zyte_api_proxy")
 
+    def test_stats_buffer(self):
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_STATS_FLUSH_INTERVAL"] = 60
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        self.assertTrue(mw._stats_task.running)
+
+        for _ in range(2):
+            req = Request("http://example.com")
+            assert mw.process_request(req, self.spider) is None
+            res = self._mock_zyte_smartproxy_response(req.url)
+            assert mw.process_response(req, res, self.spider) is res
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/request"), None)
+
+        mw._flush_stats()
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/request"), 2)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/response/status/200"), 2
+        )
+
+        req = Request("http://example.com", method="POST")
+        assert mw.process_request(req, self.spider) is None
+        mw.spider_closed(self.spider)
+        self.assertFalse(mw._stats_task.running)
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/request"), 3)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/request/method/POST"), 1
+        )
+
+    def test_stat_names(self):
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        mw._inc_stat(("response/status/", 200), targets_zyte_api=False)
+        mw._inc_stat(("response/status/", 200), targets_zyte_api=True)
+        mw._inc_stat("response/status/200", targets_zyte_api=False)
+        self.assertEqual(
+            crawler.stats.get_stats(),
+            {
+                "zyte_smartproxy/response/status/200": 2,
+                "zyte_api_proxy/response/status/200": 1,
+            },
+        )
+        self.assertIs(
+            mw._stat_names[False][("response/status/", 200)],
+            mw._stat_names[False]["response/status/200"],
+        )
+
     def _make_fake_request(self, spider, zyte_smartproxy_enabled, **kwargs):
         spider.zyte_smartproxy_enabled = zyte_smartproxy_enabled
         crawler = self._mock_crawler(spider, self.settings)
@@ -644,6 +748,22 @@ class ZyteSmartProxyMiddlewareTestCase(TestCase):
             other_request_warning, extra={"spider": spider}
         )
 
+        # The general warning is only sent once, and conflicts are counted.
+        self.assertEqual(mock_warnings.warn.call_count, 1)
+        self.assertEqual(mock_logger.debug.call_count, 2)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/headers/conflicting"), 2
+        )
+
+        # Per-request messages are only built if debug logging is enabled.
+        mock_logger.isEnabledFor.return_value = False
+        req = Request("http://example.com/other", headers={"X-Crawlera-UA": "desktop"})
+        assert mw.process_request(req, spider) is None
+        self.assertEqual(mock_logger.debug.call_count, 2)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/headers/conflicting"), 3
+        )
+
     def test_dont_proxy_false_does_nothing(self):
         spider = self.spider
         spider.zyte_smartproxy_enabled = True
@@ -792,6 +912,1332 @@ class ZyteSmartProxyMiddlewareTestCase(TestCase):
         mw.process_response(good_req, good_res, self.spider)
         self.assertEqual(slot.delay, default_delay)
 
+    @patch("random.uniform")
+    def test_retry_after(self, random_uniform_patch):
+        random_uniform_patch.side_effect = lambda x, y: y
+
+        slot_key = "example.com"
+        url = "http://example.com"
+        self.settings["ZYTE_SMARTPROXY_BACKOFF_STEP"] = 15
+        self.settings["ZYTE_SMARTPROXY_BACKOFF_MAX"] = 70
+        self.spider.zyte_smartproxy_enabled = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        slot = MockedSlot()
+        crawler.engine.downloader.slots[slot_key] = slot
+        req = Request(url, meta={"download_slot": slot_key})
+        assert mw.process_request(req, self.spider) is None
+
+        def stat(source):
+            return crawler.stats.get_value(
+                "zyte_smartproxy/delay/source/{}".format(source)
+            )
+
+        for status, headers in (
+            (503, {"X-Crawlera-Error": "noslaves"}),
+            (429, {"Zyte-Error-Type": "/limits/over-user-limit"}),
+            (407, {"X-Crawlera-Error": "bad_proxy_auth"}),
+        ):
+            headers["Retry-After"] = "3"
+            res = self._mock_zyte_smartproxy_response(
+                url, status=status, headers=headers
+            )
+            mw.process_response(req, res, self.spider)
+            self.assertEqual(slot.delay, 3)
+        self.assertEqual(stat("retry_after"), 3)
+        self.assertEqual(stat("backoff"), None)
+
+        # Retry-After does not advance the backoff of the slot.
+        res = self._mock_zyte_smartproxy_response(
+            url, status=503, headers={"X-Crawlera-Error": "noslaves"}
+        )
+        mw.process_response(req, res, self.spider)
+        self.assertEqual(slot.delay, 15)
+        self.assertEqual(stat("backoff"), 1)
+
+        # Invalid values fall back to backoff.
+        res = self._mock_zyte_smartproxy_response(
+            url,
+            status=503,
+            headers={"X-Crawlera-Error": "noslaves", "Retry-After": "soon"},
+        )
+        mw.process_response(req, res, self.spider)
+        self.assertEqual(slot.delay, 30)
+        self.assertEqual(stat("backoff"), 2)
+
+        # Retry-After is capped at ZYTE_SMARTPROXY_BACKOFF_MAX.
+        for headers in (
+            {"X-Crawlera-Error": "noslaves", "Retry-After": "3600"},
+            {"X-Crawlera-Error": "banned", "Retry-After": "3600"},
+        ):
+            res = self._mock_zyte_smartproxy_response(url, status=503, headers=headers)
+            mw.process_response(req, res, self.spider)
+            self.assertEqual(slot.delay, 70)
+        self.assertEqual(stat("retry_after_capped"), 2)
+
+        # Bans without a valid Retry-After do not delay the slot.
+        slot.delay = 0
+        res = self._mock_zyte_smartproxy_response(
+            url,
+            status=503,
+            headers={"X-Crawlera-Error": "banned", "Retry-After": "soon"},
+        )
+        mw.process_response(req, res, self.spider)
+        self.assertEqual(slot.delay, 0)
+        self.assertEqual(stat("backoff"), 2)
+
+    @patch("random.uniform")
+    def test_backoff_per_slot(self, random_uniform_patch):
+        # mock random.uniform to just return the max delay
+        random_uniform_patch.side_effect = lambda x, y: y
+
+        backoff_step = 15
+        self.settings["ZYTE_SMARTPROXY_BACKOFF_STEP"] = backoff_step
+        self.settings["ZYTE_SMARTPROXY_BACKOFF_MAX"] = 180
+
+        self.spider.zyte_smartproxy_enabled = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        slot_a, slot_b = MockedSlot(), MockedSlot()
+        crawler.engine.downloader.slots["a.example"] = slot_a
+        crawler.engine.downloader.slots["b.example"] = slot_b
+        req_a = Request("http://a.example", meta={"download_slot": "a.example"})
+        req_b = Request("http://b.example", meta={"download_slot": "b.example"})
+        for req in (req_a, req_b):
+            assert mw.process_request(req, self.spider) is None
+
+        def throttle(req):
+            res = self._mock_zyte_smartproxy_response(
+                req.url,
+                status=503,
+                headers={"X-Crawlera-Error": "noslaves"},
+            )
+            mw.process_response(req, res, self.spider)
+
+        throttle(req_a)
+        throttle(req_a)
+        self.assertEqual(slot_a.delay, backoff_step * 2**1)
+
+        # Throttling a different slot starts its own backoff sequence.
+        throttle(req_b)
+        self.assertEqual(slot_b.delay, backoff_step)
+
+        # A successful response only resets the backoff of its own slot.
+        res = self._mock_zyte_smartproxy_response(req_b.url)
+        mw.process_response(req_b, res, self.spider)
+        self.assertEqual(slot_b.delay, 0)
+        self.assertNotIn("b.example", mw._backoffs)
+        throttle(req_a)
+        self.assertEqual(slot_a.delay, backoff_step * 2**2)
+
+    @patch("random.uniform")
+    def test_exp_backoff_deprecated(self, random_uniform_patch):
+        random_uniform_patch.side_effect = lambda x, y: y
+        self.spider.zyte_smartproxy_enabled = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        # The deprecated attribute is the backoff of responses without a
+        # download slot.
+        with pytest.warns(ScrapyDeprecationWarning):
+            backoff = mw.exp_backoff
+        self.assertEqual(next(backoff), mw.backoff_step)
+        self.assertEqual(mw._next_backoff(None), mw.backoff_step * 2)
+        with pytest.warns(ScrapyDeprecationWarning):
+            mw.exp_backoff = iter([1.0])
+        self.assertEqual(mw._next_backoff(None), 1.0)
+
+    @patch("random.uniform")
+    def test_backoff_policy_change(self, random_uniform_patch):
+        random_uniform_patch.side_effect = lambda x, y: y
+        self.spider.zyte_smartproxy_enabled = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        slow = DomainPolicy(None, [], None, 60, 600, None)
+        fast = DomainPolicy(None, [], None, 1, 600, None)
+
+        # The backoff sequence of a slot starts over with the parameters of a
+        # policy that differs from the one it was started with.
+        self.assertEqual(mw._next_backoff("a", slow), 60)
+        self.assertEqual(mw._next_backoff("a", slow), 120)
+        self.assertEqual(mw._next_backoff("a", fast), 1)
+        self.assertEqual(mw._next_backoff("a", fast), 2)
+        self.assertEqual(
+            mw._next_backoff("a", DomainPolicy(None, [], None, 1, 2, None)), 1
+        )
+        self.assertEqual(mw._next_backoff("a"), mw.backoff_step)
+
+    def test_backoff_slots_bounded(self):
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_STATE_MAXSIZE"] = 2
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        for key in ("a", "b", "a", "c"):
+            mw._next_backoff(key)
+        self.assertEqual(sorted(mw._backoffs), ["a", "c"])
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/state/evicted/backoffs"), 1
+        )
+
+    def test_state_bounded(self):
+        self.spider.zyte_smartproxy_enabled = False
+        self.settings["ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES"] = [403]
+        self.settings["ZYTE_SMARTPROXY_STATE_MAXSIZE"] = 2
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        for domain in ("a.example", "b.example", "c.example"):
+            req = Request("http://{}".format(domain))
+            mw.process_request(req, self.spider)
+            res = Response(req.url, status=403)
+            assert isinstance(mw.process_response(req, res, self.spider), Request)
+        self.assertEqual(mw.enabled_for_domain, {"b.example": True, "c.example": True})
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/state/evicted/domains"), 1
+        )
+
+    @patch("scrapy_zyte_smartproxy.utils.time")
+    def test_state_ttl(self, time_patch):
+        time_patch.return_value = 1000.0
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_STATE_TTL"] = 60
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        slot = MockedSlot(delay=0.5)
+        crawler.engine.downloader.slots["example.com"] = slot
+        req = Request("http://example.com", meta={"download_slot": "example.com"})
+        mw._set_custom_delay(req, 10, targets_zyte_api=False)
+        self.assertEqual(slot.delay, 10)
+        mw._bans["example.com"] += 1
+
+        # Expired state is evicted, and evicting a saved delay restores it.
+        time_patch.return_value += 60
+        self.assertEqual(mw._bans["example.com"], 0)
+        crawler.engine.downloader.slots["other.example"] = MockedSlot()
+        req = Request("http://other.example", meta={"download_slot": "other.example"})
+        mw._set_custom_delay(req, 10, targets_zyte_api=False)
+        self.assertEqual(slot.delay, 0.5)
+        self.assertNotIn("example.com", mw._saved_delays)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/state/evicted/saved_delays"), 1
+        )
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/state/evicted/bans"), 1
+        )
+
+    @patch("random.uniform")
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_throttle_retry(self, time_patch, random_uniform_patch):
+        time_patch.return_value = 1000.0
+        random_uniform_patch.side_effect = lambda x, y: y
+        clock = Clock()
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_THROTTLE_RETRY_ENABLED"] = True
+        self.settings["ZYTE_SMARTPROXY_MAX_THROTTLE_RETRY_TIMES"] = 1
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        slot = MockedSlot()
+        crawler.engine.downloader.slots["example.com"] = slot
+
+        def throttle(req):
+            res = self._mock_zyte_smartproxy_response(
+                req.url, status=503, headers={"X-Crawlera-Error": "noslaves"}
+            )
+            return mw.process_response(req, res, self.spider), res
+
+        errors = []
+        req = Request(
+            "http://example.com",
+            meta={"download_slot": "example.com"},
+            errback=errors.append,
+        )
+        assert mw.process_request(req, self.spider) is None
+
+        # The throttled response is dropped, and the request is crawled again
+        # after the delay, without waiting in the downloader. The slot is not
+        # delayed.
+        with patch("twisted.internet.reactor", clock, create=True):
+            with pytest.raises(IgnoreRequest) as exc_info:
+                throttle(req)
+        self.assertEqual(slot.delay, 0)
+        # Scrapy calls the errback of dropped requests, if any, but only the
+        # outcome of the retry is reported.
+        if req.errback is not None:
+            req.errback(Failure(exc_info.value))
+        self.assertEqual(errors, [])
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/retries/throttle"), 1)
+        clock.advance(14)
+        self.assertEqual(crawler.engine.crawled, [])
+        # The spider is kept open while retries wait.
+        self.assertRaises(DontCloseSpider, mw.spider_idle, self.spider)
+        clock.advance(1)
+        self.assertIsNone(mw.spider_idle(self.spider))
+        (retry,) = crawler.engine.crawled
+        self.assertEqual(retry.url, req.url)
+        self.assertEqual(retry.errback, errors.append)
+        self.assertTrue(retry.dont_filter)
+        self.assertEqual(retry.meta["zyte_smartproxy_throttle_retry_times"], 1)
+        self.assertEqual(mw._throttle_retries, set())
+        self.assertIsNone(mw.process_request(retry, self.spider))
+
+        # Once retries are exhausted, the slot is delayed instead.
+        result, res = throttle(retry)
+        self.assertIs(result, res)
+        self.assertEqual(slot.delay, 30)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/retries/throttle/max_reached"),
+            1,
+        )
+
+        # Pending retries are cancelled when the spider closes.
+        slot.delay = 0
+        req = Request("http://example.com", meta={"download_slot": "example.com"})
+        with patch("twisted.internet.reactor", clock, create=True):
+            self.assertRaises(IgnoreRequest, throttle, req)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        mw.spider_closed(self.spider)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(mw._throttle_retries, set())
+
+    def test_throttle_retry_disabled(self):
+        self.spider.zyte_smartproxy_enabled = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        req = Request("http://example.com")
+        assert mw.process_request(req, self.spider) is None
+        res = self._mock_zyte_smartproxy_response(
+            req.url, status=503, headers={"X-Crawlera-Error": "noslaves"}
+        )
+        self.assertIs(mw.process_response(req, res, self.spider), res)
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_session_pool(self, time_patch):
+        time_patch.return_value = 1000.0
+        clock = Clock()
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_SESSION_POOL_SIZE"] = 2
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        def request(url="http://example.com", **kwargs):
+            req = Request(url, **kwargs)
+            return req, mw.process_request(req, self.spider)
+
+        def park(url="http://example.com"):
+            errors = []
+            req = Request(url, errback=errors.append)
+            with patch("twisted.internet.reactor", clock, create=True):
+                self.assertRaises(IgnoreRequest, mw.process_request, req, self.spider)
+            # Only the outcome of the copy crawled later is reported.
+            self.assertIsNone(req.errback)
+            return req
+
+        def respond(req, status=200, session=None, **headers):
+            if session is not None:
+                headers["X-Crawlera-Session"] = session
+            res = self._mock_zyte_smartproxy_response(
+                req.url, status=status, headers=headers
+            )
+            mw.process_response(req, res, self.spider)
+
+        def stat(name):
+            return crawler.stats.get_value("zyte_smartproxy/sessions/" + name)
+
+        # The pool is filled with new sessions, further requests wait for
+        # one of them out of the downloader, and are crawled again once one
+        # is ready.
+        create1, result = request()
+        assert result is None
+        self.assertEqual(create1.headers["X-Crawlera-Session"], b"create")
+        create2, result = request()
+        self.assertEqual(create2.headers["X-Crawlera-Session"], b"create")
+        park()
+        self.assertEqual(stat("wait"), 1)
+        self.assertEqual(crawler.engine.crawled, [])
+        self.assertRaises(DontCloseSpider, mw.spider_idle, self.spider)
+
+        # Pools are per domain.
+        other, result = request("http://other.example")
+        assert result is None
+        self.assertEqual(other.headers["X-Crawlera-Session"], b"create")
+
+        respond(create1, session="1")
+        self.assertEqual(stat("created"), 1)
+        (waiting,) = crawler.engine.crawled
+        self.assertTrue(waiting.dont_filter)
+        self.assertIsNone(mw.spider_idle(self.spider))
+        self.assertIsNone(mw.process_request(waiting, self.spider))
+        self.assertEqual(waiting.headers["X-Crawlera-Session"], b"1")
+        respond(create2, session="2")
+        self.assertEqual(stat("created"), 2)
+
+        # Requests go to the least loaded session.
+        req, _ = request()
+        self.assertEqual(req.headers["X-Crawlera-Session"], b"2")
+        respond(req, session="2")
+        respond(waiting, session="1")
+        sessions = set()
+        for _ in range(2):
+            req, _ = request()
+            sessions.add(req.headers["X-Crawlera-Session"])
+            respond(req, session=req.headers["X-Crawlera-Session"])
+        self.assertEqual(sessions, {b"1", b"2"})
+
+        # Banned and expired sessions are replaced.
+        req, _ = request()
+        session = req.headers["X-Crawlera-Session"]
+        respond(
+            req, status=self.bancode, session=session, **{"X-Crawlera-Error": "banned"}
+        )
+        self.assertEqual(stat("retired/banned"), 1)
+        req, _ = request()
+        self.assertEqual(req.headers["X-Crawlera-Session"], b"create")
+        respond(req, session="3")
+        req, _ = request()
+        session = req.headers["X-Crawlera-Session"]
+        respond(
+            req, status=400, session=session, **{"X-Crawlera-Error": "bad_session_id"}
+        )
+        self.assertEqual(stat("retired/bad_session_id"), 1)
+        req, _ = request()
+        self.assertEqual(req.headers["X-Crawlera-Session"], b"create")
+
+        # Failed session creations free their place in the pool, including
+        # creation requests dropped by other downloader middlewares.
+        mw.process_exception(req, ConnectionRefusedError(), self.spider)
+        self.assertEqual(stat("create_failed"), 1)
+        req, _ = request()
+        self.assertEqual(req.headers["X-Crawlera-Session"], b"create")
+        mw.process_exception(req, IgnoreRequest(), self.spider)
+        self.assertEqual(stat("create_failed"), 2)
+        req, _ = request()
+        self.assertEqual(req.headers["X-Crawlera-Session"], b"create")
+
+        # Sessions set by users are kept.
+        req, result = request(headers={"X-Crawlera-Session": "mine"})
+        assert result is None
+        self.assertEqual(req.headers["X-Crawlera-Session"], b"mine")
+
+        # Session creations that never get a response nor an exception, e.g.
+        # because another downloader middleware rescheduled them, time out
+        # after the download timeout, and requests waiting for a session are
+        # crawled again then.
+        crawler.engine.crawled = []
+        lost, _ = request("http://third.example")
+        time_patch.return_value += 10
+        create, _ = request("http://third.example")
+        park("http://third.example")
+        clock.advance(mw.download_timeout - 11)
+        self.assertEqual(crawler.engine.crawled, [])
+        clock.advance(1)
+        (waiting,) = crawler.engine.crawled
+        time_patch.return_value += mw.download_timeout - 10
+        self.assertIsNone(mw.process_request(waiting, self.spider))
+        self.assertEqual(waiting.headers["X-Crawlera-Session"], b"create")
+        self.assertEqual(stat("create_timeout"), 1)
+
+        # Waits are cancelled quietly when the spider closes.
+        crawler.engine.crawled = []
+        park("http://third.example")
+        self.assertTrue(clock.getDelayedCalls())
+        mw.spider_closed(self.spider)
+        self.assertEqual(mw._session_waits, set())
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(crawler.engine.crawled, [])
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_circuit_breaker(self, time_patch):
+        time_patch.return_value = 1000.0
+        clock = Clock()
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_CIRCUIT_BREAKER_ENABLED"] = True
+        self.settings["ZYTE_SMARTPROXY_CIRCUIT_BREAKER_THRESHOLD"] = 2
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        slot = MockedSlot()
+        crawler.engine.downloader.slots["example.com"] = slot
+
+        def request():
+            req = Request("http://example.com", meta={"download_slot": "example.com"})
+            with patch("twisted.internet.reactor", clock, create=True):
+                return req, _deferred(mw.process_request(req, self.spider))
+
+        def fail(req):
+            with patch("twisted.internet.reactor", clock, create=True):
+                mw.process_exception(req, ConnectionRefusedError(), self.spider)
+
+        def succeed(req):
+            res = self._mock_zyte_smartproxy_response(req.url)
+            mw.process_response(req, res, self.spider)
+
+        def stat(state):
+            return crawler.stats.get_value("zyte_smartproxy/circuit/" + state)
+
+        # The circuit opens after 2 connection failures, instead of delaying
+        # slots.
+        req, _ = request()
+        fail(req)
+        self.assertEqual(stat("open"), None)
+        fail(req)
+        self.assertEqual(stat("open"), 1)
+        self.assertEqual(slot.delay, 0)
+
+        # While open, all proxied requests wait.
+        _, probe_wait = request()
+        _, wait = request()
+        probe_fired = []
+        probe_wait.addCallback(probe_fired.append)
+        fired = []
+        wait.addCallback(fired.append)
+
+        # After connection_refused_delay, 1 probe request is sent.
+        time_patch.return_value += mw.connection_refused_delay
+        clock.advance(mw.connection_refused_delay)
+        self.assertEqual(stat("half_open"), 1)
+        self.assertEqual(probe_fired, [None])
+        self.assertEqual(fired, [])
+
+        # A failed probe opens the circuit again.
+        fail(req)
+        self.assertEqual(stat("open"), 2)
+        time_patch.return_value += mw.connection_refused_delay
+        clock.advance(mw.connection_refused_delay)
+        self.assertEqual(stat("half_open"), 2)
+        self.assertEqual(fired, [None])
+
+        # A probe answered by something else than the proxy service, e.g. a
+        # load balancer, opens the circuit again.
+        mw.process_response(req, Response(req.url, status=502), self.spider)
+        self.assertEqual(stat("open"), 3)
+        time_patch.return_value += mw.connection_refused_delay
+        clock.advance(mw.connection_refused_delay)
+        self.assertIsNone(request()[1])
+        self.assertEqual(stat("half_open"), 3)
+
+        # If a probe gets no result, another one is sent after
+        # connection_refused_delay.
+        _, wait = request()
+        fired = []
+        wait.addCallback(fired.append)
+        time_patch.return_value += mw.connection_refused_delay - 1
+        clock.advance(mw.connection_refused_delay - 1)
+        self.assertEqual(fired, [])
+        time_patch.return_value += 1
+        clock.advance(1)
+        self.assertEqual(fired, [None])
+
+        # A successful probe closes the circuit.
+        _, wait = request()
+        fired = []
+        wait.addCallback(fired.append)
+        succeed(req)
+        self.assertEqual(stat("closed"), 1)
+        self.assertEqual(fired, [None])
+        assert request()[1] is None
+
+        # Pending wake-ups are cancelled quietly when the spider closes.
+        wakes = list(mw._waits)
+        self.assertTrue(wakes)
+        results = []
+        for wake in wakes:
+            wake.addBoth(results.append)
+        mw.spider_closed(self.spider)
+        self.assertEqual(results, [None] * len(wakes))
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_endpoints(self, time_patch):
+        time_patch.return_value = 1000.0
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_URLS"] = {
+            "http://proxy.zyte.com:8011": 2,
+            "api.zyte.com:8011": 1,
+            "http://otherkey:@proxy.example:8011": 1,
+        }
+        self.settings["ZYTE_SMARTPROXY_ENDPOINT_ERROR_THRESHOLD"] = 2
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        httpproxy = HttpProxyMiddleware.from_crawler(crawler)
+        slot = MockedSlot()
+        crawler.engine.downloader.slots["example.com"] = slot
+
+        def request():
+            req = Request("http://example.com", meta={"download_slot": "example.com"})
+            assert mw.process_request(req, self.spider) is None
+            assert httpproxy.process_request(req, self.spider) is None
+            return req
+
+        # Requests are spread by weighted least outstanding requests.
+        a = "http://proxy.zyte.com:8011"
+        b = "http://api.zyte.com:8011"
+        c = "http://proxy.example:8011"
+        reqs = [request() for _ in range(8)]
+        self.assertEqual(
+            [req.meta["proxy"] for req in reqs],
+            [a, a, b, c, a, a, b, c],
+        )
+        self.assertEqual(
+            [req.headers["Proxy-Authorization"] for req in reqs[1:4]],
+            [
+                basic_auth_header("apikey", ""),
+                basic_auth_header("apikey", ""),
+                basic_auth_header("otherkey", ""),
+            ],
+        )
+
+        # Each endpoint is classified as Zyte API or Smart Proxy Manager.
+        for req in reqs[:4]:
+            res = self._mock_zyte_smartproxy_response(req.url)
+            mw.process_response(req, res, self.spider)
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/response"), 3)
+        self.assertEqual(crawler.stats.get_value("zyte_api_proxy/response"), 1)
+        self.assertEqual(
+            [endpoint.outstanding for endpoint in mw._endpoints.endpoints],
+            [2, 1, 1],
+        )
+
+        def down():
+            return crawler.stats.get_value("zyte_smartproxy/endpoints/down")
+
+        # Connection errors and 5xx responses from outside the proxy service
+        # mark endpoints as down, without delaying slots.
+        for req in reqs[4:6]:
+            mw.process_exception(req, ConnectionRefusedError(), self.spider)
+        self.assertEqual(down(), 1)
+        self.assertEqual(slot.delay, 0)
+        mw.process_response(reqs[6], Response(b, status=502), self.spider)
+        req = request()
+        self.assertEqual(req.meta["proxy"], b)
+        mw.process_response(req, Response(b, status=500), self.spider)
+        self.assertEqual(down(), 2)
+        res = self._mock_zyte_smartproxy_response(
+            c, status=self.bancode, headers={"X-Crawlera-Error": "banned"}
+        )
+        retry = reqs[7].copy()
+        mw.process_response(reqs[7], res, self.spider)
+        self.assertEqual(down(), 2)
+
+        # Retries go to the remaining endpoint.
+        assert mw.process_request(retry, self.spider) is None
+        self.assertEqual(retry.meta["proxy"], "http://otherkey:@proxy.example:8011")
+
+        # Once all endpoints are down, slots are delayed.
+        mw.process_exception(retry, ConnectionRefusedError(), self.spider)
+        mw.process_exception(request(), ConnectionRefusedError(), self.spider)
+        self.assertEqual(down(), 3)
+        self.assertEqual(slot.delay, mw.connection_refused_delay)
+
+        # Proxies set by users are kept.
+        req = Request("http://example.com", meta={"proxy": "http://user.example"})
+        assert mw.process_request(req, self.spider) is None
+        self.assertEqual(req.meta["proxy"], "http://user.example")
+
+    def test_endpoint_weights(self):
+        self.spider.zyte_smartproxy_enabled = True
+
+        def open_spider(urls):
+            self.settings["ZYTE_SMARTPROXY_URLS"] = urls
+            mw = self.mwcls.from_crawler(self._mock_crawler(self.spider, self.settings))
+            mw.open_spider(self.spider)
+            return mw
+
+        # Endpoints with a weight of 0 are disabled.
+        mw = open_spider({"proxy.zyte.com:8011": 0, "api.zyte.com:8011": 1})
+        self.assertEqual(
+            [endpoint.url for endpoint in mw._endpoints.endpoints],
+            ["http://api.zyte.com:8011"],
+        )
+        req = Request("http://example.com")
+        assert mw.process_request(req, self.spider) is None
+        self.assertEqual(req.meta["proxy"], "http://apikey:@api.zyte.com:8011")
+
+        self.assertRaises(ValueError, open_spider, {"proxy.zyte.com:8011": 0})
+        self.assertRaises(ValueError, open_spider, {"proxy.zyte.com:8011": -1})
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_latency_histograms(self, time_patch):
+        time_patch.return_value = 1000.0
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_LATENCY_HISTOGRAMS_ENABLED"] = True
+        self.settings["ZYTE_SMARTPROXY_LATENCY_PER_SLOT"] = True
+        self.settings["ZYTE_SMARTPROXY_LATENCY_EXPORT_INTERVAL"] = 0
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        def fetch(latency, status=200, exception=None, url="http://example.com"):
+            time_patch.return_value = 1000.0
+            req = Request(url)
+            assert mw.process_request(req, self.spider) is None
+            req.meta["download_slot"] = urlparse(url).netloc
+            time_patch.return_value = 1000.0 + latency
+            if exception is not None:
+                mw.process_exception(req, exception, self.spider)
+            else:
+                res = self._mock_zyte_smartproxy_response(url, status=status)
+                mw.process_response(req, res, self.spider)
+
+        for latency in range(1, 101):
+            fetch(latency / 100.0)
+        fetch(2, status=503)
+        fetch(5, exception=ConnectionRefusedError())
+        fetch(0.5, url="http://example.org")
+
+        # Stats are only set at close time if there is no export interval.
+        assert crawler.stats.get_value("zyte_smartproxy/latency/2xx/count") is None
+        mw.spider_closed(self.spider)
+        stats = crawler.stats.get_stats()
+        self.assertEqual(stats["zyte_smartproxy/latency/2xx/count"], 101)
+        # Percentiles are upper bounds with less than 10% of error.
+        self.assertTrue(0.5 <= stats["zyte_smartproxy/latency/2xx/p50"] <= 0.55)
+        self.assertTrue(0.95 <= stats["zyte_smartproxy/latency/2xx/p95"] <= 1.0)
+        self.assertEqual(stats["zyte_smartproxy/latency/2xx/p99"], 1.0)
+        self.assertEqual(stats["zyte_smartproxy/latency/5xx/count"], 1)
+        self.assertEqual(stats["zyte_smartproxy/latency/5xx/p50"], 2.0)
+        self.assertEqual(stats["zyte_smartproxy/latency/exception/p99"], 5.0)
+        self.assertEqual(
+            stats["zyte_smartproxy/latency/slot/example.com/2xx/count"], 100
+        )
+        self.assertEqual(stats["zyte_smartproxy/latency/slot/example.org/2xx/p50"], 0.5)
+
+        # Per-slot histograms are kept for a limited number of slots, and only
+        # exported when the spider closes.
+        self.settings["ZYTE_SMARTPROXY_LATENCY_SLOTS_MAXSIZE"] = 1
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        fetch(1)
+        fetch(0.5, url="http://example.org")
+        mw._export_latency()
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/latency/2xx/count"), 2
+        )
+        assert (
+            crawler.stats.get_value(
+                "zyte_smartproxy/latency/slot/example.org/2xx/count"
+            )
+            is None
+        )
+        mw.spider_closed(self.spider)
+        stats = crawler.stats.get_stats()
+        self.assertNotIn("zyte_smartproxy/latency/slot/example.com/2xx/count", stats)
+        self.assertEqual(stats["zyte_smartproxy/latency/slot/example.org/2xx/count"], 1)
+        self.assertEqual(stats["zyte_smartproxy/state/evicted/latency"], 1)
+
+        # Requests not sent through the proxy are not measured.
+        self.spider.zyte_smartproxy_enabled = False
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        fetch(1)
+        mw.spider_closed(self.spider)
+        assert crawler.stats.get_value("zyte_smartproxy/latency/2xx/count") is None
+
+    def _metrics_crawler(self, exporter, address):
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_METRICS_EXPORTER"] = exporter
+        self.settings["ZYTE_SMARTPROXY_METRICS_ADDRESS"] = address
+        self.settings["ZYTE_SMARTPROXY_STATS_FLUSH_INTERVAL"] = 60
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        crawler.engine.downloader.slots["example.com"] = MockedSlot()
+        for status in (200, self.bancode):
+            req = Request("http://example.com", meta={"download_slot": "example.com"})
+            assert mw.process_request(req, self.spider) is None
+            headers = {"X-Crawlera-Error": "banned"} if status != 200 else {}
+            res = self._mock_zyte_smartproxy_response(
+                req.url, status=status, headers=headers
+            )
+            mw.process_response(req, res, self.spider)
+        return crawler, mw
+
+    def test_metrics_prometheus(self):
+        crawler, mw = self._metrics_crawler("prometheus", "127.0.0.1:0")
+        lines = mw._exporter.render().decode().splitlines()
+        # Buffered stat increments are included.
+        self.assertIn("# TYPE zyte_smartproxy_request_total counter", lines)
+        self.assertIn("zyte_smartproxy_request_total 2", lines)
+        self.assertIn("zyte_smartproxy_response_status_503_total 1", lines)
+        self.assertIn("# TYPE zyte_smartproxy_slot_bans gauge", lines)
+        self.assertIn('zyte_smartproxy_slot_bans{slot="example.com"} 1', lines)
+        mw.spider_closed(self.spider)
+        self.assertIsNone(mw._exporter)
+
+    def test_metrics_exporter_start_failure(self):
+        # e.g. another crawl on the same host already uses the port.
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        address = "127.0.0.1:%d" % server.getsockname()[1]
+        self.spider.download_delay = 5
+        with patch("scrapy_zyte_smartproxy.middleware.logger") as logger:
+            crawler, mw = self._metrics_crawler("prometheus", address)
+        logger.error.assert_called_once()
+        # The rest of the middleware is set up, without exporter.
+        self.assertIsNone(mw._exporter)
+        self.assertEqual(self.spider.download_delay, 0)
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/request"), None)
+        mw.spider_closed(self.spider)
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/request"), 2)
+
+    def test_metrics_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+        address = "127.0.0.1:%d" % server.getsockname()[1]
+        crawler, mw = self._metrics_crawler("statsd", address)
+        exporter = mw._exporter
+
+        exporter.push()
+        lines = server.recv(65536).decode().splitlines()
+        self.assertIn("zyte_smartproxy.request:2|c", lines)
+        self.assertIn("zyte_smartproxy.response.banned:1|c", lines)
+        self.assertIn("zyte_smartproxy.slot.bans.example_com:1|g", lines)
+
+        # Counters are sent as increments since the previous push, and
+        # unchanged counters are not sent.
+        req = Request("http://example.com")
+        mw.process_request(req, self.spider)
+        exporter.push()
+        lines = server.recv(65536).decode().splitlines()
+        self.assertIn("zyte_smartproxy.request:1|c", lines)
+        self.assertNotIn("zyte_smartproxy.response.banned:1|c", lines)
+
+        # Pending metrics are pushed when the spider closes.
+        mw.process_request(Request("http://example.com"), self.spider)
+        mw.spider_closed(self.spider)
+        lines = server.recv(65536).decode().splitlines()
+        self.assertIn("zyte_smartproxy.request:1|c", lines)
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_quarantine(self, time_patch):
+        time_patch.return_value = 1000.0
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_MAXBANS"] = 1
+        self.settings["ZYTE_SMARTPROXY_QUARANTINE_ENABLED"] = True
+        self.settings["ZYTE_SMARTPROXY_QUARANTINE_TIME"] = 100
+        self.settings["ZYTE_SMARTPROXY_QUARANTINE_MAX_TIME"] = 300
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        slots = crawler.engine.downloader.slots
+        slots.clear()
+        for domain in ("a.example", "b.example", "c.example"):
+            slots[domain] = MockedSlot()
+
+        def respond(domain, banned=True, error="banned"):
+            req = Request("http://" + domain, meta={"download_slot": domain})
+            assert mw.process_request(req, self.spider) is None
+            if banned:
+                res = self._mock_zyte_smartproxy_response(
+                    req.url,
+                    status=self.bancode,
+                    headers={"X-Crawlera-Error": error},
+                )
+            else:
+                res = self._mock_zyte_smartproxy_response(req.url)
+            mw.process_response(req, res, self.spider)
+
+        def stat(name):
+            return crawler.stats.get_value("zyte_smartproxy/quarantine/" + name)
+
+        # Slots are paused instead of closing the spider.
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 0)
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 100)
+        self.assertEqual(stat("slots"), 1)
+        self.assertIsNone(crawler.engine.fake_spider_closed_result)
+
+        # Responses to requests sent before the quarantine keep it as is,
+        # including successful and throttling responses.
+        time_patch.return_value = 1050.0
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 50)
+        respond("a.example", banned=False)
+        self.assertEqual(slots["a.example"].delay, 50)
+        self.assertIsNone(stat("released"))
+        time_patch.return_value = 1060.0
+        respond("a.example", error="noslaves")
+        self.assertEqual(slots["a.example"].delay, 40)
+
+        # Bans after the quarantine double it, up to the maximum. Non-ban
+        # responses reset the count of consecutive bans.
+        time_patch.return_value = 1100.0
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 0)
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 200)
+        time_patch.return_value = 1300.0
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 300)
+        self.assertEqual(stat("slots"), 1)
+
+        # A successful response after the quarantine ends it.
+        respond("a.example", banned=False)
+        self.assertEqual(slots["a.example"].delay, 300)
+        self.assertIsNone(stat("released"))
+        time_patch.return_value = 1600.0
+        respond("a.example", banned=False)
+        self.assertEqual(slots["a.example"].delay, 0)
+        self.assertEqual(stat("released"), 1)
+        respond("a.example")
+        respond("a.example")
+        self.assertEqual(slots["a.example"].delay, 100)
+
+        # The spider is closed once enough slots are in quarantine.
+        respond("b.example")
+        respond("b.example")
+        self.assertEqual(
+            crawler.engine.fake_spider_closed_result, (self.spider, "banned")
+        )
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_ban_window(self, time_patch):
+        time_patch.return_value = 1000.0
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_BAN_WINDOW"] = 10
+        self.settings["ZYTE_SMARTPROXY_BAN_RATIO"] = 0.8
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        crawler.engine.downloader.slots["example.com"] = MockedSlot()
+
+        def respond(banned):
+            req = Request("http://example.com", meta={"download_slot": "example.com"})
+            assert mw.process_request(req, self.spider) is None
+            if banned:
+                res = self._mock_zyte_smartproxy_response(
+                    req.url,
+                    status=self.bancode,
+                    headers={"X-Crawlera-Error": "banned"},
+                )
+            else:
+                res = self._mock_zyte_smartproxy_response(req.url)
+            mw.process_response(req, res, self.spider)
+
+        # Occasional successful responses do not hide a high ban ratio.
+        for banned in [True] * 4 + [False] + [True] * 4:
+            respond(banned)
+        self.assertIsNone(crawler.engine.fake_spider_closed_result)
+        respond(True)
+        self.assertEqual(
+            crawler.engine.fake_spider_closed_result, (self.spider, "banned")
+        )
+        window = mw._ban_windows["example.com"]
+        self.assertEqual(window.ratio, 0.9)
+        self.assertAlmostEqual(window.rate(1000.0), 9 / 60.0)
+
+        # Older responses leave the window.
+        crawler.engine.fake_spider_closed_result = None
+        for _ in range(3):
+            respond(False)
+        respond(True)
+        self.assertEqual(window.ratio, 0.6)
+        self.assertIsNone(crawler.engine.fake_spider_closed_result)
+
+        # Ban ratios and rates are set in stats when the spider closes.
+        name = "zyte_smartproxy/ban_window/slot/example.com/"
+        mw._flush_stats()
+        self.assertIsNone(crawler.stats.get_value(name + "ratio"))
+        mw.spider_closed(self.spider)
+        stats = crawler.stats.get_stats()
+        self.assertEqual(stats[name + "ratio"], 0.6)
+        self.assertEqual(stats[name + "rate"], round(window.rate(1000.0), 3))
+
+        # Slots in quarantine are released once their ban ratio drops below
+        # half of the maximum ban ratio, not on the first successful response.
+        self.settings["ZYTE_SMARTPROXY_QUARANTINE_ENABLED"] = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        crawler.engine.downloader.slots["example.com"] = MockedSlot()
+        for _ in range(10):
+            respond(True)
+        self.assertIn("example.com", mw._quarantines)
+        slot = crawler.engine.downloader.slots["example.com"]
+        self.assertEqual(slot.delay, mw.quarantine_time)
+        for _ in range(6):
+            respond(False)
+        self.assertIn("example.com", mw._quarantines)
+        self.assertEqual(slot.delay, mw.quarantine_time)
+        respond(False)
+        self.assertNotIn("example.com", mw._quarantines)
+        self.assertEqual(slot.delay, 0)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/quarantine/released"), 1
+        )
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_state_backend(self, time_patch):
+        time_patch.return_value = 1000.0
+        path = os.path.join(tempfile.mkdtemp(), "state")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.settings["ZYTE_SMARTPROXY_STATE_BACKEND"] = (
+            "scrapy_zyte_smartproxy.state.MmapStateBackend"
+        )
+        self.settings["ZYTE_SMARTPROXY_STATE_MMAP_PATH"] = path
+        self.settings["ZYTE_SMARTPROXY_MAXBANS"] = 1
+        self.settings["ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES"] = [403]
+        self.spider.zyte_smartproxy_enabled = True
+        crawler_a = self._mock_crawler(self.spider, self.settings)
+        crawler_b = self._mock_crawler(self.spider, self.settings)
+        mw_a = self.mwcls.from_crawler(crawler_a)
+        mw_b = self.mwcls.from_crawler(crawler_b)
+        mw_a.open_spider(self.spider)
+        mw_b.open_spider(self.spider)
+        self.addCleanup(mw_a.spider_closed, self.spider)
+        self.addCleanup(mw_b.spider_closed, self.spider)
+        slot_a, slot_b = MockedSlot(), MockedSlot()
+        crawler_a.engine.downloader.slots["example.com"] = slot_a
+        crawler_b.engine.downloader.slots["example.com"] = slot_b
+
+        def respond(mw, **kwargs):
+            req = Request("http://example.com", meta={"download_slot": "example.com"})
+            assert mw.process_request(req, self.spider) is None
+            res = self._mock_zyte_smartproxy_response(req.url, **kwargs)
+            return mw.process_response(req, res, self.spider)
+
+        def shared_delays(crawler):
+            return crawler.stats.get_value("zyte_smartproxy/state/shared_delay")
+
+        # The backend is not called while handling responses.
+        ban = {"status": self.bancode, "headers": {"X-Crawlera-Error": "banned"}}
+        with patch.object(mw_a, "_state", Mock(wraps=mw_a._state)) as mock_state:
+            respond(mw_a, **ban)
+            respond(mw_a)
+            respond(
+                mw_a,
+                status=503,
+                headers={"X-Crawlera-Error": "noslaves", "Retry-After": "30"},
+            )
+        self.assertEqual(mock_state.method_calls, [])
+        self.assertEqual(slot_a.delay, 30)
+
+        # Delays are periodically applied to the slots of other processes,
+        # until their end.
+        mw_a._sync_state()
+        self.assertIsNone(shared_delays(crawler_a))
+        time_patch.return_value = 1010.0
+        mw_b._sync_state()
+        self.assertEqual(slot_b.delay, 20)
+        self.assertEqual(shared_delays(crawler_b), 1)
+        mw_b._sync_state()
+        self.assertEqual(shared_delays(crawler_b), 1)
+        respond(mw_b)
+        self.assertEqual(slot_b.delay, 0)
+
+        # Consecutive bans are counted across processes, as of their last
+        # sync.
+        time_patch.return_value = 1030.0
+        respond(mw_a, **ban)
+        self.assertIsNone(crawler_a.engine.fake_spider_closed_result)
+        mw_a._sync_state()
+        respond(mw_b, **ban)
+        self.assertIsNone(crawler_b.engine.fake_spider_closed_result)
+        mw_b._sync_state()
+        self.assertEqual(mw_b._state.get("bans:example.com"), 2)
+        respond(mw_b, **ban)
+        self.assertEqual(
+            crawler_b.engine.fake_spider_closed_result, (self.spider, "banned")
+        )
+        respond(mw_a)
+        mw_a._sync_state()
+        self.assertIsNone(mw_a._state.get("bans:example.com"))
+
+        # Shared ban counts are only reset by processes that counted bans.
+        with patch.object(mw_a._state, "delete") as delete:
+            respond(mw_a)
+            mw_a._sync_state()
+        delete.assert_not_called()
+
+        # Sync failures are logged, without raising.
+        with patch.object(mw_a._state, "smembers", side_effect=OSError("boom")):
+            with patch("scrapy_zyte_smartproxy.middleware.logger") as logger:
+                mw_a._sync_state()
+        logger.warning.assert_called_once()
+
+        # Responses without a download slot, e.g. cached ones, are not shared.
+        req = Request("http://example.com")
+        res = self._mock_zyte_smartproxy_response(req.url, **ban)
+        mw_a.process_response(req, res, self.spider)
+        mw_a.process_response(
+            req, self._mock_zyte_smartproxy_response(req.url), self.spider
+        )
+
+        # Force-enabled domains are shared.
+        mw_a.enabled = mw_b.enabled = False
+        req = Request("http://example.org")
+        res = Response(req.url, status=403)
+        self.assertIsInstance(mw_a.process_response(req, res, self.spider), Request)
+        mw_b._sync_state()
+        self.assertFalse(mw_b._is_enabled_for_request(req))
+        mw_a._sync_state()
+        mw_b._sync_state()
+        self.assertTrue(mw_b._is_enabled_for_request(req))
+
+        # Without periodic syncs, nothing would be shared.
+        self.settings["ZYTE_SMARTPROXY_STATE_SYNC_INTERVAL"] = 0
+        mw = self.mwcls.from_crawler(self._mock_crawler(self.spider, self.settings))
+        with pytest.raises(ValueError):
+            mw.open_spider(self.spider)
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_rate_limit(self, time_patch):
+        time_patch.return_value = 1000.0
+        clock = Clock()
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_RATE_LIMIT"] = 10
+        self.settings["ZYTE_SMARTPROXY_RATE_LIMIT_BURST"] = 2
+        self.settings["ZYTE_SMARTPROXY_RATE_LIMIT_BY_TARGET"] = {"zyte_api": 1}
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        def request(**meta):
+            req = Request("http://example.com", meta=meta)
+            with patch("twisted.internet.reactor", clock, create=True):
+                return _deferred(mw.process_request(req, self.spider))
+
+        # Requests beyond the burst capacity wait for tokens, in order.
+        self.assertIsNone(request())
+        self.assertIsNone(request())
+        first = request()
+        second = request()
+        self.assertIsInstance(first, Deferred)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/rate_limit/delayed"), 2
+        )
+        clock.advance(0.15)
+        self.assertTrue(first.called)
+        self.assertFalse(second.called)
+        clock.advance(0.1)
+        self.assertTrue(second.called)
+
+        # Per-target limits apply on top of the account limit.
+        time_patch.return_value = 1010.0
+        zapi = {"proxy": "http://apikey:@api.zyte.com:8011"}
+        self.assertIsNone(request(**zapi))
+        self.assertIsNone(request(**zapi))
+        deferred = request(**zapi)
+        self.assertIsInstance(deferred, Deferred)
+        self.assertEqual(
+            crawler.stats.get_value("zyte_api_proxy/rate_limit/delayed"), 1
+        )
+        clock.advance(0.95)
+        self.assertFalse(deferred.called)
+        clock.advance(0.1)
+        self.assertTrue(deferred.called)
+
+        self.settings["ZYTE_SMARTPROXY_RATE_LIMIT_BY_TARGET"] = {"zapi": 1}
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        with pytest.raises(ValueError):
+            mw.open_spider(self.spider)
+
+    @pytest.mark.skipif(
+        version_info < (2, 6), reason="Deferreds are returned before Scrapy 2.6"
+    )
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_wait_coroutine(self, time_patch):
+        time_patch.return_value = 1000.0
+        clock = Clock()
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_RATE_LIMIT"] = 1
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        # Waits are returned as coroutines, which Scrapy 2.14 and later await
+        # without deprecation warnings.
+        with patch("twisted.internet.reactor", clock, create=True):
+            self.assertIsNone(
+                mw.process_request(Request("http://example.com"), self.spider)
+            )
+            result = mw.process_request(Request("http://example.com"), self.spider)
+        self.assertNotIsInstance(result, Deferred)
+        self.assertTrue(hasattr(result, "__await__"))
+        fired = []
+        _deferred(result).addCallback(fired.append)
+        clock.advance(1)
+        self.assertEqual(fired, [None])
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_domains_file(self, time_patch):
+        time_patch.return_value = 1000.0
+        path = os.path.join(tempfile.mkdtemp(), "domains.json.gz")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        self.spider.zyte_smartproxy_enabled = False
+        self.settings["ZYTE_SMARTPROXY_DOMAINS_FILE"] = path
+        self.settings["ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES"] = [403]
+
+        def run(*domains):
+            crawler = self._mock_crawler(self.spider, self.settings)
+            mw = self.mwcls.from_crawler(crawler)
+            mw.open_spider(self.spider)
+            for domain in domains:
+                req = Request("http://" + domain)
+                res = Response(req.url, status=403)
+                mw.process_response(req, res, self.spider)
+            mw.spider_closed(self.spider)
+            return crawler, mw
+
+        # Domains learned in a job are enabled in the next ones.
+        run("a.example", "b.example")
+        crawler, mw = run()
+        self.assertEqual(
+            crawler.stats.get_value("zyte_smartproxy/domains_file/loaded"), 2
+        )
+        self.assertTrue(mw._is_enabled_for_request(Request("http://a.example")))
+        self.assertTrue(mw._is_enabled_for_request(Request("http://b.example")))
+
+        # Domains expire after their TTL, and are learned again if needed.
+        time_patch.return_value = 1010.0
+        run("c.example")
+        self.settings["ZYTE_SMARTPROXY_DOMAINS_FILE_TTL"] = 5
+        time_patch.return_value = 1012.0
+        crawler, mw = run()
+        self.assertFalse(mw._is_enabled_for_request(Request("http://a.example")))
+        self.assertTrue(mw._is_enabled_for_request(Request("http://c.example")))
+
+        # Unreadable files are ignored, and are overwritten at close time.
+        with open(path, "wb") as f:
+            f.write(b"not gzip")
+        with patch("scrapy_zyte_smartproxy.middleware.logger") as logger:
+            run("d.example")
+        self.assertEqual(logger.warning.call_count, 1)
+        crawler, mw = run()
+        self.assertTrue(mw._is_enabled_for_request(Request("http://d.example")))
+
+        # Domains saved by other processes since the start of a job are kept.
+        self.settings["ZYTE_SMARTPROXY_DOMAINS_FILE_TTL"] = 0
+        os.remove(path)
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        run("e.example")
+        req = Request("http://f.example")
+        mw.process_response(req, Response(req.url, status=403), self.spider)
+        mw.spider_closed(self.spider)
+        self.assertEqual(set(load_domains(path)), {"e.example", "f.example"})
+
+        # Domains learned during a job are bounded.
+        self.settings["ZYTE_SMARTPROXY_DOMAINS_FILE_MAXSIZE"] = 3
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+        for domain in ("g.example", "h.example", "i.example"):
+            time_patch.return_value += 1
+            req = Request("http://" + domain)
+            mw.process_response(req, Response(req.url, status=403), self.spider)
+        self.assertEqual(
+            sorted(mw._learned_domains), ["g.example", "h.example", "i.example"]
+        )
+        mw.spider_closed(self.spider)
+        self.assertEqual(
+            set(load_domains(path)), {"g.example", "h.example", "i.example"}
+        )
+
+        # The file is not used if the middleware is enabled for all requests.
+        self.spider.zyte_smartproxy_enabled = True
+        crawler, mw = run()
+        self.assertIsNone(
+            crawler.stats.get_value("zyte_smartproxy/domains_file/loaded")
+        )
+
+    @patch("scrapy_zyte_smartproxy.middleware.time")
+    def test_aimd(self, time_patch):
+        time_patch.return_value = 1000.0
+        self.spider.zyte_smartproxy_enabled = True
+        self.settings["ZYTE_SMARTPROXY_AIMD_ENABLED"] = True
+        self.settings["ZYTE_SMARTPROXY_AIMD_MIN_CONCURRENCY"] = 2
+        self.settings["ZYTE_SMARTPROXY_AIMD_MAX_CONCURRENCY"] = 5
+        self.settings["ZYTE_SMARTPROXY_AIMD_TARGET_LATENCY"] = 10
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        slot = MockedSlot(concurrency=8)
+        crawler.engine.downloader.slots["example.com"] = slot
+
+        def respond(latency=0.1, **kwargs):
+            req = Request(
+                "http://example.com",
+                meta={"download_slot": "example.com", "download_latency": latency},
+            )
+            assert mw.process_request(req, self.spider) is None
+            res = self._mock_zyte_smartproxy_response(req.url, **kwargs)
+            mw.process_response(req, res, self.spider)
+
+        throttle_kwargs = {
+            "status": 429,
+            "headers": {"Zyte-Error-Type": "/limits/over-domain-limit"},
+        }
+
+        # Throttling halves concurrency.
+        respond(**throttle_kwargs)
+        self.assertEqual(slot.concurrency, 4)
+
+        # Throttling responses to requests sent before the last decrease are
+        # ignored.
+        respond(latency=5, **throttle_kwargs)
+        self.assertEqual(slot.concurrency, 4)
+
+        # Successful responses increase concurrency by 1 per window.
+        for _ in range(3):
+            respond()
+        self.assertEqual(slot.concurrency, 4)
+        respond()
+        self.assertEqual(slot.concurrency, 5)
+
+        # Concurrency does not grow past the maximum.
+        for _ in range(10):
+            respond()
+        self.assertEqual(slot.concurrency, 5)
+
+        # High latency counts as congestion, and concurrency does not go below
+        # the minimum.
+        time_patch.return_value += 60
+        respond(latency=11)
+        self.assertEqual(slot.concurrency, 2)
+        respond(latency=0, **throttle_kwargs)
+        self.assertEqual(slot.concurrency, 2)
+
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/aimd/decrease"), 2)
+        self.assertEqual(crawler.stats.get_value("zyte_smartproxy/aimd/increase"), 1)
+
+    def test_aimd_disabled(self):
+        self.spider.zyte_smartproxy_enabled = True
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        slot = MockedSlot(concurrency=8)
+        crawler.engine.downloader.slots["example.com"] = slot
+        req = Request("http://example.com", meta={"download_slot": "example.com"})
+        assert mw.process_request(req, self.spider) is None
+        res = self._mock_zyte_smartproxy_response(
+            req.url, status=503, headers={"X-Crawlera-Error": "noslaves"}
+        )
+        mw.process_response(req, res, self.spider)
+        self.assertEqual(slot.concurrency, 8)
+
     @patch("random.uniform")
     def test_auth_error_retries(self, random_uniform_patch):
         # mock random.uniform to just return the max delay
@@ -941,6 +2387,141 @@ class ZyteSmartProxyMiddlewareTestCase(TestCase):
         self.assertEqual(mw.enabled_for_domain["scrapy.org"], True)
         self.assertEqual(mw.crawler.stats.get_value("zyte_smartproxy/request"), 2)
 
+    def test_force_enable_subdomains(self):
+        self.spider.zyte_smartproxy_enabled = False
+        self.settings["ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES"] = [403]
+        self.settings["ZYTE_SMARTPROXY_STATE_MAXSIZE"] = 2
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        def enabled(url):
+            return mw._is_enabled_for_request(Request(url))
+
+        req = Request("http://shop.example.com:8080/a")
+        res = Response(req.url, status=403)
+        self.assertIsInstance(mw.process_response(req, res, self.spider), Request)
+        self.assertEqual(mw.enabled_for_domain, {"shop.example.com": True})
+
+        # Other ports and subdomains are enabled, parent domains are not.
+        self.assertTrue(enabled("https://shop.example.com/b"))
+        self.assertTrue(enabled("http://www.shop.example.com"))
+        self.assertTrue(enabled("http://cdn.eu.SHOP.example.com"))
+        self.assertFalse(enabled("http://example.com"))
+        self.assertFalse(enabled("http://othershop.example.com"))
+
+        # Evicted domains stop matching subdomains.
+        for domain in ("a.example", "b.example"):
+            req = Request("http://" + domain)
+            mw.process_response(req, Response(req.url, status=403), self.spider)
+        self.assertFalse(enabled("http://www.shop.example.com"))
+        self.assertEqual(len(mw._enabled_domain_index), 2)
+
+    @patch("random.uniform")
+    def test_domain_policies(self, random_uniform_patch):
+        random_uniform_patch.side_effect = lambda x, y: y
+        self.spider.zyte_smartproxy_enabled = False
+        self.settings["ZYTE_SMARTPROXY_DOWNLOAD_TIMEOUT"] = 60
+        self.settings["ZYTE_SMARTPROXY_BACKOFF_STEP"] = 15
+        self.settings["ZYTE_SMARTPROXY_MAXBANS"] = 100
+        self.settings["ZYTE_SMARTPROXY_DEFAULT_HEADERS"] = {
+            "X-Crawlera-Profile": "desktop",
+            "X-Crawlera-Cookies": "disable",
+        }
+        self.settings["ZYTE_SMARTPROXY_DOMAIN_POLICIES"] = {
+            "render.example": {
+                "enabled": True,
+                "download_timeout": 600,
+                "headers": {"x-crawlera-profile": "mobile", "X-Crawlera-Cookies": None},
+            },
+            "fragile.example": {"enabled": True, "backoff_step": 60, "maxbans": 1},
+            "skip.fragile.example": {"enabled": False},
+        }
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        # Policies enable domains, and their subdomains, even if the
+        # middleware is disabled.
+        req = Request("http://www.render.example", headers={"X-Foo": "bar"})
+        self.assertIsNone(mw.process_request(req, self.spider))
+        self.assertEqual(req.meta["proxy"], "http://apikey:@proxy.zyte.com:8011")
+        self.assertEqual(req.meta["download_timeout"], 600)
+        self.assertEqual(req.headers["X-Crawlera-Profile"], b"mobile")
+        self.assertNotIn("X-Crawlera-Cookies", req.headers)
+        self.assertFalse(mw._is_enabled_for_request(Request("http://other.example")))
+        self.assertFalse(
+            mw._is_enabled_for_request(Request("http://a.skip.fragile.example"))
+        )
+
+        # Backoff and ban settings.
+        slot = MockedSlot()
+        crawler.engine.downloader.slots["fragile.example"] = slot
+        req = Request(
+            "http://fragile.example", meta={"download_slot": "fragile.example"}
+        )
+        self.assertIsNone(mw.process_request(req, self.spider))
+        self.assertEqual(req.meta["download_timeout"], 60)
+        self.assertEqual(req.headers["X-Crawlera-Profile"], b"desktop")
+        res = self._mock_zyte_smartproxy_response(
+            req.url, status=503, headers={"X-Crawlera-Error": "noslaves"}
+        )
+        mw.process_response(req, res, self.spider)
+        self.assertEqual(slot.delay, 60)
+        res = self._mock_zyte_smartproxy_response(
+            req.url, status=mw.ban_code, headers={"X-Crawlera-Error": "banned"}
+        )
+        mw.process_response(req, res, self.spider)
+        self.assertIsNone(crawler.engine.fake_spider_closed_result)
+        mw.process_response(req, res, self.spider)
+        self.assertEqual(
+            crawler.engine.fake_spider_closed_result, (self.spider, "banned")
+        )
+
+        # Policies can also disable domains.
+        self.spider.zyte_smartproxy_enabled = True
+        mw.open_spider(self.spider)
+        self.assertTrue(mw._is_enabled_for_request(Request("http://other.example")))
+        self.assertFalse(
+            mw._is_enabled_for_request(Request("http://skip.fragile.example"))
+        )
+
+        self.settings["ZYTE_SMARTPROXY_DOMAIN_POLICIES"] = {
+            "example.com": {"timeout": 10}
+        }
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        self.assertRaises(ValueError, mw.open_spider, self.spider)
+
+    def test_request_domain_parsing(self):
+        url = "https://scrapy.org"
+
+        self.spider.zyte_smartproxy_enabled = False
+        self.settings["ZYTE_SMARTPROXY_FORCE_ENABLE_ON_HTTP_CODES"] = [403]
+        crawler = self._mock_crawler(self.spider, self.settings)
+        mw = self.mwcls.from_crawler(crawler)
+        mw.open_spider(self.spider)
+
+        # No URL parsing while no domain has been enabled.
+        req = Request(url)
+        with patch("scrapy.utils.httpobj.urlparse") as urlparse_patch:
+            mw.process_request(req, self.spider)
+            mw.process_response(req, Response(url), self.spider)
+            mw.process_exception(req, ConnectionDone(), self.spider)
+        urlparse_patch.assert_not_called()
+
+        mw.enabled_for_domain["scrapy.org"] = True
+
+        # The URL of a request is parsed only once.
+        req = Request(url)
+        with patch("scrapy.utils.httpobj.urlparse", wraps=urlparse) as urlparse_patch:
+            mw.process_request(req, self.spider)
+            res = self._mock_zyte_smartproxy_response(url)
+            mw.process_response(req, res, self.spider)
+            mw.process_exception(req, ConnectionDone(), self.spider)
+        self.assertEqual(urlparse_patch.call_count, 1)
+        self.assertIsNotNone(req.meta.get("proxy"))
+
     def test_process_response_from_file_scheme(self):
         url = "file:///tmp/foobar.txt"
 
@@ -1535,3 +3116,453 @@ def test_request_headers(settings, input_headers, output_headers, warnings, capl
             assert warning in caplog.text
     else:
         assert not caplog.records
+
+
+@pytest.mark.parametrize(
+    ("settings", "output_headers"),
+    (
+        (
+            {},
+            {
+                b"Foo": b"Bar",
+                b"X-Crawlera-Profile": b"desktop",
+                b"X-Crawlera-Session": b"create",
+                b"X-Crawlera-Region": b"US",
+                b"X-Crawlera-Timeout": b"40000",
+            },
+        ),
+        (
+            {"ZYTE_SMARTPROXY_URL": "http://api.zyte.com:8011"},
+            {
+                b"Foo": b"Bar",
+                b"Zyte-Device": b"desktop",
+                b"Zyte-Geolocation": b"US",
+                b"X-Crawlera-Session": b"create",
+                b"Zyte-Foo": b"Bar",
+            },
+        ),
+        (
+            {"ZYTE_SMARTPROXY_ENABLED": False},
+            {b"Foo": b"Bar"},
+        ),
+    ),
+)
+def test_request_headers_mixed(settings, output_headers):
+    settings = _merge_dicts(
+        {
+            "ZYTE_SMARTPROXY_APIKEY": "apikey",
+            "ZYTE_SMARTPROXY_ENABLED": True,
+        },
+        settings,
+    )
+    crawler = get_crawler(settings_dict=settings)
+    mw = ZyteSmartProxyMiddleware.from_crawler(crawler)
+    spider = Spider("foo")
+    mw.open_spider(spider)
+
+    request = Request(
+        url="https://example.com",
+        headers={
+            b"Foo": b"Bar",
+            b"Zyte-Device": b"desktop",
+            b"Zyte-Geolocation": b"US",
+            b"X-Crawlera-Session": b"create",
+            b"X-Crawlera-Timeout": b"40000",
+            b"Zyte-Foo": b"Bar",
+        },
+    )
+    assert mw.process_request(request, spider) is None
+    actual_headers = {
+        k: b"".join(vs)
+        for k, vs in request.headers.items()
+        if k not in {b"X-Crawlera-Client", b"Zyte-Client"}
+    }
+    assert actual_headers == output_headers
+
+
+def test_header_warnings_aggregated(caplog):
+    crawler = get_crawler(
+        settings_dict={
+            "ZYTE_SMARTPROXY_APIKEY": "apikey",
+            "ZYTE_SMARTPROXY_ENABLED": True,
+        }
+    )
+    mw = ZyteSmartProxyMiddleware.from_crawler(crawler)
+    spider = Spider("foo")
+    mw.open_spider(spider)
+
+    caplog.clear()
+    with caplog.at_level("WARNING"):
+        for _ in range(3):
+            request = Request(url="https://example.com", headers={"Zyte-Foo": "Bar"})
+            assert mw.process_request(request, spider) is None
+            assert b"Zyte-Foo" not in request.headers
+    assert len(caplog.records) == 1
+    assert "Dropping header b'Zyte-Foo' (b'Bar')" in caplog.text
+    assert crawler.stats.get_value("zyte_smartproxy/headers/dropped/zyte-foo") == 3
+
+    caplog.clear()
+    with caplog.at_level("WARNING"):
+        mw.spider_closed(spider)
+    assert len(caplog.records) == 1
+    assert (
+        "Header b'Zyte-Foo' dropped on requests proxied with Zyte Smart Proxy "
+        "Manager (2 more times since it was last reported)."
+    ) in caplog.text
+
+    # Reports only include warnings that occurred since the last report.
+    caplog.clear()
+    with caplog.at_level("WARNING"):
+        mw.spider_closed(spider)
+    assert not caplog.records
+
+
+@patch("scrapy_zyte_smartproxy.utils.time")
+def test_header_warnings_interval(time_patch, caplog):
+    time_patch.return_value = 1000.0
+    crawler = get_crawler(
+        settings_dict={
+            "ZYTE_SMARTPROXY_APIKEY": "apikey",
+            "ZYTE_SMARTPROXY_ENABLED": False,
+            "ZYTE_SMARTPROXY_WARNING_INTERVAL": 60,
+        }
+    )
+    mw = ZyteSmartProxyMiddleware.from_crawler(crawler)
+    spider = Spider("foo")
+    mw.open_spider(spider)
+
+    caplog.clear()
+    with caplog.at_level("WARNING"):
+        for _ in range(3):
+            request = Request(url="https://example.com", headers={"Zyte-Foo": "Bar"})
+            assert mw.process_request(request, spider) is None
+        assert len(caplog.records) == 1
+        time_patch.return_value += 60
+        request = Request(url="https://example.com", headers={"Zyte-Foo": "Bar"})
+        assert mw.process_request(request, spider) is None
+    assert len(caplog.records) == 2
+    assert (
+        "Header b'Zyte-Foo' dropped on requests not handled by "
+        "scrapy-zyte-smartproxy (3 more times since it was last reported)."
+    ) in caplog.text
+
+
+def test_benchmarks():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (root, env.get("PYTHONPATH")) if path
+    )
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            os.path.join(root, "benchmarks", "bench_middleware.py"),
+            "--number",
+            "10",
+            "--repeat",
+            "1",
+        ],
+        env=env,
+    )
+    assert b"process_request_spm" in output
+    assert b"process_exception_connection_refused" in output
+
+
+@pytest.mark.parametrize(
+    ("args", "expected_statuses", "expected_reason"),
+    (
+        ([], {"200": 20}, "finished"),
+        (
+            ["--ban", "1", "--domains", "1", "-s", "ZYTE_SMARTPROXY_MAXBANS=2"],
+            None,
+            "banned",
+        ),
+    ),
+)
+def test_loadtest(args, expected_statuses, expected_reason):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output(
+        [
+            sys.executable,
+            os.path.join(root, "benchmarks", "loadtest.py"),
+            "--requests",
+            "20",
+            "--json",
+        ]
+        + args,
+    )
+    result = json.loads(output.decode().splitlines()[-1])
+    assert result["finish_reason"] == expected_reason
+    if expected_statuses is not None:
+        assert result["statuses"] == expected_statuses
+        assert result["middleware_stats"]["zyte_smartproxy/request"] == 20
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (
+        (None, None),
+        (b"", None),
+        (b"1.5", 1.5),
+        ("120", 120.0),
+        (b"-1", 0.0),
+        (b"nan", None),
+        (b"soon", None),
+        (b"Wed, 21 Oct 2015 07:28:30 GMT", 30.0),
+        (b"Wed, 21 Oct 2015 07:27:00 GMT", 0.0),
+    ),
+)
+def test_parse_retry_after(value, expected):
+    # 2015-10-21 07:28:00 UTC
+    assert parse_retry_after(value, now=1445412480) == expected
+
+
+def test_circuit_breaker():
+    circuit = CircuitBreaker(threshold=2, window=10, open_time=30, probes=2)
+    assert circuit.allow(0)
+    assert circuit.record_success(0) is None
+    assert circuit.record_failure(0) is None
+    # Failures outside the window do not count.
+    assert circuit.record_failure(11) is None
+    assert circuit.record_failure(12) == CircuitBreaker.OPEN
+    assert not circuit.allow(41)
+    assert circuit.record_failure(41) is None
+    assert circuit.allow(42)
+    assert circuit.state == CircuitBreaker.HALF_OPEN
+    assert circuit.allow(42)
+    assert not circuit.allow(42)
+    assert circuit.record_failure(43) == CircuitBreaker.OPEN
+    assert not circuit.allow(72)
+    assert circuit.allow(73)
+    assert circuit.record_success(74) == CircuitBreaker.CLOSED
+    assert circuit.allow(74)
+    assert circuit.record_failure(74) is None
+    # Probes without a result are replaced after open_time.
+    assert circuit.record_failure(75) == CircuitBreaker.OPEN
+    assert circuit.allow(105)
+    assert circuit.allow(106)
+    assert not circuit.allow(134)
+    assert circuit.allow(135)
+    assert circuit.allow(135)
+    assert not circuit.allow(135)
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram(min_value=0.001, max_value=10)
+    assert histogram.percentile(50) is None
+    for value in (0, 0.0005, 0.002, 0.1, 3, 20):
+        histogram.record(value)
+    assert histogram.count == 6
+    assert histogram.percentile(0) == 0.001
+    assert histogram.percentile(33) == 0.001
+    assert 0.002 <= histogram.percentile(50) <= 0.002 * 2**0.125
+    assert 0.1 <= histogram.percentile(60) <= 0.1 * 2**0.125
+    # Values over max_value are reported as the maximum recorded value.
+    assert histogram.percentile(100) == 20
+
+
+def test_ban_window():
+    window = BanWindow(size=3, period=10)
+    assert window.ratio == 0.0
+    assert window.rate(0) == 0.0
+    window.record(True, 0)
+    window.record(False, 0)
+    assert not window.full
+    assert window.ratio == 0.5
+    assert window.rate(0) == 0.1
+    assert abs(window.rate(10) - 0.1 / math.e) < 1e-9
+    window.record(True, 10)
+    window.record(True, 10)
+    assert window.full
+    assert window.ratio == 2 / 3.0
+    window.record(True, 10)
+    assert window.ratio == 1.0
+    assert window.count == 3
+
+
+class FakeRedis(object):
+    """Minimal stand-in for redis.Redis."""
+
+    def __init__(self):
+        self.data = {}
+
+    def _get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= state.time():
+            del self.data[key]
+            return None
+        return value
+
+    def get(self, key):
+        value = self._get(key)
+        return None if value is None else str(value).encode()
+
+    def set(self, key, value, px=None):
+        expires = None if px is None else state.time() + px / 1000.0
+        self.data[key] = (value, expires)
+
+    def incr(self, key, amount=1):
+        value = int(self._get(key) or 0) + amount
+        self.data[key] = (value, None)
+        return value
+
+    def pexpire(self, key, px):
+        self.data[key] = (self.data[key][0], state.time() + px / 1000.0)
+
+    def pttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expires = self.data[key][1]
+        return -1 if expires is None else int((expires - state.time()) * 1000)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def sadd(self, key, member):
+        if self._get(key) is None:
+            self.data[key] = (set(), None)
+        self.data[key][0].add(member.encode())
+
+    def smembers(self, key):
+        return set(self._get(key) or ())
+
+
+@pytest.fixture(params=["memory", "mmap", "redis"])
+def state_backend(request, tmp_path):
+    if request.param == "memory":
+        backend = MemoryStateBackend()
+    elif request.param == "mmap":
+        backend = MmapStateBackend(str(tmp_path / "state"), capacity=8)
+    else:
+        backend = RedisStateBackend(FakeRedis())
+    yield backend
+    backend.close()
+
+
+@patch("scrapy_zyte_smartproxy.state.time")
+def test_state_backends(time_patch, state_backend):
+    time_patch.return_value = 1000.0
+    assert state_backend.get("a") is None
+    state_backend.set("a", 1.5)
+    state_backend.set("b", 2, ttl=10)
+    assert state_backend.get("a") == 1.5
+    assert state_backend.get("b") == 2.0
+    assert state_backend.incr("c", ttl=10) == 1
+    assert state_backend.incr("c", ttl=20) == 2
+    assert state_backend.incr("d", amount=3) == 3
+    assert state_backend.incr("d", amount=2) == 5
+    time_patch.return_value = 1010.0
+    assert state_backend.get("b") is None
+    assert state_backend.get("c") == 2.0
+    state_backend.delete("a")
+    state_backend.delete("missing")
+    assert state_backend.get("a") is None
+    assert state_backend.incr("a") == 1
+    assert state_backend.smembers("domains") == set()
+    state_backend.sadd("domains", "example.com")
+    state_backend.sadd("domains", "example.org")
+    state_backend.sadd("domains", "example.com")
+    assert state_backend.smembers("domains") == {"example.com", "example.org"}
+    # Members are kept for at least their ttl.
+    state_backend.sadd("slots", "a", ttl=10)
+    state_backend.sadd("slots", "b", ttl=20)
+    time_patch.return_value = 1025.0
+    assert "b" in state_backend.smembers("slots")
+    time_patch.return_value = 1030.0
+    assert state_backend.smembers("slots") == set()
+
+
+def test_mmap_state_backend_shared(tmp_path):
+    path = str(tmp_path / "state")
+    a = MmapStateBackend(path, capacity=4)
+    b = MmapStateBackend(path, capacity=4)
+    a.incr("bans:example.com")
+    assert b.incr("bans:example.com") == 2
+    # Long keys are hashed.
+    b.set("x" * 300, 1)
+    assert a.get("x" * 300) == 1.0
+    # New keys are not stored once the table is full.
+    for key in ("d", "e", "f"):
+        a.set(key, 1)
+    assert sum(a.get(key) is not None for key in ("d", "e", "f")) == 2
+    assert a.dropped == 1
+    a.close()
+    b.close()
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2, capacity=2)
+    assert bucket.take(0) == 0.0
+    assert bucket.take(0) == 0.0
+    assert bucket.take(0) == 0.5
+    assert bucket.take(0) == 1.0
+    # Tokens taken in advance are refilled first.
+    assert bucket.take(1) == 0.5
+    # The bucket does not fill up beyond its capacity.
+    assert bucket.take(100) == 0.0
+    assert bucket.take(100) == 0.0
+    assert bucket.take(100) == 0.5
+
+
+def test_domains_file(tmp_path):
+    path = str(tmp_path / "domains.json.gz")
+    assert load_domains(path) == {}
+    save_domains(path, {"a.example": 1.0, "b.example": 3.0, "c.example": 2.0})
+    assert load_domains(path) == {
+        "a.example": 1.0,
+        "b.example": 3.0,
+        "c.example": 2.0,
+    }
+    assert load_domains(path, ttl=10, now=11.5) == {"b.example": 3.0, "c.example": 2.0}
+    # The most recently learned domains are kept.
+    save_domains(path, {"a.example": 1.0, "b.example": 3.0, "c.example": 2.0}, 2)
+    assert load_domains(path) == {"b.example": 3.0, "c.example": 2.0}
+    assert os.listdir(str(tmp_path)) == ["domains.json.gz"]
+
+
+def test_domain_trie():
+    trie = DomainTrie({"example.com": 1, "a.b.example.com": 2})
+    assert len(trie) == 2
+    assert trie.get("example.com") == 1
+    assert trie.get("b.example.com") == 1
+    assert trie.get("x.a.b.example.com") == 2
+    assert trie.get("Example.COM.") == 1
+    assert trie.match("a.b.example.com") == ("a.b.example.com", 2)
+    assert trie.get("example.org") is None
+    assert trie.get("com", 3) == 3
+    assert "b.example.com" not in trie
+    assert "a.b.example.com" in trie
+    trie["example.com"] = 4
+    assert len(trie) == 2
+    assert sorted(trie.items()) == [("a.b.example.com", 2), ("example.com", 4)]
+    trie.discard("b.example.com")
+    trie.discard("example.com")
+    assert len(trie) == 1
+    assert trie.get("b.example.com") is None
+    assert trie.get("a.b.example.com") == 2
+    trie.discard("a.b.example.com")
+    assert trie._root == {}
+
+
+def test_endpoint_pool():
+    a = Endpoint("http://a", "http://key:@a", weight=2)
+    b = Endpoint("http://b", "http://key:@b")
+    pool = EndpointPool([a, b], error_threshold=2, error_window=10, down_time=60)
+    assert pool.get("http://a") is pool.get("http://key:@a") is a
+    assert pool.get("http://c") is None
+    assert [pool.select(0) for _ in range(3)] == [a, a, b]
+    pool.release(a)
+    pool.release(a)
+    assert pool.select(0) is a
+    assert pool.record_error(b, 0) is False
+    assert pool.record_error(b, 11) is False
+    assert pool.record_error(b, 12) is True
+    assert [pool.select(12) for _ in range(3)] == [a, a, a]
+    assert not pool.all_down(12)
+    assert pool.record_error(a, 13) is False
+    assert pool.record_error(a, 13) is True
+    assert pool.all_down(13)
+    # If all endpoints are down, the one that went down first is used.
+    assert pool.select(13) is b
+    assert pool.select(72) is b
+    assert pool.select(73) is a